@@ -30,6 +30,8 @@ from ..util.misc import BackwardsCompatibility
 # Number of parallel processes.
 # This isn't in Params, because it should not be set in the settings files.
 WORKERS = 1
+# Number of pointers sent to a parallel worker at once.
+CHUNK_SIZE = 10
 
 
 class ParamBase(object):
@@ -183,6 +185,18 @@ class Params(ParamBase):
     # Iteration basis: iterate over documents or collections.
     # Valid mode names: "document" and "collection".
     iter_mode = 'document'
+    # In collection mode, process and export the documents of a collection
+    # one by one, rather than loading the whole collection first (much less
+    # memory for large collections; ignored in pipeline mode).
+    # Output formats that can't be written incrementally (currently all
+    # except bioc_xml) still keep the documents in memory until the end.
+    # Entity IDs are numbered document by document, after the highest
+    # numeric annotation ID seen so far.
+    stream_collections = False
+    # With stream_collections, read each input collection twice: first to
+    # find its highest numeric annotation ID, so that new entities never
+    # reuse an ID of a later document (only needed for annotated input).
+    stream_scan_ids = False
     # Pointer type: construct file names from IDs or use globbing.
     # Valid type names: "id" and "glob".
     pointer_type = 'id'
@@ -228,6 +242,10 @@ class Params(ParamBase):
     include_mesh = False
     # In addition to the descriptor name, add an Entity with the MeSH ID (UI).
     mesh_as_entities = False
+    # Number of processes for parsing Medline files (pxml.gz), in shards
+    # of citations (the document order is kept; outside the main thread,
+    # eg. in pipeline mode, the files are always parsed serially).
+    medline_workers = 1
     # Conflate all sections into one section (pxml, pxml.gz, pubmed, txt).
     # For txt, if single_section is False, blank lines separate sections.
     single_section = False
@@ -236,6 +254,20 @@ class Params(ParamBase):
 
     # Maximum number of IDs per request to the efetch API.
     efetch_max_ids = 1000
+    # Directory for a local copy of documents downloaded through efetch
+    # (pubmed, pmc).  Documents found there are not downloaded again.
+    efetch_store = None
+    # Never access efetch; use the documents in efetch_store only.
+    efetch_offline = False
+    # Number of efetch requests (chunks of efetch_max_ids) kept in flight,
+    # ahead of processing.
+    efetch_workers = 1
+    # NCBI API key, which allows more requests per second.
+    efetch_api_key = None
+    # Maximum number of efetch requests per second
+    # (default: 3 without an API key, 10 with one).
+    # With parallel workers (-j N), each process gets an equal share.
+    efetch_rate = None
 
     # Interpret offsets wrt bytes instead of codepoints (bioc only).
     # If you need byte offsets in the (BioC) output, then use the
@@ -297,6 +329,15 @@ class Params(ParamBase):
     # This function is called with an Article or Collection object,
     # for modifying it in-place before writing the result.
     postfilter = ()
+    # Store the entities of each article in a columnar table (arrays of
+    # offsets, sentence indices and termlist entries) instead of one object
+    # per entity.  This saves memory for articles with many entities; it
+    # doesn't make recognition, postfiltering or export faster.
+    # The built-in overlap/submatch postfilters and the TSV formats work
+    # on the table directly; other formats create the entity objects when
+    # they need them, external postfilters always get them.
+    # Ignored for collections in pipeline mode.
+    entity_table = False
 
 
     # TEXT PROCESSING.
@@ -368,11 +409,19 @@ class Params(ParamBase):
         backw_comp.warnings()
 
         # Some parameter values need preprocessing.
+        self.stream_collections = self.bool(self.stream_collections)
+        self.stream_scan_ids = self.bool(self.stream_scan_ids)
         self.ignore_load_errors = self.bool(self.ignore_load_errors)
         self.include_mesh = self.bool(self.include_mesh)
+        self.medline_workers = int(self.medline_workers)
         self.single_section = self.bool(self.single_section)
         self.sentence_split = self.bool(self.sentence_split)
         self.efetch_max_ids = int(self.efetch_max_ids)
+        self.efetch_offline = self.bool(self.efetch_offline)
+        self.efetch_workers = int(self.efetch_workers)
+        if self.efetch_rate is None:
+            self.efetch_rate = 3 if self.efetch_api_key is None else 10
+        self.efetch_rate = float(self.efetch_rate)
         self.export_format = self.split(self.export_format)
         self.extra_fields = self.split(self.extra_fields)
         self.field_names = self.mapping(self.field_names)
@@ -393,6 +442,7 @@ class Params(ParamBase):
                                 for n in a]
         self.conll_include = self.split(self.conll_include)
         self.postfilter = self.split(self.postfilter)
+        self.entity_table = self.bool(self.entity_table)
 
         self.recognizers = tuple(self.parse_ER_settings(er_params))
 
@@ -475,6 +525,23 @@ class ERParams(ParamBase):
     cache = None
     # Force loading the terms from TSV, even if a cached pickle exists.
     force_reload = False
+    # Number of processes for compiling the terms from TSV.
+    # The default compiles serially; a pool only pays off with several
+    # CPUs and a large termlist.  Outside the main thread (eg. in the
+    # REST server), the terms are always compiled serially.
+    build_workers = 1
+    # Format of the cached termlist:
+    #   pickle (fully loaded into memory at startup)
+    #   mmap (compiled index, queried lazily and shared between processes)
+    cache_format = 'pickle'
+    # Keep the termlist entries in interned column tables
+    # (much less memory for large termlists; ignored with "mmap").
+    compact = False
+    # Diff files with added and removed termlist lines (eg. from
+    # `diff -u old.tsv new.tsv`), applied to the cached termlist
+    # instead of compiling the whole TSV again.
+    # Each diff is applied only once to a cached termlist.
+    delta = None
 
     # Regular expression defining a token, as used in the ER process.
     term_token = None
@@ -486,6 +553,11 @@ class ERParams(ParamBase):
     # Local abbreviation detection (document-wise memory).
     abbrev_detection = False
 
+    # Matching engine for finding term candidates in a sentence:
+    #   hash (probe the full-term table for each term length)
+    #   trie (walk a token-level prefix tree; more memory, less probing)
+    engine = 'hash'
+
     # Normalization for term lookup.
     # This must be a name loadable from the term_normalization module.
     # If multiple names are given (separated by blanks),
@@ -493,6 +565,9 @@ class ERParams(ParamBase):
     # Some methods take parameters; join these with dashes onto the name,
     # eg. "stem-lancaster" or "unicode-NFKC".
     normalize = 'lowercase'
+    # Number of tokens for which the normalized form is cached
+    # (least-recently used are evicted first; 0 disables the cache).
+    normalize_cache = 0
 
     # Stopwords: terms that are not normalized.
     stopwords = None
@@ -515,8 +590,12 @@ class ERParams(ParamBase):
         # Some parameter values need preprocessing.
         self.skip_header = self.bool(self.skip_header)
         self.force_reload = self.bool(self.force_reload)
+        self.compact = self.bool(self.compact)
+        self.delta = self.split(self.delta or ())
+        self.build_workers = int(self.build_workers)
         self.abbrev_detection = self.bool(self.abbrev_detection)
         self.normalize = self.split(self.normalize)
+        self.normalize_cache = int(self.normalize_cache)
 
 
 def parse_cmdline(args=None):
@@ -548,6 +627,17 @@ def parse_cmdline(args=None):
         '-j', '--parallel-workers', dest='n_workers',
         type=int, default=WORKERS, metavar='N',
         help='run N parallel processes (default: %(default)s)')
+    gg.add_argument(
+        '--chunk-size', dest='chunk_size',
+        type=int, default=CHUNK_SIZE, metavar='N',
+        help='send N pointers at a time to each parallel process; '
+             'use a low value for large collections '
+             '(default: %(default)s)')
+    gg.add_argument(
+        '--pipeline', action='store_true',
+        help='run loading, entity recognition and export concurrently, '
+             'with -j N recognition processes; '
+             'the input order is preserved')
 
     pg = ap.add_argument_group(
         title='Pipeline parameters',
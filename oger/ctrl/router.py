@@ -44,9 +44,10 @@ import logging
 import itertools as it
 import multiprocessing
 from datetime import datetime
+from contextlib import ExitStack
 
 from . import parameters
-from ..doc.document import Collection, Entity
+from ..doc.document import Article, Collection, Entity
 from ..doc import EXPORTERS, LOADERS
 from ..nlp.tokenize import Text_processing
 from ..er.entity_recognition import EntityRecognizer, AbbrevDetector
@@ -71,6 +72,11 @@ class PipelineServer(object):
         _ = self.conf.postfilters
         _ = self.conf.entity_recognizers
 
+    def close(self):
+        """Release shared resources."""
+        if self._conf is not None:
+            self._conf.close()
+
     @property
     def conf(self):
         '''A Router object holding configurations.'''
@@ -106,13 +112,61 @@ class PipelineServer(object):
 
     def process(self, content):
         '''Run NER+linking on one article/collection.'''
+        table = self.conf.p.entity_table
         for er in self.ers:
-            content.recognize_entities(er)
+            content.recognize_entities(er, table=table)
 
     def postfilter(self, content):
         'Postfilter an article/collection.'
         for pf in self.conf.postfilters:
-            pf(content)
+            self.apply_postfilter(pf, content)
+
+    @staticmethod
+    def apply_postfilter(postfilter, content):
+        '''
+        Call a postfilter function on an article/collection.
+
+        External postfilters get the entity tables unpacked
+        into Entity objects first, since changes to entities
+        created on the fly (eg. through iter_entities()) would
+        not be kept.
+        '''
+        if getattr(builtin_postfilters, postfilter.__name__, None) \
+                is not postfilter:
+            for article in content.get_subelements(Article,
+                                                   include_self=True):
+                article.unpack_entities()
+        postfilter(content)
+
+    def stream_collection(self, collection, articles):
+        '''
+        Process and export a collection article by article.
+
+        Each article is exported right after processing, so
+        the collection is never held in memory as a whole
+        (as long as the output formats support it).
+        Entity IDs are numbered consecutively across the
+        articles, after the highest numeric ID of the input
+        (as far as the loader knows it in advance, see the
+        stream_scan_ids parameter), and skipping any numeric
+        IDs of the article at hand or the previous ones.
+        '''
+        next_id = collection.max_input_id + 1
+        table = self.conf.p.entity_table
+        with ExitStack() as stack:
+            writers = [stack.enter_context(w)
+                       for w in self.conf.open_collection(collection)]
+            for article in it.chain(collection, articles):
+                logging.info('Processing article %s', article.id_)
+                present = (int(e.id_) for e in article.iter_entities()
+                           if isinstance(e.id_, int) or e.id_.isdigit())
+                ids = it.count(max(next_id, max(present, default=0) + 1))
+                for er in self.ers:
+                    article.recognize_entities(er, ids, table=table)
+                next_id = next(ids)
+                self.postfilter(article)
+                for writer in writers:
+                    writer.add(article)
 
     def export(self, content, **params):
         '''Write an article/collection to disk.'''
@@ -223,6 +277,14 @@ class Router(object):
         return tuple(constr[params.abbrev_detection](params)
                      for params in self.p.recognizers)
 
+    def close(self):
+        '''
+        Release the termlists of the entity recognizers.
+        '''
+        if self._entity_recognizers is not None:
+            for er in self._entity_recognizers:
+                er.close()
+
     def ensure_cached_termlist(self):
         '''
         Make sure there is a pickled term list for fast loading.
@@ -248,27 +310,75 @@ class Router(object):
         else:
             return self._iter_documents(pointers, ctxt, loader)
 
+    def iter_content_parts(self, pointers=None):
+        '''
+        Iterate over pairs <content, pending>.
+
+        In document mode, content is an article and pending
+        is empty.
+        In collection mode, content is a collection which
+        might be incomplete: the articles from the iterator
+        pending still need to be added to it.
+        This allows processing the articles of a large
+        collection while it is still being loaded.
+        Each pending iterator must be exhausted before
+        requesting the next pair.
+        '''
+        ctxt = LoadContext(self.p.ignore_load_errors,
+                           bool(self.p.fallback_format))
+        loader = LOADERS[self.p.article_format](self)
+
+        if self.p.iter_mode == 'collection':
+            return self._iter_collection_parts(pointers, ctxt, loader)
+        else:
+            return ((a, iter(()))
+                    for a in self._iter_documents(pointers, ctxt, loader))
+
     def _iter_collections(self, pointers, ctxt, loader):
         '''
         Iterate over input collections.
+        '''
+        for coll, pending in self._iter_collection_parts(pointers, ctxt,
+                                                          loader):
+            for article in pending:
+                coll.add_article(article)
+            yield coll
+
+    def _iter_collection_parts(self, pointers, ctxt, loader):
+        '''
+        Iterate over input collections and their pending articles.
 
         With bioc, pubtator and pxml.gz input, each pointer/path
         is a collection.
-        With pubmed/pmc, there is only one collection in total.
+        With pubmed/pmc, there is only one collection in total
+        (one per worker with parallel processing).
         Otherwise, each subdirectory below input_directory
         contains one collection.
         '''
         if loader.__class__.__name__.endswith('Fetcher'):  # no unique method
             # All documents belong to the same collection.
             id_ = 'collection_{:%Y-%m-%d_%H%M%S}'.format(datetime.now())
+            process = multiprocessing.current_process().name
+            if process != 'MainProcess':
+                # Each parallel worker has its own collection.
+                id_ = '{}_{}'.format(id_, process)
             yield self._collection(id_, (pointers, ctxt, loader))
         elif hasattr(loader, 'collection'):
             # Each path node is a collection.
+            stream = (self.p.stream_collections
+                      and hasattr(loader, 'collection_parts'))
             for path, id_ in self.iter_path_ID(pointers):
                 if id_ is None:
                     id_ = os.path.splitext(os.path.basename(path))[0]
+                coll = None
                 with ctxt.setcurrent(id_):
-                    yield loader.collection(path, id_)
+                    if stream:
+                        coll, pending = loader.collection_parts(path, id_)
+                        pending = self._iter_pending(pending, ctxt, id_)
+                    else:
+                        coll, pending = loader.collection(path, id_), iter(())
+                if coll is not None:
+                    yield coll, pending
         elif hasattr(loader, 'iter_documents'):
             # Each path node is a collection.
             for path, id_ in self.iter_path_ID(pointers):
@@ -284,16 +394,19 @@ class Router(object):
             for name, paths in self._iter_subdirs(pointers):
                 yield self._collection(name, (paths, ctxt, loader))
 
-        yield from self._handle_missing_files(ctxt.pop())
+        for coll in self._handle_missing_files(ctxt.pop()):
+            yield coll, iter(())
+
+    @staticmethod
+    def _iter_pending(articles, ctxt, id_):
+        with ctxt.setcurrent(id_):
+            yield from articles
 
     def _collection(self, id_, args):
         '''
-        Construct a collection from single documents.
+        Construct an empty collection with its pending documents.
         '''
-        coll = Collection(id_)
-        for article in self._iter_documents(*args):
-            coll.add_article(article)
-        return coll
+        return Collection(id_), self._iter_documents(*args)
 
     def _iter_documents(self, pointers, ctxt, loader):
         '''
@@ -301,9 +414,15 @@ class Router(object):
         '''
         if loader.__class__.__name__.endswith('Fetcher'):  # no unique method
             it = self._iter_ids(pointers)  # use IDs, regardless of type
-            for chunk in iter_chunks(it, self.p.efetch_max_ids):
+            chunks = (list(c) for c in iter_chunks(it, self.p.efetch_max_ids))
+            if hasattr(loader, 'iter_prefetched'):
+                # Downloads of subsequent chunks may run in the background.
+                fetched = loader.iter_prefetched(chunks)
+            else:
+                fetched = ((c, loader.iter_documents(c)) for c in chunks)
+            for chunk, documents in fetched:
                 with ctxt.setcurrent():
-                    yield from self._check_ids(chunk, loader)
+                    yield from self._check_ids(chunk, documents)
         elif hasattr(loader, 'iter_documents'):
             for path, id_ in self.iter_path_ID(pointers):
                 with ctxt.setcurrent(id_):
@@ -318,7 +437,7 @@ class Router(object):
 
         yield from self._handle_missing_files(ctxt.pop())
 
-    def _check_ids(self, ids, loader):
+    def _check_ids(self, ids, documents):
         '''
         Check that an article is returned for each ID.
         '''
@@ -334,7 +453,7 @@ class Router(object):
 
         # Yield each article while updating the list of remaining IDs.
         try:
-            for a in loader.iter_documents(ids):
+            for a in documents:
                 try:
                     remaining.remove(a.id_)
                 except ValueError:
@@ -379,7 +498,8 @@ class Router(object):
         '''
         if self.p.iter_mode == 'collection' and self.p.article_format not in (
                 'bioc', 'pubtator', 'pubtator_fbk', 'pxml.gz', 'txt_json',
-                'pubmed', 'pmc', 'becalmabstracts', 'becalmpatents'):
+                'txt_jsonl', 'pubmed', 'pmc', 'becalmabstracts',
+                'becalmpatents'):
             # Subdirectory grouping requires nested pointers.
             for _, p in self._iter_subdirs(pointers):
                 yield p
@@ -521,6 +641,16 @@ class Router(object):
         for exporter in self._exporters:
             exporter.export(content)
 
+    def open_collection(self, collection):
+        '''
+        Start exporting a collection article by article.
+
+        Return a list of CollectionWriter instances
+        (one per output format).
+        '''
+        return [exporter.open_collection(collection)
+                for exporter in self._exporters]
+
     def _get_exporters(self):
         '''
         Create all required exporters.
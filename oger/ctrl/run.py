@@ -14,11 +14,21 @@ This module provides:
 '''
 
 
-import multiprocessing as mp
+import gc
+import time
+import queue
 import logging
+import threading
+import traceback
+import collections
+import itertools as it
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 
 from . import parameters
 from . import router
+from ..doc import document
+from ..util.iterate import iter_chunks
 
 
 def main():
@@ -29,18 +39,19 @@ def main():
     run(**params)
 
 
-def run(n_workers=parameters.WORKERS, **params):
+def run(n_workers=parameters.WORKERS, chunk_size=parameters.CHUNK_SIZE,
+        pipeline=False, **params):
     '''
     Run the pipeline with parsed arguments.
     '''
     try:
-        _run(n_workers, params)
+        _run(n_workers, chunk_size, pipeline, params)
     except Exception:
         logging.exception('Top-level crash:')
         raise
 
 
-def _run(n_workers, params):
+def _run(n_workers, chunk_size, pipeline, params):
     '''
     Run the pipeline with parsed arguments (wrapped function).
     '''
@@ -49,52 +60,191 @@ def _run(n_workers, params):
     # after processing the whole stack of config levels.
     master_conf = router.Router(**params)
 
+    if pipeline:
+        logging.info('Run in pipeline mode with %d recognition processes.',
+                     max(n_workers, 1))
+        run_pipelined(master_conf, max(n_workers, 1))
+        logging.info('Finished processing.')
+        return
+
     # Short-cut: Reduce overhead for single-thread execution.
     if n_workers <= 1:
         logging.info('Run in single-thread mode.')
         run_serial(master_conf)
+        log_cache_info(master_conf)
         logging.info('Finished processing.')
         return
 
-    # Avoid parallel term-list loadings by ensuring a pickled version.
-    master_conf.ensure_cached_termlist()
-    params['termlist_force_reload'] = False  # don't reload in the workers
+    # NCBI's rate limit applies to all workers together.
+    master_conf.p.efetch_rate /= n_workers
+    params['efetch_rate'] = master_conf.p.efetch_rate
+
+    if 'fork' in mp.get_all_start_methods():
+        # Load the termlists once and let the workers inherit them.
+        ctx, worker_conf = mp.get_context('fork'), master_conf
+        _load_shared(master_conf)
+    else:
+        # Avoid parallel term-list loadings by ensuring a pickled version.
+        master_conf.ensure_cached_termlist()
+        params['termlist_force_reload'] = False  # don't reload in the workers
+        ctx, worker_conf = mp, params
 
     # Set up and start the parallel workers.
     logging.info('Start %d parallel workers.', n_workers)
-    q = mp.Queue()
+    q, results = ctx.Queue(), ctx.Queue()
     workers = []
     for i in range(n_workers):
-        p = mp.Process(target=run_worker,
-                       args=(params, q, i+1))
+        p = ctx.Process(target=run_worker, name='worker{}'.format(i+1),
+                        args=(worker_conf, q, i+1, results))
         p.start()
         workers.append(p)
 
     # Iterate over the pointers.
     logging.info('Feed %s sequence to the workers.', master_conf.p.iter_mode)
-    for pointer in master_conf.iter_pointers():
-        q.put(pointer)
+    chunks, total = 0, 0
+    for chunk in iter_chunks(master_conf.iter_pointers(), chunk_size):
+        chunk = list(chunk)
+        q.put(chunk)
+        chunks += 1
+        total += len(chunk)
 
     # Tell the workers to stop and wait for them to finish.
     for _ in workers:
         q.put(None)
+    received, failed = _collect_results(results, workers, total)
     for p in workers:
         p.join()
     logging.info('Joined all workers.')
+    crashed = sum(p.exitcode != 0 for p in workers)
+    if failed or received < chunks or crashed:
+        raise RuntimeError('{} of {} chunks failed, {} unaccounted for, '
+                           '{} workers crashed'
+                           .format(failed, chunks, chunks-received, crashed))
 
 
-def run_worker(params, q, n):
+def _collect_results(results, workers, total):
     '''
-    Process articles with pointers from a queue.
+    Log progress and errors reported by the workers.
+
+    Return the number of received and failed chunks.
     '''
-    conf = router.Router(**params)
-    try:
-        run_serial(conf, iter(q.get, None))
-    except Exception:
-        logging.exception('Worker %d crashed:', n)
-        raise
-    else:
-        logging.info('Worker %d finished.', n)
+    done, received, failed = 0, 0, 0
+    while True:
+        try:
+            n, count, seconds, error = results.get(timeout=1)
+        except queue.Empty:
+            if not any(p.is_alive() for p in workers):
+                break
+            continue
+        received += 1
+        done += count
+        if error is None:
+            logging.info('Worker %d: %d items in %.1f s (%d/%d done)',
+                         n, count, seconds, done, total)
+        else:
+            failed += 1
+            logging.error('Worker %d: chunk of %d items failed after '
+                          '%.1f s (%d/%d done):\n%s',
+                          n, count, seconds, done, total, error)
+    return received, failed
+
+
+def _load_shared(conf):
+    '''
+    Load all lazy resources before forking the workers.
+
+    The workers share the loaded termlists with the master
+    process through copy-on-write memory.
+    Pages are copied only when written to; with Python objects,
+    this happens whenever a refcount changes.  Thus, dict-based
+    termlists (cache_format "pickle") are gradually copied to
+    the workers as they are accessed, while the memory-mapped
+    index (cache_format "mmap") has no per-object refcounts and
+    remains shared entirely.
+    Measured with a synthetic termlist of 1M entries (~560 MB
+    as in-memory dicts) and 4 workers, private memory per worker
+    (at peak):
+        pickle, loaded in each worker:  ~590 MB
+        pickle, shared through fork:    ~120 MB
+        mmap, shared through fork:       ~70 MB
+    (about 35 MB of which is the interpreter and libraries).
+    '''
+    logging.info('Load termlists for sharing with the workers.')
+    router.PipelineServer(conf, lazy=False)
+    if hasattr(gc, 'freeze'):  # Python 3.7+
+        # Keep the garbage collector from touching (and thereby copying)
+        # all objects created so far.
+        gc.collect()
+        gc.freeze()
+
+
+def run_worker(conf, q, n, results=None):
+    '''
+    Process articles with chunks of pointers from a queue.
+
+    The conf argument is either a loaded Router instance
+    (inherited through fork) or a dict of parameters.
+    All chunks are processed in one run, such that loaders
+    can group pointers across chunks (eg. up to efetch_max_ids
+    IDs per efetch request) and collections are not split.
+    For each chunk, a tuple <n, count, seconds, error> is put
+    on the results queue, where error is None or a formatted
+    traceback.
+    '''
+    if not isinstance(conf, router.Router):
+        conf = router.Router(**conf)
+    feed = _ChunkFeed(q, n, results)
+    while not feed.exhausted:
+        try:
+            run_serial(conf, iter(feed))
+        except Exception:
+            logging.exception('Worker %d failed on a chunk:', n)
+            if not feed.report(traceback.format_exc()):
+                raise  # not caused by a chunk
+        else:
+            feed.report()
+    log_cache_info(conf, 'Worker {}: '.format(n))
+    logging.info('Worker %d finished.', n)
+
+
+class _ChunkFeed(object):
+    '''
+    Iterate over the pointers of all chunks from a queue.
+
+    A chunk is reported on the results queue when the next
+    chunk is requested.  Loaders reading ahead (eg. efetch)
+    thus report chunks before they are fully processed.
+    After a failure, iteration can be resumed with the next
+    chunk.
+    '''
+    def __init__(self, q, n, results):
+        self.q = q
+        self.n = n
+        self.results = results
+        self.exhausted = False
+        self._current = None
+        self._start = None
+
+    def __iter__(self):
+        for chunk in iter(self.q.get, None):
+            self.report()
+            self._current, self._start = chunk, time.time()
+            yield from chunk
+        self.exhausted = True
+
+    def report(self, error=None):
+        '''
+        Report the current chunk, if any.
+
+        Return True if there was a chunk to report.
+        '''
+        chunk, self._current = self._current, None
+        if chunk is None:
+            return False
+        if self.results is not None:
+            self.results.put((self.n, len(chunk), time.time()-self._start,
+                              error))
+        return True
 
 
 def run_serial(conf, pointers=None):
@@ -103,8 +253,205 @@ def run_serial(conf, pointers=None):
     '''
     server = router.PipelineServer(conf, lazy=False)
     level = 'collection' if conf.p.iter_mode == 'collection' else 'article'
-    for content in server.iter_contents(pointers):
-        logging.info('Processing %s %s', level, content.id_)
-        server.process(content)
-        server.postfilter(content)
-        server.export(content)
+    if level == 'collection' and conf.p.stream_collections:
+        for coll, articles in server.conf.iter_content_parts(pointers):
+            logging.info('Streaming collection %s', coll.id_)
+            server.stream_collection(coll, articles)
+    else:
+        for content in server.iter_contents(pointers):
+            logging.info('Processing %s %s', level, content.id_)
+            server.process(content)
+            server.postfilter(content)
+            server.export(content)
+
+
+def log_cache_info(conf, prefix=''):
+    '''
+    Report the efficiency of the normalization caches.
+
+    Called once per process, after all chunks are done.
+    '''
+    for i, er in enumerate(conf.entity_recognizers, 1):
+        info = er.normalize_cache_info()
+        if info is not None and info.hits + info.misses:
+            logging.info('%sNormalization cache %d: %d hits, %d misses '
+                         '(%.1f%%), %d/%d entries',
+                         prefix, i, info.hits, info.misses,
+                         100*info.hits/(info.hits+info.misses),
+                         info.currsize, info.maxsize)
+
+
+# ============== #
+# PIPELINE MODE. #
+# ============== #
+
+# Items in the pipeline stream.
+_ARTICLE, _END, _ERROR = range(3)
+
+# Placeholder for entity IDs assigned in the recognition processes.
+_LocalID = collections.namedtuple('_LocalID', 'er index')
+
+# Recognition processes access the server through this global.
+_pipeline_server = None
+
+
+def run_pipelined(conf, n_workers, buffer_size=None):
+    '''
+    Run loading, recognition and export as concurrent stages.
+
+    The stages are connected through bounded queues:
+    - a loader thread parses the input (lxml releases the GIL
+      for much of the parsing),
+    - n_workers processes run entity recognition on
+      individual articles,
+    - the calling thread exports the results.
+    Articles are exported in input order.  In collection mode,
+    the processed articles are reassembled into their
+    collections; entity IDs and postfilters are computed
+    exactly as in serial processing.
+    '''
+    if buffer_size is None:
+        buffer_size = 4 * n_workers
+    server = router.PipelineServer(conf)
+
+    global _pipeline_server
+    _pipeline_server = server
+    if 'fork' in mp.get_all_start_methods():
+        ctx, worker_params = mp.get_context('fork'), None
+        _load_shared(conf)
+    else:
+        conf.ensure_cached_termlist()
+        ctx = mp
+        worker_params = router.Router(conf, termlist_force_reload=False).p
+
+    collection_mode = conf.p.iter_mode == 'collection'
+    with ProcessPoolExecutor(n_workers, ctx, _init_pipeline_worker,
+                             (worker_params,)) as pool:
+        # Start all workers before the loader thread: a process forked
+        # while the parser holds a lock (lxml, gzip) might deadlock.
+        for future in [pool.submit(int) for _ in range(n_workers)]:
+            future.result()
+        loaded = queue.Queue(maxsize=buffer_size)
+        loader = threading.Thread(target=_load_stage, daemon=True,
+                                  args=(server, loaded))
+        loader.start()
+
+        pending = collections.deque()
+        for kind, item, coll in iter(loaded.get, None):
+            if kind == _ERROR:
+                raise item
+            if kind == _ARTICLE:
+                # Keep the (large) tokenizer out of the pickle.
+                tokenizer, item.tokenizer = item.tokenizer, None
+                future = pool.submit(_recognize, item, collection_mode)
+                item = future, tokenizer
+            pending.append((kind, item, coll))
+            while pending and (len(pending) > buffer_size
+                               or _is_ready(pending[0])):
+                _export_stage(server, *pending.popleft())
+        while pending:
+            _export_stage(server, *pending.popleft())
+    loader.join()
+
+
+def _load_stage(server, loaded):
+    '''
+    Put articles and complete collections on the queue.
+
+    Each item is a triple <kind, item, collection>, where
+    collection is the collection an article belongs to (None
+    in document mode).
+    '''
+    try:
+        for content, articles in server.conf.iter_content_parts():
+            if isinstance(content, document.Article):
+                loaded.put((_ARTICLE, content, None))
+                continue
+            # Send the articles of the collection individually.
+            present, content.subelements = content.subelements, []
+            for article in it.chain(present, articles):
+                loaded.put((_ARTICLE, article, content))
+            loaded.put((_END, content, None))
+    except Exception as e:
+        loaded.put((_ERROR, e, None))
+    loaded.put(None)
+
+
+def _is_ready(entry):
+    kind, item, _ = entry
+    return kind != _ARTICLE or item[0].done()
+
+
+def _export_stage(server, kind, item, coll):
+    '''
+    Export articles and reassembled collections.
+    '''
+    if kind == _ARTICLE:
+        future, tokenizer = item
+        article = future.result()
+        article.tokenizer = tokenizer
+        if coll is not None:
+            coll.add_article(article)
+        else:
+            logging.info('Processing article %s', article.id_)
+            server.export(article)
+    else:
+        logging.info('Processing collection %s', item.id_)
+        _assign_entity_ids(item)
+        server.postfilter(item)
+        server.export(item)
+
+
+def _init_pipeline_worker(params):
+    global _pipeline_server
+    if params is not None:
+        _pipeline_server = router.PipelineServer(router.Router(params),
+                                                 lazy=False)
+
+
+def _recognize(article, collection_mode):
+    '''
+    Run entity recognition on one article in a worker process.
+
+    In document mode, the article is also postfiltered.
+    In collection mode, the entities get placeholder IDs,
+    which are resolved once the collection is complete.
+    '''
+    server = _pipeline_server
+    if not collection_mode:
+        server.process(article)
+        server.postfilter(article)
+        return article
+    for r, er in enumerate(server.ers):
+        ids = (_LocalID(r, i) for i in it.count())
+        er.reset()
+        for sentence in article.get_subelements(document.Sentence):
+            sentence.recognize_entities(er, ids)
+    return article
+
+
+def _assign_entity_ids(collection):
+    '''
+    Replace placeholder IDs with collection-wide numbers.
+
+    The numbering is the same as with Collection.recognize_entities:
+    consecutive for each entity recognizer, starting after the
+    highest ID present before.
+    '''
+    new, previous = collections.defaultdict(list), []
+    for article in collection.get_subelements('article'):
+        local = collections.defaultdict(list)
+        for e in article.iter_entities():
+            if isinstance(e.id_, _LocalID):
+                local[e.id_.er].append(e)
+            else:
+                previous.append(e)
+        for r, entities in local.items():
+            entities.sort(key=lambda e: e.id_.index)
+            new[r].extend(entities)
+    last = max((int(e.id_) for e in previous
+                if isinstance(e.id_, int) or e.id_.isdigit()), default=0)
+    for r in sorted(new):
+        for id_, e in enumerate(new[r], start=last+1):
+            e.id_ = id_
+        last += len(new[r])
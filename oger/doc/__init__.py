@@ -27,6 +27,7 @@ from .europepmc import *
 LOADERS = {
     'txt': TXTLoader,
     'txt_json': TXTJSONLoader,
+    'txt_jsonl': TXTJSONLinesLoader,
     'txt.tar': TXTTarLoader,
     'txt_tsv': TXTTSVLoader,
     'bioc': BioCXMLLoader,  # keep for backwards compatibility
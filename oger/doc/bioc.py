@@ -13,7 +13,6 @@ __all__ = ['BioCXMLLoader', 'BioCJSONLoader',
            'BioCXMLFormatter', 'BioCJSONFormatter']
 
 
-import json
 import logging
 from collections import OrderedDict
 
@@ -22,8 +21,9 @@ from lxml.builder import E
 
 from .document import Collection, Article, Entity
 from .load import CollLoader, text_node
-from .export import XMLMemoryFormatter, StreamFormatter
+from .export import XMLMemoryFormatter, StreamFormatter, CollectionWriter
 from ..util.iterate import peekaheaditer, json_iterencode
+from ..util.jsonstream import iter_members
 from ..util.misc import iter_codepoint_indices_utf8, iter_byte_indices_utf8
 from ..util.stream import text_stream, basename
 
@@ -60,14 +60,58 @@ class _BioCLoader(CollLoader, _OffsetMixin):
     def collection(self, source, id_):
         coll_node, docs = self._parse_collection(source)
         collection = Collection(id_, basename(source))
-        collection.metadata = self._meta_dict(coll_node)
         for doc in docs:
             collection.add_article(self._article(doc))
+        # Metadata may also follow the documents.
+        collection.metadata = self._meta_dict(coll_node)
         return collection
 
+    def collection_parts(self, source, id_):
+        '''
+        Get an empty collection and an iterator of its articles.
+
+        The collection has the metadata of the BioC collection
+        (as far as it precedes the first document).
+        Only one document node at a time is kept in memory.
+
+        With the stream_scan_ids parameter, the source is read
+        twice: a first pass finds the highest numeric annotation
+        ID, so that new entities can be numbered after it, as with
+        a fully loaded collection.
+        '''
+        max_id = 0
+        if self.config.p.stream_scan_ids:
+            max_id = max(self._numeric_ids(source), default=0)
+        coll_node, docs = self._parse_collection(source)
+        collection = Collection(id_, basename(source))
+        collection.metadata = self._meta_dict(coll_node)
+        collection.max_input_id = max_id
+        return collection, (self._article(doc) for doc in docs)
+
+    def _numeric_ids(self, source):
+        '''
+        Iterate over all numeric annotation IDs of a collection.
+        '''
+        for doc in self._iterparse(source):
+            for passage in self._iterfind(doc, 'passage'):
+                nodes = [passage, *self._iterfind(passage, 'sentence')]
+                for node in nodes:
+                    for anno in self._iterfind(node, 'annotation'):
+                        id_ = anno.get('id')
+                        if isinstance(id_, int) or (isinstance(id_, str)
+                                                    and id_.isdigit()):
+                            yield int(id_)
+
+    def iter_documents(self, source):
+        for doc in self._iterparse(source):
+            yield self._article(doc)
+
     def _parse_collection(self, source):
         raise NotImplementedError
 
+    def _iterparse(self, source):
+        raise NotImplementedError
+
     def _article(self, node):
         '''
         Read a document node into a document.Article object.
@@ -198,15 +242,15 @@ class BioCXMLLoader(_BioCLoader):
         coll_node = next(docs).getparent()
         return coll_node, docs
 
-    def iter_documents(self, source):
-        for doc in self._iterparse(source):
-            yield self._article(doc)
-
     @staticmethod
     def _iterparse(source):
         for _, node in etree.iterparse(source, tag='document'):
             yield node
             node.clear()
+            # Drop the previous (cleared) document from the tree.
+            previous = node.getprevious()
+            if previous is not None and previous.tag == 'document':
+                node.getparent().remove(previous)
 
     def infon_dict(self, node):
         return {n.attrib['key']: n.text for n in self._iterfind(node, 'infon')}
@@ -225,14 +269,32 @@ class BioCJSONLoader(_BioCLoader):
     Parser for BioC JSON.
     '''
 
+    def _parse_collection(self, source):
+        '''
+        Get the collection node and an iterator of document nodes.
+
+        The collection node is a dict, which is filled with
+        the other members of the collection while iterating.
+        '''
+        coll_node = {}
+        docs = peekaheaditer(self._iterparse(source, coll_node))
+        next(docs, None)  # read up to the first document
+        return coll_node, docs
+
     @staticmethod
-    def _parse_collection(source):
+    def _iterparse(source, coll_node=None):
         '''
-        Read BioC JSON into a document.Collection object.
+        Iterate over the document nodes of a BioC collection.
+
+        The JSON input is parsed incrementally, so only one
+        document node at a time is kept in memory.
         '''
         with text_stream(source) as f:
-            coll_node = json.load(f)
-        return coll_node, coll_node['documents']
+            for key, value in iter_members(f, 'documents'):
+                if key == 'documents':
+                    yield value
+                elif coll_node is not None:
+                    coll_node[key] = value
 
     @staticmethod
     def infon_dict(node):
@@ -261,6 +323,11 @@ class BioCXMLFormatter(XMLMemoryFormatter, _OffsetMixin):
         else:
             super().write(stream, content)
 
+    def iter_dump(self, content):
+        if isinstance(content, Collection):
+            return self._iter_bytes(content)
+        return super().iter_dump(content)
+
     def _dump(self, content):
         coll = wrap_in_collection(content)
         return self._collection(coll)
@@ -269,25 +336,35 @@ class BioCXMLFormatter(XMLMemoryFormatter, _OffsetMixin):
         kwargs.setdefault('doctype', self.doctype)
         return super()._tostring(node, **kwargs)
 
+    def open_collection(self, collection):
+        return _BioCXMLWriter(self, collection)
+
     def _iter_bytes(self, coll):
         '''
         Iterate over fragments of serialised BioC bytes.
         '''
-        # Serialise the outer shell and split off the closing tag.
-        shell = self._tostring(self._collection_frame(coll))
-        tail = '</collection>\n'.encode('UTF-8')
-        head = shell[:-len(tail)]
+        head, tail = self._frame_bytes(coll)
 
         # Yield fragment by fragment.
         yield head
 
         for article in coll:
-            node = self._document(article)
-            frag = self._tostring(node, doctype=None, xml_declaration=False)
-            yield frag
+            yield self._document_bytes(article)
 
         yield tail
 
+    def _frame_bytes(self, coll):
+        '''
+        Serialise the outer shell and split off the closing tag.
+        '''
+        shell = self._tostring(self._collection_frame(coll))
+        tail = '</collection>\n'.encode('UTF-8')
+        return shell[:-len(tail)], tail
+
+    def _document_bytes(self, article):
+        node = self._document(article)
+        return self._tostring(node, doctype=None, xml_declaration=False)
+
     def _collection(self, coll):
         node = self._collection_frame(coll)
         for article in coll:
@@ -384,6 +461,25 @@ class BioCXMLFormatter(XMLMemoryFormatter, _OffsetMixin):
         node.append(E('infon', value, key=key))
 
 
+class _BioCXMLWriter(CollectionWriter):
+    '''
+    Write the documents of a BioC collection as they are added.
+    '''
+    def __init__(self, formatter, collection):
+        super().__init__(formatter, collection)
+        self._file = formatter.open_file(collection)
+        head, self._tail = formatter._frame_bytes(collection)
+        self._file.write(head)
+
+    def add(self, article):
+        self._file.write(self.formatter._document_bytes(article))
+
+    def close(self, complete=True):
+        with self._file:
+            if complete:
+                self._file.write(self._tail)
+
+
 class BioCJSONFormatter(StreamFormatter, _OffsetMixin):
     '''
     BioC JSON output format.
@@ -17,12 +17,29 @@ The hierarchy is fixed:
 
 Matched entities are anchored at the sentence level.
 Word-level tokenization can be skipped.
+
+Units below the article level have fixed attributes
+(__slots__) and create their lists only when needed.
+Sentences split from a section text don't hold a copy of
+their text; it is sliced from the section text on access.
+The text is shared per section, not per article: input
+formats like BioC place passages at arbitrary offsets (with
+gaps, or even overlapping), so the section texts can't always
+be joined into one article buffer.  Either way, each character
+of the input is stored once.
+Memory of a loaded collection: see doc_memory in
+oger.test.benchmark.
+
+Optionally, the entities of an article are kept in a columnar
+EntityTable; Entity objects are then created on demand.
 """
 
 
 import re
 import pickle
+import bisect
 import itertools as it
+from array import array
 from collections import namedtuple
 
 from ..util.iterate import peekaheaditer
@@ -32,12 +49,24 @@ class Unit(object):
     """
     Base class for all levels of representation.
     """
+    __slots__ = ('id_', '_subelements', '_metadata')
 
     def __init__(self, id_):
-        self.subelements = []
+        self._subelements = None
         self.id_ = id_
         self._metadata = None
 
+    @property
+    def subelements(self):
+        '''Units of the next lower level.'''
+        if self._subelements is None:
+            self._subelements = []
+        return self._subelements
+
+    @subelements.setter
+    def subelements(self, value):
+        self._subelements = value
+
     @property
     def metadata(self):
         '''Metadata imported from input documents.'''
@@ -51,14 +80,14 @@ class Unit(object):
 
     def __repr__(self):
         name = self.__class__.__name__
-        elems = len(self.subelements)
+        elems = len(self._subelements or ())
         plural = '' if elems == 1 else 's'
         address = hex(id(self))
         return ('<{} with {} subelement{} at {}>'
                 .format(name, elems, plural, address))
 
     def __iter__(self):
-        return iter(self.subelements)
+        return iter(self._subelements or ())
 
     def __getitem__(self, index):
         return self.subelements[index]
@@ -103,18 +132,18 @@ class Unit(object):
             # The root level matches.
             return iter([self])
 
-        if not self.subelements:
+        if not self._subelements:
             # No subelements -- nothing to return.
             return iter([])
 
-        if isinstance(self.subelements[0], subelement_type):
+        if isinstance(self._subelements[0], subelement_type):
             # The first sub-level matches.
-            return iter(self.subelements)
+            return iter(self._subelements)
 
         else:
             # Recursively descend into sub-subelements.
             return (subsub
-                    for sub in self.subelements
+                    for sub in self._subelements
                     for subsub in sub.get_subelements(subelement_type))
 
     def iter_entities(self):
@@ -159,18 +188,49 @@ class Exporter(Unit):
             yield from section.iter_text()
             offset = section.end
 
-    def recognize_entities(self, entity_recognizer):
+    def iter_entities(self):
         '''
-        Delegate entity recognition to the sentence unit.
+        Iterate over all entities, ordered by start offset.
+
+        The entities of an article with an entity table are
+        created on the fly; changes to them are not kept.
         '''
-        previous_ids = (int(e.id_) for e in self.iter_entities()
-                        if isinstance(e.id_, int) or e.id_.isdigit())
-        start_id = max(previous_ids, default=0) + 1
-        ids = it.count(start_id)
+        for article in self.get_subelements(Article, include_self=True):
+            table = article.entity_table
+            if table is None:
+                yield from Unit.iter_entities(article)
+            else:
+                yield from table.iter_entities(
+                    article.get_subelements(Sentence))
+
+    def recognize_entities(self, entity_recognizer, ids=None, table=False):
+        '''
+        Run entity recognition on all sentences, article by article.
+
+        Unless an iterator of IDs is given, the new entities are
+        numbered after the highest numeric ID present.
+
+        If table is True, the entities of each article are stored
+        in an EntityTable rather than as Entity objects, unless
+        any sentence holds entities already (eg. from the input).
+        '''
+        if ids is None:
+            previous_ids = (int(e.id_) for e in self.iter_entities()
+                            if isinstance(e.id_, int) or e.id_.isdigit())
+            start_id = max(previous_ids, default=0) + 1
+            ids = it.count(start_id)
         for article in self.get_subelements(Article, include_self=True):
             entity_recognizer.reset()
-            for sentence in article.get_subelements(Sentence):
-                sentence.recognize_entities(entity_recognizer, ids)
+            sentences = list(article.get_subelements(Sentence))
+            if table and not any(s._entities for s in sentences):
+                article.add_entity_rows(
+                    sentences,
+                    (entity_recognizer.recognize_entities(s.text)
+                     for s in sentences),
+                    ids)
+            else:
+                for sentence in sentences:
+                    sentence.recognize_entities(entity_recognizer, ids)
 
     def pickle(self, output_filename):
         '''
@@ -188,6 +248,11 @@ class Exporter(Unit):
 
 class Collection(Exporter):
     """A collection of multiple articles."""
+
+    # Highest numeric entity ID in the input, if known before all
+    # articles are loaded (see PipelineServer.stream_collection()).
+    max_input_id = 0
+
     @classmethod
     def from_iterable(cls, iterable, id_, basename=None):
         '''
@@ -210,6 +275,10 @@ class Collection(Exporter):
 
 class Article(Exporter):
     '''An article with text, metadata and annotations.'''
+
+    # Columnar entity storage (see recognize_entities()).
+    entity_table = None
+
     def __init__(self, id_, basename=None, tokenizer=None):
         super().__init__(id_, basename)
         # The tokenizer is used for sentence splitting and word tokenization.
@@ -220,29 +289,64 @@ class Article(Exporter):
         self.year = None
         self._char_cursor = 0
 
-    def add_section(self, section_type, text, offset=None):
+    def add_section(self, section_type, text, offset=None, spans=None):
         '''
         Append a section to the end.
 
         The text can be either a str or an iterable of str.
+        For a str, spans may give the sentence boundaries
+        (pairs of offsets relative to text), if already known.
         '''
         id_ = len(self.subelements)
         if offset is None:
             offset = self._char_cursor
-        section = Section(id_, section_type, text, self, offset)
+        section = Section(id_, section_type, text, self, offset, spans)
         self.add_subelement(section)
         self._char_cursor = section.end
 
+    def add_entity_rows(self, sentences, entities, ids):
+        '''
+        Add recognized entities to the entity table.
+
+        The table is created if necessary.  The sentences are
+        all sentences of this article; entities has a sequence
+        of <(start, end), info> pairs for each of them.
+        '''
+        if self.entity_table is None:
+            self.entity_table = EntityTable()
+        table = self.entity_table
+        prev_len = len(table)
+        for i, (sentence, found) in enumerate(zip(sentences, entities)):
+            table.extend(i, sentence.start, found, ids)
+        if prev_len:
+            # Sort in the new rows.
+            table.sort()
+
+    def unpack_entities(self):
+        '''
+        Move the entities of the table to the sentences.
+
+        This creates an Entity object for each row and
+        removes the table.
+        '''
+        table, self.entity_table = self.entity_table, None
+        if table is not None:
+            table.unpack(self.get_subelements(Sentence))
+
 
 class Section(Unit):
     """Any unit of text between document and sentence level."""
+    __slots__ = ('type_', 'article', '_text', 'start', 'end')
 
-    def __init__(self, id_, section_type, text, article, start=0):
+    def __init__(self, id_, section_type, text, article, start=0,
+                 spans=None):
         '''
         A section (eg. title, abstract, mesh list).
 
         The text can be a single string or a list of
         strings (sentences).
+        A single string is split into sentences, unless
+        their spans (relative to text) are given.
         '''
         super().__init__(id_)
 
@@ -254,9 +358,16 @@ class Section(Unit):
         self.end = start
 
         if isinstance(text, str):
-            # Single string element.
-            self.add_sentences(
-                self.article.tokenizer.span_tokenize_sentences(text, start))
+            # Single string element, shared with the sentences.
+            if spans is None:
+                spans = ((s, e) for _, s, e in
+                         self.article.tokenizer.span_tokenize_sentences(text))
+            first_id = len(self.subelements)
+            for id_, (s_start, s_end) in enumerate(spans, first_id):
+                s_start, s_end = s_start + start, s_end + start
+                self.add_subelement(
+                    Sentence(id_, text, self, s_start, s_end, base=start))
+            self._update_offsets()
             self._text = text
         else:
             # Iterable of strings or <string, offset...> tuples.
@@ -315,30 +426,78 @@ class Section(Unit):
         first_id = len(self.subelements)
         for id_, (sent, *span) in enumerate(sentences, first_id):
             self.add_subelement(Sentence(id_, sent, self, *span))
-        if self.subelements:
+        self._update_offsets()
+
+    def _update_offsets(self):
+        if self._subelements:
             # Adjust the section-level offsets based on the sentences.
-            self.start = self.subelements[0].start
-            self.end = self.subelements[-1].end
+            self.start = self._subelements[0].start
+            self.end = self._subelements[-1].end
 
 
 class Sentence(Unit):
     '''
     Central annotation unit.
     '''
-    def __init__(self, id_, text, section=None, start=0, end=None):
+    __slots__ = ('_buffer', '_base', 'section', '_entities', 'start', 'end')
+
+    def __init__(self, id_, text, section=None, start=0, end=None,
+                 base=None):
+        '''
+        If base is given, text is a buffer shared with other
+        units (eg. the section text), which starts at offset
+        base; this sentence is the part from start to end.
+        '''
         super().__init__(id_)
-        self.text = text
+        self._buffer = text
+        self._base = base
         self.section = section
-        self.entities = []
+        self._entities = None
         # Character offsets:
         self.start = start
         self.end = end if end is not None else start + len(text)
 
+    @property
+    def text(self):
+        '''The text of this sentence.'''
+        if self._base is None:
+            return self._buffer
+        return self._buffer[self.start-self._base:self.end-self._base]
+
+    @text.setter
+    def text(self, value):
+        self._buffer = value
+        self._base = None
+
+    @property
+    def entities(self):
+        '''List of entities, sorted by offsets.'''
+        if self._entities is None:
+            self._unpack_table()
+            if self._entities is None:
+                self._entities = []
+        return self._entities
+
+    @entities.setter
+    def entities(self, value):
+        if self._entities is None:
+            self._unpack_table()
+        self._entities = value
+
+    def _unpack_table(self):
+        # Create the Entity objects of the article's entity table, if any.
+        try:
+            table = self.section.article.entity_table
+        except AttributeError:
+            return
+        if table is not None:
+            self.section.article.unpack_entities()
+
     def tokenize(self):
         '''
         Word-tokenize this sentence.
         '''
-        if not self.subelements and self.text:
+        if not self._subelements and self.text:
             tokenizer = self.section.article.tokenizer
             toks = tokenizer.span_tokenize_words(self.text, self.start)
             for id_, (token, start, end) in enumerate(toks):
@@ -350,18 +509,17 @@ class Sentence(Unit):
         '''
         if ids is None:
             ids = it.count()
-        entities = entity_recognizer.recognize_entities(self.text)
+        text = self.text
+        entities = entity_recognizer.recognize_entities(text)
+        new = [Entity(id_, text[start:end], start+self.start, end+self.start,
+                      info)
+               for ((start, end), info), id_ in zip(entities, ids)]
+        if not new:
+            return
         prev_len = len(self.entities)
-        for ((start, end), info), id_ in zip(entities, ids):
-            surface = self.text[start:end]
-            entity = Entity(id_,
-                            surface,
-                            start+self.start,
-                            end+self.start,
-                            info)
-            self.entities.append(entity)
-
-        if prev_len and len(self.entities) > prev_len:
+        self.entities.extend(new)
+
+        if prev_len:
             # If the new annotations weren't the first ones, then they need
             # to be sorted in.
             self.entities.sort(key=Entity.sort_key)
@@ -370,7 +528,9 @@ class Sentence(Unit):
         '''
         Iterate over all entities, sorted by occurrence.
         '''
-        yield from self.entities
+        if self._entities is None:
+            self._unpack_table()
+        yield from self._entities or ()
 
     def get_section_type(self, default=None):
         '''
@@ -470,3 +630,152 @@ class Entity(object):
         Sort entities by offset.
         '''
         return entity.start, entity.end
+
+
+class EntityTable(object):
+    '''
+    Columnar storage for the entities of an article.
+
+    Each entity is a row in the parallel arrays start, end
+    (absolute offsets), sentence (index within the article)
+    and entry (index into the distinct info tuples in
+    entries).  The entity IDs are kept in a list.
+    The rows are sorted by sentence and offsets.
+    '''
+    __slots__ = ('start', 'end', 'sentence', 'entry', 'ids',
+                 'entries', '_entry_index')
+
+    def __init__(self):
+        self.start = array('l')
+        self.end = array('l')
+        self.sentence = array('l')
+        self.entry = array('l')
+        self.ids = []
+        self.entries = []
+        self._entry_index = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return '<{} with {} rows at {}>'.format(
+            self.__class__.__name__, len(self), hex(id(self)))
+
+    def extend(self, sentence, offset, entities, ids):
+        '''
+        Append entities found in one sentence.
+
+        Each entity is a pair <(start, end), info> with offsets
+        relative to the sentence, which starts at offset.
+        '''
+        for ((start, end), info), id_ in zip(entities, ids):
+            self.start.append(start+offset)
+            self.end.append(end+offset)
+            self.sentence.append(sentence)
+            self.entry.append(self._intern(info))
+            self.ids.append(id_)
+
+    def _intern(self, info):
+        try:
+            return self._entry_index[info]
+        except KeyError:
+            index = self._entry_index[info] = len(self.entries)
+            self.entries.append(info)
+            return index
+
+    def info(self, row):
+        '''The info tuple of this row.'''
+        return self.entries[self.entry[row]]
+
+    # Accessor methods for the standard fields (cf. Entity):
+
+    def type(self, row):
+        'Entity-type field.'
+        return self.entries[self.entry[row]][0]
+
+    def pref(self, row):
+        'Preferred-form field.'
+        return self.entries[self.entry[row]][1]
+
+    def db(self, row):
+        'Original-resource field.'
+        return self.entries[self.entry[row]][2]
+
+    def cid(self, row):
+        'Concept-ID field (defined by DB).'
+        return self.entries[self.entry[row]][3]
+
+    def cui(self, row):
+        'UMLS CUI field.'
+        return self.entries[self.entry[row]][4]
+
+    def extra(self, row):
+        'Any additional fields.'
+        return self.entries[self.entry[row]][5:]
+
+    def text(self, row, sentence):
+        '''The text of this row, taken from its sentence.'''
+        offset = sentence.start
+        return sentence.text[self.start[row]-offset:self.end[row]-offset]
+
+    def text_wn(self, row, sentence):
+        '''Whitespace normalised text: replace newlines and tabs.'''
+        return re.sub(r'\s', ' ', self.text(row, sentence))
+
+    def rows(self, sentence):
+        '''Range of the rows belonging to this sentence index.'''
+        return range(bisect.bisect_left(self.sentence, sentence),
+                     bisect.bisect_right(self.sentence, sentence))
+
+    def sort(self):
+        '''
+        Sort the rows by sentence and offsets (stable).
+        '''
+        keys = list(zip(self.sentence, self.start, self.end))
+        self.take(sorted(range(len(self)), key=keys.__getitem__))
+
+    def take(self, rows):
+        '''
+        Keep only the given rows, in the given order.
+        '''
+        for name in ('start', 'end', 'sentence', 'entry'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode,
+                                      (column[r] for r in rows)))
+        self.ids = [self.ids[r] for r in rows]
+
+    def remove(self, rows):
+        '''
+        Remove the given rows.
+        '''
+        rows = set(rows)
+        if rows:
+            self.take([r for r in range(len(self)) if r not in rows])
+
+    def entity(self, row, sentence):
+        '''
+        Create an Entity object for this row.
+
+        The entity text is taken from the sentence.
+        '''
+        return Entity(self.ids[row], self.text(row, sentence),
+                      self.start[row], self.end[row], self.info(row))
+
+    def iter_entities(self, sentences):
+        '''
+        Iterate over Entity objects for all rows.
+
+        The sentences are all sentences of the article.
+        '''
+        for i, sentence in enumerate(sentences):
+            for row in self.rows(i):
+                yield self.entity(row, sentence)
+
+    def unpack(self, sentences):
+        '''
+        Append the entities of each row to its sentence.
+        '''
+        for i, sentence in enumerate(sentences):
+            entities = [self.entity(row, sentence) for row in self.rows(i)]
+            if entities:
+                sentence.entities.extend(entities)
@@ -14,6 +14,9 @@ import io
 
 from lxml import etree
 
+from .document import Collection
+from ..util.stream import iter_written
+
 
 class Formatter:
     '''
@@ -30,18 +33,31 @@ class Formatter:
         '''
         Write this content to disk.
         '''
+        with self.open_file(content) as f:
+            self.write(f, content)
+
+    def open_file(self, content):
+        '''
+        Open the output file for this content.
+        '''
         open_params = self._get_open_params(content)
         try:
-            f = open(**open_params)
+            return open(**open_params)
         except FileNotFoundError:
             # An intermediate directory didn't exist.
             # Create it and try again.
             # (Use exist_ok because of race conditions -- another
             # worker might have created it in the meantime.)
             os.makedirs(os.path.dirname(open_params['file']), exist_ok=True)
-            f = open(**open_params)
-        with f:
-            self.write(f, content)
+            return open(**open_params)
+
+    def open_collection(self, collection):
+        '''
+        Start exporting a collection article by article.
+
+        Return a CollectionWriter.
+        '''
+        return CollectionWriter(self, collection)
 
     def write(self, stream, content):
         '''
@@ -55,6 +71,12 @@ class Formatter:
         '''
         raise NotImplementedError()
 
+    def iter_dump(self, content):
+        '''
+        Serialise the content to a sequence of str or bytes chunks.
+        '''
+        yield self.dump(content)
+
     def _get_open_params(self, content):
         path = self.config.get_out_path(content.id_, content.basename,
                                         self.fmt_name, self.ext)
@@ -64,6 +86,41 @@ class Formatter:
             return dict(file=path, mode='w', encoding='utf8')
 
 
+class CollectionWriter:
+    '''
+    Export of a collection whose articles are added one by one.
+
+    Use it as a context manager: on leaving the context without
+    an exception, the export is completed.
+    This base class keeps all articles and exports the whole
+    collection at the end; subclasses write each article as
+    soon as it is added.
+    '''
+    def __init__(self, formatter, collection):
+        self.formatter = formatter
+        self.collection = Collection(collection.id_, collection.basename)
+        self.collection.metadata = collection.metadata
+
+    def add(self, article):
+        '''
+        Add a processed article.
+        '''
+        self.collection.add_article(article)
+
+    def close(self, complete=True):
+        '''
+        Finish the export (unless complete is False).
+        '''
+        if complete:
+            self.formatter.export(self.collection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(complete=exc_type is None)
+
+
 class MemoryFormatter(Formatter):
     '''
     Abstract formatter with a primary dump method.
@@ -88,6 +145,11 @@ class StreamFormatter(Formatter):
         self.write(buffer, content)
         return buffer.getvalue()
 
+    def iter_dump(self, content):
+        # Pass on the output while write() is still running.
+        return iter_written(lambda stream: self.write(stream, content),
+                            binary=self.binary)
+
 
 class XMLMemoryFormatter(MemoryFormatter):
     '''
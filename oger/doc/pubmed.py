@@ -14,15 +14,38 @@ __all__ = ['MedlineLoader',
            'PXMLLoader', 'PXMLFetcher', 'PMCLoader', 'PMCFetcher']
 
 
+import re
+import time
 import gzip
+import shutil
 import logging
+import tempfile
+import threading
+import collections
 import itertools as it
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from urllib import request as url_request, parse as url_parse
 
 from lxml import etree
 
 from .document import Article, Entity
 from .load import _Loader, DocLoader, DocIterator, text_node
+from .store import DocumentStore
+from ..util.stream import CHUNK_SIZE
+
+
+# Efetch responses larger than this are buffered on disk.
+SPOOL_SIZE = 2**24
+
+# Number of Medline citations per parsing task.
+MEDLINE_SHARD_SIZE = 200
+
+_CITATION_START = re.compile(rb'<MedlineCitation[\s>]')
+_CITATION_END = b'</MedlineCitation>'
+
+# Parser of the Medline worker processes (set in the pool processes only).
+_medline_parser = None
 
 
 class _MedlineParser(_Loader):
@@ -30,34 +53,63 @@ class _MedlineParser(_Loader):
     Parser for PubMed abstracts in Medline's XML format.
     '''
     def _document(self, node, docid):
+        return self._build_article(*self._citation(node, docid))
+
+    def _citation(self, node, docid):
+        '''
+        Extract ID, metadata and sections of a citation.
+
+        The sections are <label, text, anno> triples, where
+        text is a str or a sequence of sentence strings.
+        '''
         # Get the PMID, if missing.
         if docid is None:
-            docid = text_node(node, './/PMID')
+            docid = self._get_docid(node)
 
-        article = Article(docid, tokenizer=self.config.text_processor)
         # Add metadata if they can be found.
-        article.year = text_node(node, './/DateCompleted/Year')
+        year = text_node(node, './/DateCompleted/Year')
         # There may be multiple publication types -- the first one is enough.
-        article.type_ = text_node(node, './/PublicationType')
+        type_ = text_node(node, './/PublicationType')
 
         # Title.
         title = ''.join(node.find('.//ArticleTitle').itertext())
-        article.add_section('Title', title + '\n')
+        sections = [('Title', title + '\n', None)]
 
         # Abstract body migt contain multiple sections, incl. a MeSH list.
-        sections = self._iter_sections(node)
+        body = self._iter_sections(node)
 
         if self.config.p.single_section:
-            sections = self._conflate_sections(sections)
+            body = self._conflate_sections(body)
+        sections.extend(body)
+
+        return docid, year, type_, sections
+
+    def _build_article(self, docid, year, type_, sections, spans=None):
+        '''
+        Create an Article from the parts of a citation.
 
+        If given, spans has the sentence boundaries of each
+        str section (relative to its text), so the sentences
+        need not be split again.
+        '''
+        article = Article(docid, tokenizer=self.config.text_processor)
+        article.year = year
+        article.type_ = type_
+
+        if spans is None:
+            spans = [None] * len(sections)
         anno_counter = it.count(1)
-        for label, text, anno in sections:
-            article.add_section(label, text)
-            if any(anno):
+        for (label, text, anno), sent_spans in zip(sections, spans):
+            article.add_section(label, text, spans=sent_spans)
+            if anno and any(anno):
                 self._insert_annotations(article[-1], anno, anno_counter)
 
         return article
 
+    @staticmethod
+    def _get_docid(node):
+        return text_node(node, './/PMID')
+
     def _conflate_sections(self, sections):
         '''
         Conflate the sections into one.
@@ -213,8 +265,12 @@ class _IterparseLoader:
     tag = None
 
     def _iterparse(self, stream):
-        for _, node in etree.iterparse(stream, tag=self.tag):
+        for node in self._iternodes(stream):
             yield self._document(node, None)
+
+    def _iternodes(self, stream):
+        for _, node in etree.iterparse(stream, tag=self.tag):
+            yield node
             node.clear()  # free memory
 
     def _document(self, node, docid):
@@ -233,17 +289,135 @@ class _NCBIFetcher(DocIterator, _IterparseLoader):
     def iter_documents(self, source):
         '''
         Iterate over documents from NCBI.
+
+        With a local store (efetch_store), only the documents
+        not found there are downloaded.  The documents are then
+        produced from the store, in the order of the given IDs.
         '''
-        docids = ','.join(source)
-        if not docids:
+        source = list(source)
+        if not source:
             raise ValueError('Empty document-ID list.')
-        query = url_parse.urlencode(dict(db=self.db, retmode='xml', id=docids))
-        logging.info(
-            "POST request to NCBI's efetch API with the query %r", query)
-        req = url_request.Request(self.url, data=query.encode('ascii'))
+        yield from self._parse(source, self._download(source, spool=False))
 
-        with url_request.urlopen(req) as f:
-            yield from self._iterparse(f)
+    def iter_prefetched(self, chunks):
+        '''
+        Iterate over pairs <IDs, documents> for chunks of IDs.
+
+        Up to efetch_workers chunks are downloaded concurrently
+        in the background, while the documents of the current
+        chunk are being processed.  The response of each request
+        is buffered (in memory, or in a temporary file if large),
+        and parsed when its turn comes.
+        '''
+        workers = self.config.p.efetch_workers
+        if workers <= 1:
+            for ids in chunks:
+                yield ids, self.iter_documents(ids)
+            return
+
+        chunks = iter(chunks)
+        pending = collections.deque()
+        with ThreadPoolExecutor(workers) as pool:
+            def fill():
+                for ids in it.islice(chunks, workers-len(pending)):
+                    pending.append((ids, pool.submit(self._download, ids)))
+            fill()
+            while pending:
+                ids, future = pending.popleft()
+                fill()  # keep the number of requests in flight
+                yield ids, self._parse_future(ids, future)
+
+    def _download(self, docids, spool=True):
+        '''
+        Get the documents for these IDs ready for parsing.
+
+        Return the local store (after adding any missing
+        documents), or a file-like object with the efetch
+        response, or None (offline mode).
+        '''
+        offline = self.config.p.efetch_offline
+        if self.config.p.efetch_store is None:
+            if offline:
+                logging.warning('Offline mode without efetch_store: '
+                                '%d documents not available', len(docids))
+                return None
+            response = self._request(docids)
+            if not spool:
+                return response
+            with response:
+                buffer = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+                shutil.copyfileobj(response, buffer)
+            buffer.seek(0)
+            return buffer
+
+        store = DocumentStore(self.config.p.efetch_store)
+        missing = [i for i in map(self._store_id, docids)
+                   if (self.db, i) not in store]
+        if missing and offline:
+            logging.warning('Offline mode: %d documents not in the store',
+                            len(missing))
+        elif missing:
+            with self._request(missing) as f:
+                for node in self._iternodes(f):
+                    try:
+                        store.put(self.db, self._get_docid(node),
+                                  etree.tostring(node, encoding='UTF-8'))
+                    except ValueError as e:
+                        logging.warning('Document not stored: %s', e)
+        return store
+
+    def _parse(self, docids, downloaded):
+        if isinstance(downloaded, DocumentStore):
+            for docid in map(self._store_id, docids):
+                data = downloaded.get(self.db, docid)
+                if data is not None:
+                    yield self._document(etree.fromstring(data), None)
+        elif downloaded is not None:
+            with downloaded:
+                yield from self._iterparse(downloaded)
+
+    def _parse_future(self, docids, future):
+        yield from self._parse(docids, future.result())
+
+    def _request(self, docids):
+        query = dict(db=self.db, retmode='xml', id=','.join(docids))
+        logging.info("POST request to NCBI's efetch API with the query %r",
+                     url_parse.urlencode(query))
+        if self.config.p.efetch_api_key is not None:
+            query['api_key'] = self.config.p.efetch_api_key
+        _limiter.wait(self.config.p.efetch_rate)
+        data = url_parse.urlencode(query).encode('ascii')
+        req = url_request.Request(self.url, data=data)
+        return url_request.urlopen(req)
+
+    @staticmethod
+    def _store_id(docid):
+        return docid
+
+
+class _RateLimiter:
+    '''
+    Space out requests to a maximum rate, across threads.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next = 0.  # earliest time for the next request
+
+    def wait(self, rate):
+        '''
+        Block until the next request is allowed.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + 1/rate
+        time.sleep(start - now)
+
+
+# NCBI's limits apply to all requests from the same host (or API key).
+# The limiter is per process: with parallel workers, the runner divides
+# efetch_rate among them.
+_limiter = _RateLimiter()
 
 
 class PXMLLoader(DocLoader, _MedlineParser):
@@ -271,6 +445,11 @@ class PMCFetcher(_NCBIFetcher, _PMCParser):
     db = 'pmc'
     tag = 'article'
 
+    @staticmethod
+    def _store_id(docid):
+        # Efetch accepts an optional prefix "PMC", which isn't in the XML.
+        return docid[3:] if docid.upper().startswith('PMC') else docid
+
 
 class PXMLFetcher(_NCBIFetcher, _MedlineParser):
     '''
@@ -292,5 +471,95 @@ class MedlineLoader(DocIterator, _MedlineParser, _IterparseLoader):
         '''
         Iterate over documents from a gzipped Medline collection.
         '''
+        n_workers = self.config.p.medline_workers
+        if n_workers > 1 and 'fork' not in mp.get_all_start_methods():
+            logging.warning('Parallel Medline parsing needs the fork '
+                            'start method: falling back to serial.')
+            n_workers = 1
+        if (n_workers > 1
+                and threading.current_thread() is not threading.main_thread()):
+            # Don't fork from a threaded process (eg. the pipeline loader
+            # thread or the REST server).
+            logging.info('Parsing Medline serially outside the main thread.')
+            n_workers = 1
         with gzip.open(source, 'rb') as f:
-            yield from self._iterparse(f)
+            if n_workers > 1:
+                yield from self._iterparse_parallel(f, n_workers)
+            else:
+                yield from self._iterparse(f)
+
+    def _iterparse_parallel(self, stream, n_workers):
+        '''
+        Parse shards of citations in a process pool, in order.
+
+        Decompression and cutting happen in this process;
+        the workers receive raw XML and send back plain
+        citation records with sentence spans, from which the
+        articles are built here (without splitting again).
+        '''
+        pending = collections.deque()
+        with ProcessPoolExecutor(n_workers, mp.get_context('fork'),
+                                 initializer=_init_medline_parser,
+                                 initargs=(self,)) as pool:
+            for shard in _citation_shards(stream, MEDLINE_SHARD_SIZE):
+                pending.append(pool.submit(_parse_citations, shard))
+                while pending and (len(pending) > 2*n_workers
+                                   or pending[0].done()):
+                    for record in pending.popleft().result():
+                        yield self._build_article(*record)
+            while pending:
+                for record in pending.popleft().result():
+                    yield self._build_article(*record)
+
+
+def _citation_shards(stream, size):
+    '''
+    Cut the raw XML of a Medline file into shards of citations.
+
+    Each shard is a byte string with up to `size` consecutive
+    MedlineCitation elements.
+    '''
+    buffer, shard = b'', []
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        buffer += chunk
+        pos = 0
+        while True:
+            start = _CITATION_START.search(buffer, pos)
+            if start is None:
+                break
+            end = buffer.find(_CITATION_END, start.end())
+            if end == -1:
+                break
+            pos = end + len(_CITATION_END)
+            shard.append(buffer[start.start():pos])
+            if len(shard) == size:
+                yield b''.join(shard)
+                shard = []
+        buffer = buffer[pos:]  # keep an incomplete citation
+    if shard:
+        yield b''.join(shard)
+
+
+def _init_medline_parser(parser):
+    global _medline_parser
+    _medline_parser = parser
+
+
+def _parse_citations(shard):
+    '''
+    Parse a shard of citations (in a worker process).
+
+    Return a list of citation records (see _citation()),
+    each extended with the sentence spans of its sections.
+    '''
+    root = etree.fromstring(b'<MedlineCitationSet>%s</MedlineCitationSet>'
+                            % shard)
+    split = _medline_parser.config.text_processor.span_tokenize_sentences
+    records = []
+    for node in root.iterfind('MedlineCitation'):
+        *record, sections = _medline_parser._citation(node, None)
+        spans = [[(start, end) for _, start, end in split(text)]
+                 if isinstance(text, str) else None
+                 for _, text, _ in sections]
+        records.append((*record, sections, spans))
+    return records
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Local store for downloaded documents.
+
+The serialised documents are content-addressed: each one
+is saved once (gzip-compressed) under its SHA-1 hash.
+A small reference file per database and document ID points
+to the hash.  Writing is atomic, so concurrent processes can
+share a store.
+'''
+
+
+import os
+import re
+import gzip
+import hashlib
+import threading
+
+
+class DocumentStore:
+    '''
+    Directory of documents, indexed by database and ID.
+    '''
+    _valid_id = re.compile(r'\w[\w.-]*$')  # no '.' or '..'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, db, docid):
+        '''
+        Get the serialised document, or None if it isn't stored.
+        '''
+        try:
+            with open(self._ref_path(db, docid), encoding='ascii') as f:
+                digest = f.read().strip()
+            with gzip.open(self._object_path(digest), 'rb') as f:
+                return f.read()
+        except (OSError, EOFError, ValueError):
+            return None
+
+    def __contains__(self, key):
+        db, docid = key
+        try:
+            return os.path.exists(self._ref_path(db, docid))
+        except ValueError:
+            return False
+
+    def put(self, db, docid, data):
+        '''
+        Save a serialised document (bytes).
+        '''
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write(path, gzip.compress(data))
+        self._write(self._ref_path(db, docid), digest.encode('ascii'))
+
+    def _ref_path(self, db, docid):
+        if not all(isinstance(x, str) and self._valid_id.match(x)
+                   for x in (db, docid)):
+            raise ValueError('invalid document ID: {!r}'.format(docid))
+        # Spread the references over subdirectories.
+        return os.path.join(self.directory, db, docid[-3:], docid)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2],
+                            digest + '.gz')
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
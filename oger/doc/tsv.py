@@ -62,6 +62,7 @@ class TSVFormatter(StreamFormatter):
         # For each token, find all recognized entities starting here.
         # Write a fully-fledged TSV line for each entity.
         # In the text-tsv subclass, also add sparse lines for non-entity tokens.
+        table = article.entity_table
         for i, sentence in enumerate(article.get_subelements(Sentence), 1):
             # Use an ad-hoc counter for continuous sentence IDs.
             sent_id = 'S{}'.format(i)
@@ -70,25 +71,35 @@ class TSVFormatter(StreamFormatter):
             section_type = sentence.get_section_type(default='')
             last_end = 0  # offset history
 
-            for entity in sentence.iter_entities():
+            if table is None:
+                entities = ((e.start, e.end, e.text_wn, e.type, e.pref,
+                             e.cid, e.db, e.cui, e.extra)
+                            for e in sentence.iter_entities())
+            else:
+                entities = ((table.start[r], table.end[r],
+                             table.text_wn(r, sentence), table.type(r),
+                             table.pref(r), table.cid(r), table.db(r),
+                             table.cui(r), table.extra(r))
+                            for r in table.rows(i-1))
+            for start, end, text, type_, pref, cid, db, cui, extra in entities:
                 # Add sparse lines for all tokens preceding the current entity.
                 writer.writerows(
-                    self._tok_rows(last_end, entity.start, toks, ids))
+                    self._tok_rows(last_end, start, toks, ids))
                 # Add a rich line for each entity (possibly multiple lines
                 # for the same token(s)).
                 writer.writerow((article.id_,
-                                 entity.type,
-                                 entity.start,
-                                 entity.end,
-                                 entity.text_wn,
-                                 entity.pref,
-                                 entity.cid,
+                                 type_,
+                                 start,
+                                 end,
+                                 text,
+                                 pref,
+                                 cid,
                                  section_type,
                                  sent_id,
-                                 entity.db,
-                                 entity.cui)
-                                + entity.extra)
-                last_end = max(last_end, entity.end)
+                                 db,
+                                 cui)
+                                + tuple(extra))
+                last_end = max(last_end, end)
             # Add sparse lines for the remaining tokens.
             writer.writerows(self._tok_rows(last_end, float('inf'), toks, ids))
 
@@ -9,7 +9,8 @@ Loader for plain-text input.
 '''
 
 
-__all__ = ['TXTLoader', 'TXTJSONLoader', 'TXTTarLoader', 'TXTTSVLoader']
+__all__ = ['TXTLoader', 'TXTJSONLoader', 'TXTJSONLinesLoader', 'TXTTarLoader',
+           'TXTTSVLoader']
 
 
 import io
@@ -124,6 +125,22 @@ class TXTJSONLoader(DocIterator, _TXTLoaderMixin):
             yield self._document(stream, id_)
 
 
+class TXTJSONLinesLoader(DocIterator, _TXTLoaderMixin):
+    '''
+    Loader for plain-text documents in JSON lines.
+
+    Each non-blank line is a JSON object with "id" and "text".
+    The input is read incrementally.
+    '''
+    def iter_documents(self, source):
+        with text_stream(source) as f:
+            for line in f:
+                if line.strip():
+                    doc = json.loads(line)
+                    stream = io.StringIO(doc['text'])
+                    yield self._document(stream, doc['id'])
+
+
 class TXTTarLoader(DocIterator, _TXTLoaderMixin):
     '''
     Loader for multiple  plain-text documents in a TAR archive.
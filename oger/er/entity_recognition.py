@@ -10,16 +10,30 @@ Entity Recognition core.
 '''
 
 
+import io
 import re
 import csv
+import time
 import pickle
+import hashlib
 import os.path
+import weakref
 import logging
+import threading
+import multiprocessing as mp
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from ..ctrl import parameters
 from ..nlp.tokenize import Text_processing
 from ..util import misc, stream
 from . import term_normalization as normalization
+from .term_index import TermIndex, write_index
+from .term_store import compact_terms
+from .term_trie import TokenTrie, END as TRIE_END
+from .term_registry import termlists
+from .term_delta import TermDelta, parse_diff
 
 
 DEFAULT_TOKEN = (
@@ -29,6 +43,21 @@ DEFAULT_TOKEN = (
     r'\d+|[^\W\d_]+|[()]'
 )
 
+# Regex engine for the default term tokens: use the same as NLTK's
+# RegexpTokenizer, since re and regex differ for some characters
+# (eg. superscript digits and combining marks).
+try:
+    from nltk import redos as _nltk_redos
+    import regex as token_re
+except ImportError:  # older NLTK versions use re
+    token_re = re
+else:
+    del _nltk_redos  # imported only to probe the NLTK version
+
+# Parallel termlist compilation: lines per shard, seconds between log lines.
+BUILD_SHARD_SIZE = 20000
+PROGRESS_INTERVAL = 10
+
 
 class EntityRecognizer(object):
     """
@@ -55,13 +84,151 @@ class EntityRecognizer(object):
         automatically for faster (up to 20 times)
         loading in subsequent calls.
 
+        With `cache_format` "mmap", a compiled index (extension
+        ".index") is used instead of a pickle. It is opened
+        through mmap and queried lazily, which makes startup
+        nearly instant and lets processes share memory.
+        With `compact`, the in-memory (and pickled) tables
+        store the entry fields in interned column tables.
+
         `stopwords` is either an iterable of stopwords
         or a path to a list of stopwords (one per line).
+
+        `normalize_cache` is the size of an LRU cache for the
+        normalized form of tokens (0 to disable).
+
+        `engine` selects the method for finding candidate
+        spans: "hash" probes the first-token table for each
+        term length, "trie" walks a token-level prefix tree.
+
+        Entity recognizers with the same termlist settings
+        share the loaded tables (see term_registry).
+
+        `delta` lists diff files with changes to the termlist,
+        which are applied to the cached tables (see term_delta).
         """
         self.tokenizer = Text_processing(self._tokenizer_spec(config), None)
+        self._token_pattern = self._fast_token_pattern(config)
         self._normalizers = normalization.load(config.normalize)
+        self._normalize = self._cascade(self._normalizers,
+                                        config.normalize_cache)
         self.stopwords = self.import_stopwords(config.stopwords)
-        self.term_first, self.full_terms = self.load_termlist(config, **kwargs)
+        self._fields = config.field_format, 5 + config.n_extra
+        self._termlist = None
+        self._release = None
+        if kwargs.get('skip_loading') or config.path is None:
+            terms = self.load_termlist(config, **kwargs)
+        else:
+            self._termlist = termlists.acquire(
+                self._termlist_key(config),
+                lambda: self.load_termlist(config, **kwargs),
+                reload=config.force_reload)
+            self._release = weakref.finalize(self, termlists.release,
+                                             self._termlist)
+            terms = self._termlist.term_first, self._termlist.full_terms
+        self.term_first, self.full_terms = terms
+        self._cache_file = self._cache_path(config)
+        self.trie = None
+        self._spans = self._load_engine(config.engine)
+
+    def _load_engine(self, name):
+        '''
+        Select the span-candidate method and set up its data structure.
+        '''
+        try:
+            spans = getattr(self, '_spans_{}'.format(name))
+        except AttributeError:
+            logging.error('No such matching engine: %s', name)
+            raise ValueError('Invalid matching engine')
+        if name == 'trie' and self._termlist is not None:
+            self.trie = self._termlist.get_trie(self._trie_paths)
+        return spans
+
+    def _termlist_key(self, config):
+        '''
+        Settings which determine the content of the term tables.
+        '''
+        stopwords = config.stopwords
+        if not isinstance(stopwords, (str, type(None))):
+            stopwords = tuple(stopwords)
+        cache = config.cache or os.path.dirname(config.path)
+        return (os.path.abspath(config.path), config.field_format,
+                config.skip_header, config.n_extra,
+                os.path.abspath(cache), config.cache_format, config.compact,
+                self._tokenizer_spec(config), tuple(config.normalize),
+                stopwords, tuple(map(os.path.abspath, config.delta)))
+
+    def close(self):
+        '''
+        Stop using the shared termlist.
+
+        The tables remain usable for any ongoing recognition;
+        they are freed once this object is gone, unless other
+        entity recognizers use them as well.
+        '''
+        if self._release is not None:
+            self._release()
+
+    @property
+    def termlist(self):
+        '''The shared termlist (None if not from the registry).'''
+        return self._termlist
+
+    @property
+    def fingerprint(self):
+        '''
+        Token for the state of the termlist.
+
+        It changes when the cached termlist is rebuilt or
+        updated with a delta file, and when the loaded
+        termlist is patched.
+        '''
+        state = [None if self._termlist is None else self._termlist.revision]
+        for path in (self._cache_file, self._cache_file + '.deltas'):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                state.append(None)
+            else:
+                state.append((stat.st_mtime_ns, stat.st_size))
+        return tuple(state)
+
+    @property
+    def delta(self):
+        '''Changes made to the loaded termlist (or None).'''
+        if self._termlist is None:
+            return None
+        return self._termlist.delta
+
+    def update_terms(self, added, removed=()):
+        '''
+        Add and remove termlist records in the loaded termlist.
+
+        The records are TSV lines in the same format as the
+        termlist.  The change affects all entity recognizers
+        sharing this termlist; the cached termlist on disk is
+        not changed (use the `delta` setting for that).
+        Return the number of changed terms.
+        '''
+        if self._termlist is None:
+            raise ValueError('termlist cannot be updated')
+        added = self._compile_records(added)
+        removed = self._compile_records(removed)
+        self._termlist.patch(added, removed)
+        return len({term for _, term, _ in added + removed})
+
+    def _trie_paths(self):
+        '''
+        Iterate over the normalized token sequences of all terms.
+        '''
+        for key in self.full_terms:
+            yield key
+            if self.stopwords:
+                # Stopword terms are keyed by their exact form,
+                # but the lookup path is made of normalized tokens.
+                norm = self.normalize(key)
+                if norm != key and norm in self.stopwords:
+                    yield norm
 
     @classmethod
     def ensure_cache(cls, *args, **kwargs):
@@ -82,6 +249,41 @@ class EntityRecognizer(object):
             token = config.term_token or DEFAULT_TOKEN[config.abbrev_detection]
             return 'RegexpTokenizer({})'.format(repr(token))
 
+    @staticmethod
+    def _fast_token_pattern(config):
+        '''
+        Compile the default token pattern for direct use.
+
+        With a custom tokenizer or token pattern, return None.
+        '''
+        if config.term_tokenizer or config.term_token:
+            return None
+        flags = token_re.UNICODE | token_re.MULTILINE | token_re.DOTALL
+        return token_re.compile(DEFAULT_TOKEN[config.abbrev_detection], flags)
+
+    def tokenize(self, text):
+        '''
+        Tokenize text into a tuple of term tokens.
+        '''
+        if self._token_pattern is not None:
+            return tuple(self._token_pattern.findall(text))
+        return tuple(self.tokenizer.tokenize_words(text))
+
+    def span_tokenize(self, text):
+        '''
+        Tokenize text into parallel sequences <toks, starts, ends>.
+
+        The default token pattern is matched directly, bypassing
+        the generator layers of the NLTK tokenizer.
+        '''
+        if self._token_pattern is not None:
+            matches = list(self._token_pattern.finditer(text))
+            return (tuple(m.group() for m in matches),
+                    [m.start() for m in matches],
+                    [m.end() for m in matches])
+        spans = tuple(zip(*self.tokenizer.span_tokenize_words(text)))
+        return spans or ((), (), ())
+
     def import_stopwords(self, stopwords):
         '''
         Resolve the different ways the stopwords are provided.
@@ -93,12 +295,15 @@ class EntityRecognizer(object):
         # Any False-equivalent value is interpreted as no stopwords.
         stopwords = stopwords or []
         # The stopwords are saved and looked up in normalized form.
-        return frozenset(self.normalize(self.tokenizer.tokenize_words(w))
+        return frozenset(self.normalize(self.tokenize(w))
                          for w in stopwords)
 
+    # File extensions of the cached termlist formats.
+    _cache_ext = {'pickle': '.pickle', 'mmap': '.index'}
+
     def load_termlist(self, config, skip_loading=False):
         '''
-        Check for a pickle, or else create one.
+        Check for a pickle (or index), or else create one.
 
         After reading the term list into a dictionary,
         it has the following internal structure:
@@ -119,32 +324,130 @@ class EntityRecognizer(object):
             raise ValueError('no termlist specified')
         if config.cache is None:
             config.cache = os.path.dirname(config.path)
-        basename = os.path.basename(config.path)
-        pickle_file = os.path.join(config.cache, basename + '.pickle')
+        if config.cache_format not in self._cache_ext:
+            logging.error('No such termlist cache format: %s',
+                          config.cache_format)
+            raise ValueError('Invalid termlist cache format')
+        loader = getattr(self, 'load_termlist_from_' + config.cache_format)
+        writer = getattr(self, 'write_terms_to_' + config.cache_format)
+        cache_file = self._cache_path(config)
         n_fields = 5 + config.n_extra  # 5 std fields besides the term
-        if os.path.exists(pickle_file) and not config.force_reload:
-            if skip_loading:
+        deltas = self._read_deltas(config.delta)
+        if os.path.exists(cache_file) and not config.force_reload:
+            applied = self._applied_deltas(cache_file)
+            deltas = [d for d in deltas if d[0] not in applied]
+            if skip_loading and not deltas:
                 # Optimisation feature:
                 # Only check for a pickle, but don't load it.
-                terms = None, None
-            else:
-                terms = self.load_termlist_from_pickle(pickle_file, n_fields)
+                return None, None
+            terms = loader(cache_file, n_fields)
+            if not deltas:
+                return self._compact(config, terms, n_fields)
+            # Unpack the tables for applying the changes.
+            terms = tuple(t if isinstance(t, dict) else dict(t.items())
+                          for t in terms)
 
         # Load the termlist from file.
         else:
-            try:
-                parser = getattr(
-                    self, 'termlist_format_{}'.format(config.field_format))
-            except AttributeError:
-                logging.error('No such termlist format: %s',
-                              config.field_format)
-                raise ValueError('Invalid termlist format')
+            applied = []
+            parser = self._field_parser(config.field_format)
             terms = self.load_termlist_from_file(config, parser, n_fields)
-            try:
-                self.write_terms_to_pickle(terms, pickle_file)
-            except OSError as e:
-                logging.warning('Cannot write termlist pickle: %s (%r)',
-                                pickle_file, e)
+
+        for digest, lines in deltas:
+            logging.info('Applying termlist delta %s', digest[:8])
+            added, removed = (self._compile_records(l)
+                              for l in parse_diff(lines))
+            delta = TermDelta().update(added, removed,
+                                       terms[0].get, terms[1].get)
+            delta.apply(*terms)
+            applied.append(digest)
+        terms = self._compact(config, terms, n_fields)
+        try:
+            writer(terms, cache_file, n_fields)
+            self._record_deltas(cache_file, applied)
+        except OSError as e:
+            logging.warning('Cannot write termlist cache: %s (%r)',
+                            cache_file, e)
+        else:
+            if config.cache_format == 'mmap' and not skip_loading:
+                # Release the in-memory tables in favour of the index.
+                terms = loader(cache_file, n_fields)
+        return terms
+
+    @classmethod
+    def _cache_path(cls, config):
+        '''
+        Path of the cached termlist.
+        '''
+        basename = os.path.basename(config.path)
+        cache = config.cache or os.path.dirname(config.path)
+        ext = cls._cache_ext[config.cache_format]
+        return os.path.join(cache, basename + ext)
+
+    def _field_parser(self, field_format):
+        try:
+            return getattr(self, 'termlist_format_{}'.format(field_format))
+        except AttributeError:
+            logging.error('No such termlist format: %s', field_format)
+            raise ValueError('Invalid termlist format')
+
+    def _compile_records(self, lines):
+        '''
+        Compile termlist lines into triples <norm, term, entry>.
+        '''
+        field_format, n_fields = self._fields
+        parser = self._field_parser(field_format)
+        records = list(self._compile_lines(lines, parser, n_fields, False))
+        for line_no, (_, _, entry) in enumerate(records, 1):
+            if len(entry) != n_fields:
+                logging.error('Record %d: Wrong field count: %d (expected %d)',
+                              line_no, len(entry)+1, n_fields+1)
+                raise ValueError('Unexpected number of TSV fields')
+        return records
+
+    @staticmethod
+    def _read_deltas(paths):
+        '''
+        Read diff files into pairs <digest, lines>.
+        '''
+        deltas = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            lines = data.decode('utf-8').splitlines(keepends=True)
+            deltas.append((digest, lines))
+        return deltas
+
+    @staticmethod
+    def _applied_deltas(cache_file):
+        '''
+        Digests of the deltas applied to this cached termlist.
+        '''
+        try:
+            with open(cache_file + '.deltas', encoding='ascii') as f:
+                return f.read().split()
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _record_deltas(cache_file, digests):
+        path = cache_file + '.deltas'
+        if digests:
+            with open(path, 'w', encoding='ascii') as f:
+                f.write(''.join(d + '\n' for d in digests))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    @staticmethod
+    def _compact(config, terms, n_fields):
+        '''
+        Convert dict-based tables to the compact form, if requested.
+        '''
+        if (config.compact and config.cache_format != 'mmap'
+                and isinstance(terms[1], dict)):
+            logging.info('Compacting termlist entries...')
+            terms = compact_terms(*terms, n_fields)
         return terms
 
     @staticmethod
@@ -184,10 +487,28 @@ class EntityRecognizer(object):
         return term_first, full_terms
 
     @staticmethod
-    def write_terms_to_pickle(terms, filename):
+    def load_termlist_from_mmap(index_path, n_exp):
+        '''
+        Open a compiled index through mmap (no unpickling).
+        '''
+        logging.info('Opening term index %s', index_path)
+        index = TermIndex(index_path)
+        if index.n_fields != n_exp:
+            logging.error(
+                'Term index with wrong number of fields: '
+                'expected %d, found %d\n  '
+                'Index file: %s\n  '
+                'Delete the index file or run with force_reload=True.',
+                n_exp, index.n_fields, index_path)
+            raise ValueError('Term index with unexpected field count')
+        return index.terms
+
+    @staticmethod
+    def write_terms_to_pickle(terms, filename, n_fields=None):
         '''
         Dump everything to disk.
         '''
+        del n_fields  # the pickle format doesn't need it
         if filename.startswith(stream.REMOTE_PROTOCOLS):
             raise OSError('Cannot write pickle to remote location')
 
@@ -198,6 +519,17 @@ class EntityRecognizer(object):
 
         logging.info('Terms written to pickle at %s', filename)
 
+    @staticmethod
+    def write_terms_to_mmap(terms, filename, n_fields):
+        '''
+        Compile the terms into an index for memory-mapped access.
+        '''
+        if filename.startswith(stream.REMOTE_PROTOCOLS):
+            raise OSError('Cannot write index to remote location')
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        write_index(terms, filename, n_fields)
+
     def load_termlist_from_file(self, config, field_parser, n_fields):
         """
         Index the term DB.
@@ -205,24 +537,26 @@ class EntityRecognizer(object):
         The terms are indexed by the first token of the term
         expression.
         These keys point to a list of entries.
+
+        With `build_workers` > 1, tokenization and normalization
+        are distributed over a process pool in shards of lines.
+        The results are merged in file order, so the tables are
+        the same as with serial processing.
         """
 
         logging.info("Loading terms from file %s", config.path)
         term_first, full_terms = {}, {}
-        entry = ('',) * n_fields
 
         with stream.ropen(config.path, encoding='utf-8', newline='') as tsv:
-            reader = csv.reader(tsv, escapechar='\\', **misc.tsv_format)
-            if config.skip_header:
-                next(reader)
-            for line_no, line in enumerate(reader, 1+config.skip_header):
-                term, std, extra = field_parser(line)
-
-                # Apply text processing to the surface term.
-                toks = tuple(self.tokenizer.tokenize_words(term))
-                norm = self.normalize(toks)
-                term = self.em_filter(norm, toks, None, None)
-
+            if config.build_workers > 1:
+                compiled = self._compile_parallel(
+                    tsv, field_parser, n_fields, config.skip_header,
+                    config.build_workers)
+            else:
+                compiled = self._compile_lines(
+                    tsv, field_parser, n_fields, config.skip_header)
+            for line_no, (norm, term, entry) in enumerate(
+                    compiled, 1+config.skip_header):
                 try:
                     term_first[norm[0]].add(len(term))
                 except KeyError:
@@ -231,19 +565,19 @@ class EntityRecognizer(object):
                     logging.warning(
                         "Skipping line %d: empty term field", line_no)
 
-                entry = self._cached_entry(entry, std + extra)
                 if len(entry) != n_fields:
                     logging.error(
                         'Line %d: Wrong field count: %d (expected %d)',
                         line_no, len(entry)+1, n_fields+1)
                     raise ValueError('Unexpected number of TSV fields')
 
+                # Dicts as ordered sets: keep the entries in file order.
                 try:
-                    full_terms[term].add(entry)
+                    full_terms[term][entry] = None
                 except KeyError:
-                    full_terms[term] = set([entry])
+                    full_terms[term] = {entry: None}
 
-        # For memory reasons, replace the sets with tuples.
+        # For memory reasons, replace the sets and dicts with tuples.
         for k, v in term_first.items():
             # Sort the length indicators, so that we can stop early
             # when reaching the end of a sentence.
@@ -254,6 +588,77 @@ class EntityRecognizer(object):
         logging.info("Finished loading termlist.")
         return term_first, full_terms
 
+    def _compile_lines(self, tsv, field_parser, n_fields, skip_header):
+        '''
+        Iterate over <norm, term, fields> for the records of a TSV.
+        '''
+        reader = csv.reader(tsv, escapechar='\\', **misc.tsv_format)
+        if skip_header:
+            next(reader)
+        entry = ('',) * n_fields
+        for line in reader:
+            term, std, extra = field_parser(line)
+
+            # Apply text processing to the surface term.
+            toks = self.tokenize(term)
+            norm = self.normalize(toks)
+            term = self.em_filter(norm, toks, None, None)
+            # Share repeated field values with the previous entry.
+            entry = self._cached_entry(entry, std + extra)
+            yield norm, term, entry
+
+    def _compile_parallel(self, tsv, field_parser, n_fields, skip_header,
+                          n_workers):
+        '''
+        Compile shards of the TSV in a process pool, in order.
+        '''
+        if 'fork' not in mp.get_all_start_methods():
+            logging.warning('Parallel termlist compilation needs the fork '
+                            'start method: falling back to serial.')
+            yield from self._compile_lines(tsv, field_parser, n_fields,
+                                           skip_header)
+            return
+        if threading.current_thread() is not threading.main_thread():
+            # Don't fork from a threaded process (eg. the REST server).
+            logging.info('Compiling termlist serially outside the main '
+                         'thread.')
+            yield from self._compile_lines(tsv, field_parser, n_fields,
+                                           skip_header)
+            return
+
+        logging.info('Compiling termlist with %d processes...', n_workers)
+        if skip_header:
+            next(tsv)
+        start = last_report = time.time()
+        done = 0
+        shards = self._iter_shards(tsv, field_parser, n_fields, n_workers)
+        for compiled in shards:
+            yield from compiled
+            done += len(compiled)
+            if time.time() - last_report > PROGRESS_INTERVAL:
+                last_report = time.time()
+                logging.info('Compiled %d lines (%.0f lines/s)',
+                             done, done/(last_report-start))
+
+    def _iter_shards(self, tsv, field_parser, n_fields, n_workers):
+        '''
+        Iterate over the compiled shards, keeping the pool busy.
+
+        The workers receive raw text, which is much cheaper to
+        pickle than parsed records.
+        '''
+        pending = deque()
+        with ProcessPoolExecutor(n_workers, mp.get_context('fork'),
+                                 initializer=_init_compiler,
+                                 initargs=(self, field_parser, n_fields)
+                                 ) as pool:
+            for shard in _text_shards(tsv, BUILD_SHARD_SIZE):
+                pending.append(pool.submit(_compile_shard, shard))
+                if len(pending) > 2*n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     @staticmethod
     def termlist_format_4(fields):
         '''
@@ -296,13 +701,23 @@ class EntityRecognizer(object):
     def _cached_entry(previous, new):
         return tuple(p if p == n else n for p, n in zip(previous, new))
 
-    def _normalize(self, token):
+    @staticmethod
+    def _cascade(normalizers, cache_size=0):
         '''
-        Call all normalizer functions in a cascade.
+        Create a function calling all normalizers in a cascade.
+
+        The (optional) LRU cache wraps a closure rather than a
+        bound method: a cache stored on the instance would hold
+        a reference to the instance itself, which delays freeing
+        it (and releasing its termlist) until garbage collection.
         '''
-        for n in self._normalizers:
-            token = n(token)
-        return token
+        def normalize(token):
+            for n in normalizers:
+                token = n(token)
+            return token
+        if cache_size:
+            normalize = lru_cache(cache_size)(normalize)
+        return normalize
 
     def normalize(self, tokens):
         '''
@@ -310,6 +725,15 @@ class EntityRecognizer(object):
         '''
         return tuple(self._normalize(t) for t in tokens)
 
+    def normalize_cache_info(self):
+        '''
+        Hit/miss statistics of the normalization cache (or None).
+        '''
+        try:
+            return self._normalize.cache_info()
+        except AttributeError:
+            return None
+
     def em_filter(self, norm, exact, start, stop):
         '''
         Enforce exact match for stopwords.
@@ -339,29 +763,110 @@ class EntityRecognizer(object):
             If additional fields were defined in the constructor,
             the tuples are extended appropriately.
         """
-        span_toks = zip(*self.tokenizer.span_tokenize_words(sentence))
-        try:
-            toks, starts, ends = span_toks
-        except ValueError:
+        toks, starts, ends = self.span_tokenize(sentence)
+        if not toks:
             # No tokens in this sentence: exit early.
             return
         normalized = self.normalize(toks)
+        get_entries = self._entry_getter()
+        for i, j in self._spans(normalized):
+            candidate = self.em_filter(normalized, toks, i, j)
+            matches = get_entries(candidate)
+            if matches:
+                position = (starts[i], ends[j-1])
+                for entry in matches:
+                    yield position, entry
+                self._match_hook(matches,
+                                 sentence, toks, normalized,
+                                 position, i, j)
+
+    def _spans_hash(self, normalized):
+        '''
+        Iterate over candidate spans <i, j> using the first-token table.
+        '''
+        get_lengths = self._first_token_getter()
         for i, word in enumerate(normalized):
             # There might be multiple entries for the first token in terms:
-            for ntoks in self.term_first.get(word, ()):
+            for ntoks in get_lengths(word, ()):
                 j = i+ntoks
                 if j > len(normalized):
                     # Not enough tokens remaining: Exit the inner loop early.
                     break
-                candidate = self.em_filter(normalized, toks, i, j)
-                if candidate in self.full_terms:
-                    position = (starts[i], ends[j-1])
-                    matches = self.full_terms[candidate]
-                    for entry in matches:
-                        yield position, entry
-                    self._match_hook(matches,
-                                     sentence, toks, normalized,
-                                     position, i, j)
+                yield i, j
+
+    def _spans_trie(self, normalized):
+        '''
+        Iterate over candidate spans <i, j> using the token trie.
+        '''
+        extra = self._extra_tries()
+        if extra:
+            yield from self._spans_tries(normalized, [self.trie] + extra)
+            return
+        # Walk the trie inline (this avoids a generator per token).
+        root = self.trie.root
+        n = len(normalized)
+        for i in range(n):
+            node = root
+            for j in range(i, n):
+                node = node.get(normalized[j])
+                if node is None:
+                    break
+                if TRIE_END in node:
+                    yield i, j+1
+
+    @staticmethod
+    def _spans_tries(normalized, tries):
+        '''
+        Iterate over candidate spans found in any of the tries.
+
+        Empty tries are skipped, but they may grow while the
+        sentence is processed.
+        '''
+        for i in range(len(normalized)):
+            ends = set()
+            for trie in tries:
+                if trie:
+                    ends.update(trie.iter_ends(normalized, i))
+            for j in sorted(ends):
+                yield i, j
+
+    def _extra_tries(self):
+        'Tries with paths not in the termlist trie.'
+        delta = self.delta
+        if delta is None or not delta.trie:
+            return []
+        return [delta.trie]
+
+    def _entry_getter(self):
+        'Get a lookup function for the full-term table.'
+        delta = self.delta
+        if delta is None:
+            return self.full_terms.get
+        return self._lookup_chain(delta.full_terms, self.full_terms.get)
+
+    def _first_token_getter(self):
+        'Get a lookup function for the first-token table.'
+        delta = self.delta
+        if delta is None:
+            return self.term_first.get
+        return self._lookup_chain(delta.term_first, self.term_first.get)
+
+    @staticmethod
+    def _lookup_chain(overlay, get_base):
+        '''
+        Create a lookup function: overlay first, then base.
+
+        The overlay is consulted at each call, since it may
+        grow while a sentence is processed.
+        '''
+        def get(key, default=None):
+            if overlay:
+                try:
+                    return overlay[key]
+                except KeyError:
+                    pass
+            return get_base(key, default)
+        return get
 
     # Some placeholder methods used in subclasses.
 
@@ -377,11 +882,26 @@ class EntityRecognizer(object):
 class AbbrevDetector(EntityRecognizer):
     '''
     Entity recognizer capable of learning new abbreviations.
+
+    The abbreviations of a document are kept in an overlay,
+    which is consulted before the termlist tables.  The
+    tables themselves are never modified, so they can be
+    shared between threads and forked processes.
+    Each thread has its own overlay, which is replaced
+    with a fresh one by reset().
     '''
     def __init__(self, *args, **kwargs):
+        self._overlays = threading.local()  # needed during loading already
         super().__init__(*args, **kwargs)
-        self.abbrevs = {}
-        self.stopwords = set(self.stopwords)  # make this mutable again
+
+    @property
+    def overlay(self):
+        '''The abbreviations of the current document (and thread).'''
+        try:
+            return self._overlays.current
+        except AttributeError:
+            self._overlays.current = overlay = AbbrevOverlay()
+            return overlay
 
     def _match_hook(self, *args):
         '''
@@ -393,78 +913,72 @@ class AbbrevDetector(EntityRecognizer):
 
     def register_abbrev(self, toks, norm, entries):
         '''
-        Add an abbrev to the hash tables and keep track of the changes.
+        Add an abbrev to the overlay tables.
         '''
-        mod_stopword, mod_first, mod_full = None, None, None
+        overlay = self.overlay
 
         # Enforce an exact match for abbreviations.
         if norm not in self.stopwords:
-            mod_stopword = norm
-            self.stopwords.add(norm)
+            overlay.stopwords.add(norm)
 
-        # Update the hash tables. There are 3 cases:
-        # (1) unchanged, (2) new entry, (3) extend existing entry.
+        # Update the overlay tables with the merged values.
         # First-token hash:
-        try:
-            backup = self.term_first[norm[0]]
-        except KeyError:
-            # Case 2.
-            mod_first = 'pop'
-            self.term_first[norm[0]] = (len(toks),)
-        else:
-            if len(toks) not in backup:
-                # Case 3.
-                mod_first = backup
-                self.term_first[norm[0]] = tuple(sorted((len(toks),) + backup))
+        lengths = self._first_token_getter()(norm[0], ())
+        if len(toks) not in lengths:
+            overlay.term_first[norm[0]] = tuple(sorted((len(toks),) + lengths))
         # Full-term hash:
-        try:
-            backup = self.full_terms[toks]
-        except KeyError:
-            # Case 2.
-            mod_full = 'pop'
-            self.full_terms[toks] = entries
+        backup = self._entry_getter()(toks)
+        if backup is None:
+            overlay.full_terms[toks] = entries
         else:
             union = set(backup).union(entries)
             if len(union) > len(backup):
-                # Case 3.
-                mod_full = backup
-                self.full_terms[toks] = tuple(union)
+                overlay.full_terms[toks] = tuple(union)
+        # Trie (if used):
+        if self.trie is not None:
+            overlay.trie.add(norm)
 
-        # Register the changes.
-        self.update_registry(toks, mod_stopword, mod_first, mod_full)
+    def clear_abbrev_cache(self):
+        'Start with an empty overlay for a new document.'
+        self._overlays.current = AbbrevOverlay()
 
-    def update_registry(self, toks, stpw, first, full):
+    def em_filter(self, norm, exact, start, stop):
         '''
-        Merge the new change signature with any previous.
+        Enforce exact match for stopwords and abbreviations.
         '''
-        if toks in self.abbrevs:
-            p_stpw, p_first, p_full = self.abbrevs[toks]
-            stpw = p_stpw or stpw
-            first = p_first or first
-            full = p_full or full
-        self.abbrevs[toks] = (stpw, first, full)
+        norm = norm[start:stop]
+        if norm in self.stopwords or norm in self.overlay.stopwords:
+            return exact[start:stop]
+        return norm
 
-    def clear_abbrev_cache(self):
-        'Reset the hash tables for a new document.'
-        for toks, (mod_stopword, mod_first, mod_full) in self.abbrevs.items():
-            # Undo all the modifications from .register_abbrev().
-            if mod_stopword:
-                self.stopwords.remove(mod_stopword)
-            if mod_first == 'pop':
-                self.term_first.pop(toks[0], None)
-            elif mod_first:
-                self.term_first[toks[0]] = mod_first
-            if mod_full == 'pop':
-                self.full_terms.pop(toks, None)
-            elif mod_full:
-                self.full_terms[toks] = mod_full
-        self.abbrevs.clear()
+    def _entry_getter(self):
+        return self._lookup_chain(self.overlay.full_terms,
+                                  super()._entry_getter())
+
+    def _first_token_getter(self):
+        return self._lookup_chain(self.overlay.term_first,
+                                  super()._first_token_getter())
+
+    def _extra_tries(self):
+        'Consult the abbreviation trie as well.'
+        return super()._extra_tries() + [self.overlay.trie]
 
     def reset(self):
         'Clear the abbreviation cache.'
         self.clear_abbrev_cache()
 
 
+class AbbrevOverlay:
+    '''
+    Per-document additions to the termlist tables.
+    '''
+    def __init__(self):
+        self.stopwords = set()
+        self.term_first = {}
+        self.full_terms = {}
+        self.trie = TokenTrie()
+
+
 class RegexAbbrevDetector(AbbrevDetector):
     '''
     Regex-based, tokenisation-independet abbreviation detector.
@@ -477,10 +991,42 @@ class RegexAbbrevDetector(AbbrevDetector):
         matches, sentence, _, _, position, _, _ = args
         m = self.abbrevpattern.match(sentence[position[1]:])
         if m:
-            toks = tuple(self.tokenizer.tokenize_words(m.group(1)))
+            toks = self.tokenize(m.group(1))
             norm = self.normalize(toks)
             self.register_abbrev(toks, norm, matches)
 
     def recognize_entities(self, sentence):
         for entity in super().recognize_entities(sentence):
             yield entity
+
+
+# The entity recognizer, field parser and field count of the parallel
+# termlist compilation (set in the pool processes only).
+_compiler = None
+
+
+def _init_compiler(er, field_parser, n_fields):
+    global _compiler
+    _compiler = er, field_parser, n_fields
+
+
+def _compile_shard(shard):
+    er, field_parser, n_fields = _compiler
+    tsv = io.StringIO(shard, newline='')
+    return list(er._compile_lines(tsv, field_parser, n_fields, False))
+
+
+def _text_shards(lines, size):
+    '''
+    Join lines into shards without splitting escaped newlines.
+    '''
+    shard = []
+    for line in lines:
+        shard.append(line)
+        if len(shard) >= size:
+            stripped = line.rstrip('\r\n')
+            if (len(stripped) - len(stripped.rstrip('\\'))) % 2 == 0:
+                yield ''.join(shard)
+                shard = []
+    if shard:
+        yield ''.join(shard)
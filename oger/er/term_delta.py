@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Incremental updates of the termlist tables.
+
+A delta is a set of added and removed termlist records,
+given as lines of a diff (lines starting with "+" or "-",
+eg. the output of `diff -u old.tsv new.tsv`).  Only these
+records are tokenized and normalized; the rest of the
+termlist is left as is.
+
+Deltas are either merged into the tables before they are
+written to the cache, or kept in a TermDelta, which is
+consulted before the (read-only) tables of a loaded
+termlist.
+
+Records are identified by their term (after normalization)
+and entry fields.  Thus, removing a record also removes any
+records that differ from it only in spelling variants with
+the same normalized form (eg. "ALA" and "Ala"); such
+variants must be re-added in the same diff if they remain.
+
+Removing a term doesn't remove its length from the
+first-token table, since other terms with the same first
+token may have the same length.  A stale length only costs
+an unsuccessful lookup.
+'''
+
+
+import logging
+
+from .term_trie import TokenTrie
+
+
+class TermDelta:
+    '''
+    Changed entries of the termlist tables.
+
+    Removed terms are mapped to an empty tuple.
+    Instances are never modified after construction, so
+    they can be replaced while other threads use them.
+    '''
+    def __init__(self, term_first=(), full_terms=(), paths=()):
+        self.term_first = dict(term_first)
+        self.full_terms = dict(full_terms)
+        self.paths = tuple(paths)  # lookup paths of the added terms
+        self.trie = TokenTrie(self.paths)
+
+    def __len__(self):
+        return len(self.full_terms)
+
+    def update(self, added, removed, get_lengths, get_entries):
+        '''
+        Create a new delta with additional changes.
+
+        The added and removed records are triples <norm, term,
+        entry>, as produced by EntityRecognizer._compile_lines.
+        The lookup functions give the current values of the
+        tables (including this delta).
+        '''
+        term_first, full_terms, paths = merge(added, removed,
+                                              get_lengths, get_entries)
+        term_first = {**self.term_first, **term_first}
+        full_terms = {**self.full_terms, **full_terms}
+        return TermDelta(term_first, full_terms, self.paths + tuple(paths))
+
+    def apply(self, term_first, full_terms):
+        '''
+        Merge the changes into dict-based tables (in place).
+        '''
+        term_first.update(self.term_first)
+        for term, entries in self.full_terms.items():
+            if entries:
+                full_terms[term] = entries
+            else:
+                full_terms.pop(term, None)
+
+
+def merge(added, removed, get_lengths, get_entries):
+    '''
+    Compute the changed table values.
+
+    Return a triple <term_first, full_terms, paths>.
+    Removals are processed first, so a record that is
+    both removed and added is kept.
+    The entries of a term keep their order, with the added
+    ones at the end (as in a rebuild from the patched file).
+    '''
+    term_first, full_terms, paths = {}, {}, []
+
+    def entries(term):
+        try:
+            return full_terms[term]
+        except KeyError:
+            full_terms[term] = value = dict.fromkeys(get_entries(term, ()))
+            return value
+
+    for norm, term, entry in removed:
+        if norm:
+            entries(term).pop(entry, None)
+    for norm, term, entry in added:
+        if not norm:
+            logging.warning('Skipping added record: empty term field')
+            continue
+        entries(term)[entry] = None
+        try:
+            term_first[norm[0]].add(len(term))
+        except KeyError:
+            term_first[norm[0]] = set(get_lengths(norm[0], ()))
+            term_first[norm[0]].add(len(term))
+        paths.append(term)
+        if norm != term:
+            paths.append(norm)  # stopword terms are looked up both ways
+
+    term_first = {k: tuple(sorted(v)) for k, v in term_first.items()}
+    full_terms = {k: tuple(v) for k, v in full_terms.items()}
+    return term_first, full_terms, paths
+
+
+def parse_diff(lines):
+    '''
+    Split diff lines into added and removed termlist records.
+
+    File headers ("---"/"+++" before the first hunk) and
+    context lines are ignored.
+    '''
+    added, removed = [], []
+    in_header = True
+    for line in lines:
+        if line.startswith('@@'):
+            in_header = False
+        elif in_header and line.startswith(('--- ', '+++ ')):
+            continue
+        elif line.startswith('+'):
+            added.append(line[1:])
+        elif line.startswith('-'):
+            removed.append(line[1:])
+    return added, removed
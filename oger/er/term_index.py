@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Compiled, memory-mapped termlist index.
+
+The two hash tables of an entity recognizer (first token and
+full term) are serialised into a single binary file, which is
+queried lazily through mmap.  Opening an index is nearly
+instant, and concurrent processes share the same physical
+pages through the OS page cache.
+
+File layout (native byte order):
+    header:  magic, byte-order mark, field count,
+             offsets of the three tables
+    table:   key count, sorted CRC32 hashes, record offsets,
+             records <key length, key, value count, values>
+    entries: entry count, blob offsets, blob of entry strings
+
+Multi-token keys and entry fields are joined with the ASCII
+unit separator (U+001F), which must not occur in the termlist.
+'''
+
+
+import os
+import mmap
+import zlib
+import struct
+import logging
+from bisect import bisect_left
+from collections.abc import Mapping
+
+
+MAGIC = b'OGERIDX1'
+BOM = 0x01020304
+SEP = '\x1f'
+
+_HEADER = struct.Struct('=8sIIQQQ')
+_U32 = struct.Struct('=I')
+_U64 = struct.Struct('=Q')
+
+
+class TermIndex:
+    '''
+    Read-only view on a compiled termlist index.
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, bom, n_fields, first, full, entries = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or bom != BOM:
+            raise ValueError('not a termlist index: {}'.format(path))
+        self.n_fields = n_fields
+        self.term_first = FirstTokenTable(self._mm, first)
+        self.full_terms = FullTermTable(self._mm, full,
+                                        _EntryTable(self._mm, entries))
+
+    @property
+    def terms(self):
+        '''The pair <term_first, full_terms>.'''
+        return self.term_first, self.full_terms
+
+
+class _Table(Mapping):
+    '''
+    Abstract read-only hash table on a memory-mapped buffer.
+
+    Subclasses must implement _encode(), _decode(), _value().
+    '''
+    def __init__(self, mm, offset):
+        self._mm = mm
+        self._view = memoryview(mm)
+        n, = _U64.unpack_from(mm, offset)
+        offset += _U64.size
+        self._n = n
+        self._hashes = self._view[offset:offset+4*n].cast('I')
+        offset += _padded(4*n)
+        self._offsets = self._view[offset:offset+8*n].cast('Q')
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        for off in self._offsets:
+            klen, = _U32.unpack_from(self._mm, off)
+            yield self._decode(self._mm[off+4:off+4+klen])
+
+    def __getitem__(self, key):
+        pos = self._find(self._encode(key))
+        if pos is None:
+            raise KeyError(key)
+        return self._value(pos)
+
+    def get(self, key, default=None):
+        pos = self._find(self._encode(key))
+        if pos is None:
+            return default
+        return self._value(pos)
+
+    def __contains__(self, key):
+        return self._find(self._encode(key)) is not None
+
+    def _find(self, key):
+        '''
+        Locate the value record of this encoded key.
+        '''
+        h = zlib.crc32(key)
+        i = bisect_left(self._hashes, h)
+        while i < self._n and self._hashes[i] == h:
+            off = self._offsets[i]
+            klen, = _U32.unpack_from(self._mm, off)
+            off += 4
+            if self._mm[off:off+klen] == key:
+                return off+klen
+            i += 1  # hash collision
+        return None
+
+    def _ints(self, pos):
+        '''Read a length-prefixed sequence of integers.'''
+        count, = _U32.unpack_from(self._mm, pos)
+        pos += 4
+        return self._view[pos:pos+4*count].cast('I')
+
+    @staticmethod
+    def _encode(key):
+        raise NotImplementedError
+
+    @staticmethod
+    def _decode(key):
+        raise NotImplementedError
+
+    def _value(self, pos):
+        raise NotImplementedError
+
+
+class FirstTokenTable(_Table):
+    '''
+    Mapping from a normalized token to a sorted tuple of term lengths.
+    '''
+    @staticmethod
+    def _encode(key):
+        return key.encode('utf-8')
+
+    @staticmethod
+    def _decode(key):
+        return key.decode('utf-8')
+
+    def _value(self, pos):
+        return tuple(self._ints(pos))
+
+
+class FullTermTable(_Table):
+    '''
+    Mapping from a token tuple to a tuple of entries.
+    '''
+    def __init__(self, mm, offset, entries):
+        super().__init__(mm, offset)
+        self._entries = entries
+
+    @staticmethod
+    def _encode(key):
+        return SEP.join(key).encode('utf-8')
+
+    @staticmethod
+    def _decode(key):
+        return tuple(key.decode('utf-8').split(SEP))
+
+    def _value(self, pos):
+        return tuple(self._entries[i] for i in self._ints(pos))
+
+
+class _EntryTable:
+    '''
+    Interned entry tuples, addressed by their position.
+    '''
+    def __init__(self, mm, offset):
+        self._mm = mm
+        n, = _U64.unpack_from(mm, offset)
+        offset += _U64.size
+        self._offsets = memoryview(mm)[offset:offset+8*(n+1)].cast('Q')
+        self._blob = offset + 8*(n+1)
+
+    def __getitem__(self, i):
+        start = self._blob + self._offsets[i]
+        end = self._blob + self._offsets[i+1]
+        return tuple(self._mm[start:end].decode('utf-8').split(SEP))
+
+
+def write_index(terms, filename, n_fields):
+    '''
+    Compile the hash tables into an index file.
+
+    The file is written to a temporary location first and
+    then moved into place, so concurrent readers never see
+    a partial index.
+    '''
+    term_first, full_terms = terms
+
+    # Intern the entries (many terms share the same entry).
+    entry_ids = {}
+    full_records = {}
+    for key, entries in full_terms.items():
+        ids = [entry_ids.setdefault(e, len(entry_ids)) for e in entries]
+        full_records[SEP.join(key).encode('utf-8')] = ids
+    first_records = {k.encode('utf-8'): v for k, v in term_first.items()}
+
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        first = _write_table(f, first_records)
+        full = _write_table(f, full_records)
+        entries = _write_entries(f, entry_ids)
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, BOM, n_fields, first, full, entries))
+    os.replace(tmp, filename)
+
+    logging.info('Terms written to index at %s', filename)
+
+
+def _write_table(f, records):
+    '''Write one hash table and return its start offset.'''
+    _align(f)
+    start = f.tell()
+    keys = sorted(records, key=zlib.crc32)
+    n = len(keys)
+
+    # Compute the record offsets in advance.
+    base = start + _U64.size + _padded(4*n) + 8*n
+    offsets = []
+    for key in keys:
+        offsets.append(base)
+        base += 8 + len(key) + 4*len(records[key])
+
+    f.write(_U64.pack(n))
+    f.write(struct.pack('={}I'.format(n), *map(zlib.crc32, keys)))
+    f.write(b'\0' * (_padded(4*n) - 4*n))
+    f.write(struct.pack('={}Q'.format(n), *offsets))
+    for key in keys:
+        values = records[key]
+        f.write(_U32.pack(len(key)))
+        f.write(key)
+        f.write(_U32.pack(len(values)))
+        f.write(struct.pack('={}I'.format(len(values)), *values))
+    return start
+
+
+def _write_entries(f, entry_ids):
+    '''Write the entry table and return its start offset.'''
+    _align(f)
+    start = f.tell()
+    blobs = [SEP.join(e).encode('utf-8') for e in entry_ids]  # ordered by ID
+    offsets = [0]
+    for b in blobs:
+        offsets.append(offsets[-1] + len(b))
+    f.write(_U64.pack(len(blobs)))
+    f.write(struct.pack('={}Q'.format(len(offsets)), *offsets))
+    for b in blobs:
+        f.write(b)
+    return start
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+def _align(f):
+    f.write(b'\0' * (_padded(f.tell()) - f.tell()))
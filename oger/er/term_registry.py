@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Process-wide registry of loaded termlists.
+
+Entity recognizers with identical termlist settings (path,
+field format, term tokenization, normalization, stopwords)
+share a single copy of the term tables, which is loaded
+only once.
+The registry counts the users of each termlist and forgets
+it when the last user has released it.  Its memory is freed
+as soon as the entity recognizers holding it are gone.
+
+The memory used by each termlist is estimated from a sample
+of its entries.
+
+A loaded termlist can be updated with a delta, which affects
+all of its users.
+'''
+
+
+import sys
+import hashlib
+import logging
+import threading
+import itertools as it
+from array import array
+
+from .term_trie import TokenTrie
+from .term_delta import TermDelta
+
+
+# Number of items per container used for estimating memory.
+SAMPLE_SIZE = 1000
+
+
+class TermlistRegistry:
+    '''
+    Shared termlists with reference counting.
+
+    All methods are safe for concurrent use.
+    '''
+    def __init__(self):
+        self._termlists = {}  # key -> SharedTermlist
+        self._loading = {}    # key -> [lock for loading, number of users]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, load, reload=False):
+        '''
+        Get a shared termlist and count a new user.
+
+        If there is no termlist for this key yet (or reload
+        is True), call load() to get a new pair of tables
+        <term_first, full_terms>.
+        Every call must be balanced with a call to release().
+        '''
+        with self._lock:
+            loading = self._loading.setdefault(key, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            # Concurrent requests for the same termlist wait for each other.
+            with loading[0]:
+                with self._lock:
+                    termlist = None if reload else self._termlists.get(key)
+                if termlist is None:
+                    termlist = SharedTermlist(key, *load())
+                else:
+                    logging.info('Using the already loaded termlist %s',
+                                 key[0])
+                with self._lock:
+                    self._termlists[key] = termlist
+                    termlist.users += 1
+        finally:
+            # Forget the lock when no other request is waiting for it.
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self._loading[key]
+        return termlist
+
+    def release(self, termlist):
+        '''
+        Count one user less; forget the termlist after the last one.
+        '''
+        with self._lock:
+            termlist.users -= 1
+            if (termlist.users == 0
+                    and self._termlists.get(termlist.key) is termlist):
+                logging.info('Releasing termlist %s', termlist.key[0])
+                del self._termlists[termlist.key]
+
+    def __len__(self):
+        return len(self._termlists)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._termlists.values()))
+
+
+class SharedTermlist:
+    '''
+    Term tables used by one or more entity recognizers.
+    '''
+    def __init__(self, key, term_first, full_terms):
+        self.key = key
+        self.term_first = term_first
+        self.full_terms = full_terms
+        self.users = 0
+        self._size = None
+        self.delta = None  # TermDelta, consulted before the tables
+        self.revision = None  # digest of the patches applied so far
+        self._trie = None
+        self._trie_lock = threading.Lock()
+        self._patch_lock = threading.Lock()
+
+    @property
+    def size(self):
+        '''Estimated memory in bytes (computed on first access).'''
+        if self._size is None:
+            self._size = estimate_size(self.term_first, self.full_terms)
+        size = self._size
+        if self._trie is not None:
+            size += self._trie.size
+        if self.delta is not None:
+            size += _estimate(self.delta)
+        return size
+
+    def patch(self, added, removed):
+        '''
+        Add and remove records without modifying the tables.
+
+        The records are triples <norm, term, entry>.
+        The new delta replaces the previous one at once, so
+        ongoing lookups are not disturbed.
+        '''
+        with self._patch_lock:
+            delta = self.delta or TermDelta()
+            get_lengths = _lookup_chain(delta.term_first, self.term_first)
+            get_entries = _lookup_chain(delta.full_terms, self.full_terms)
+            self.delta = delta.update(added, removed,
+                                      get_lengths, get_entries)
+            self.revision = hashlib.sha1(repr(
+                (self.revision, added, removed)).encode('utf8')).hexdigest()
+        logging.info('Updated termlist %s: %d changed terms in total',
+                     self.key[0], len(self.delta))
+
+    def get_trie(self, paths):
+        '''
+        Get a token trie, built from paths() on first use.
+        '''
+        with self._trie_lock:
+            if self._trie is None:
+                logging.info('Building token trie...')
+                trie = TokenTrie(paths())
+                trie.size = estimate_size(trie)
+                self._trie = trie
+        return self._trie
+
+
+def _lookup_chain(delta, base):
+    def get(key, default=None):
+        try:
+            return delta[key]
+        except KeyError:
+            return base.get(key, default)
+    return get
+
+
+def estimate_size(*objects):
+    '''
+    Estimate the memory footprint of term tables (in bytes).
+
+    For a memory-mapped index, this is the size of the
+    mapped file (which is shared between processes).
+    '''
+    mm = getattr(objects[-1], '_mm', None)
+    if mm is not None:
+        return len(mm)
+    return sum(_estimate(o) for o in objects)
+
+
+def _estimate(obj):
+    '''
+    Deep size of an object, extrapolated from sampled items.
+    '''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, array)):
+        return size
+    if isinstance(obj, dict):
+        items = it.chain.from_iterable(it.islice(obj.items(), SAMPLE_SIZE))
+        return size + _extrapolate(items, len(obj), 2)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + _extrapolate(it.islice(obj, SAMPLE_SIZE), len(obj))
+    if hasattr(obj, '__dict__'):
+        return size + _estimate(vars(obj))
+    return size
+
+
+def _extrapolate(items, n, per_item=1):
+    total, count = 0, 0
+    for item in items:
+        total += _estimate(item)
+        count += 1
+    if not count:
+        return 0
+    return int(total / count * per_item * n)
+
+
+termlists = TermlistRegistry()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Compact in-memory storage for the full-term table.
+
+Instead of a tuple of strings per entry, each entry field
+is interned into a per-column string table, and entries
+are rows of integer references in a flat array.
+The full-term table maps each term to a range in an array
+of entry IDs.  Entry tuples (which end up as Entity.info)
+are materialised only when a term is actually looked up.
+
+Large termlists repeat the same few types, resources and
+preferred forms many times, and every string object costs
+at least 50 bytes; the compact form replaces them with
+4-byte references.
+'''
+
+
+from array import array
+from collections.abc import Mapping
+
+
+class CompactTermTable(Mapping):
+    '''
+    Read-only replacement for the full_terms dict.
+    '''
+    def __init__(self, full_terms, n_fields):
+        self.n_fields = n_fields
+        self.columns = [[] for _ in range(n_fields)]
+        self._rows = array('I')     # n_fields references per entry
+        self._bounds = array('I', [0])  # entry-ID range per term
+        self._ids = array('I')      # entry IDs
+        self._keys = {}             # term -> position in _bounds
+
+        interned = [{} for _ in range(n_fields)]
+        entry_ids = {}
+        tokens = {}
+        for term, entries in full_terms.items():
+            for entry in entries:
+                try:
+                    id_ = entry_ids[entry]
+                except KeyError:
+                    id_ = entry_ids[entry] = len(entry_ids)
+                    self._rows.extend(self._intern(entry, interned))
+                self._ids.append(id_)
+            self._bounds.append(len(self._ids))
+            # Share the token strings among all terms.
+            term = tuple(tokens.setdefault(t, t) for t in term)
+            self._keys[term] = len(self._keys)
+        self.tokens = tokens
+
+    def _intern(self, entry, interned):
+        for value, table, column in zip(entry, interned, self.columns):
+            try:
+                yield table[value]
+            except KeyError:
+                table[value] = len(column)
+                column.append(value)
+                yield table[value]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __getitem__(self, key):
+        k = self._keys[key]
+        return tuple(self.entry(id_)
+                     for id_ in self._ids[self._bounds[k]:self._bounds[k+1]])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def entry(self, id_):
+        '''
+        Materialise an entry tuple from its ID.
+        '''
+        start = id_ * self.n_fields
+        return tuple(column[ref] for column, ref
+                     in zip(self.columns,
+                            self._rows[start:start+self.n_fields]))
+
+
+def compact_terms(term_first, full_terms, n_fields):
+    '''
+    Convert dict-based tables to the compact representation.
+
+    The keys of term_first are replaced with the shared token
+    strings of the full-term table.
+    '''
+    full_terms = CompactTermTable(full_terms, n_fields)
+    tokens = full_terms.tokens
+    term_first = {tokens.get(t, t): lengths
+                  for t, lengths in term_first.items()}
+    del full_terms.tokens  # only needed during construction
+    return term_first, full_terms
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Token-level trie for term lookup.
+
+Each node is a dict mapping a normalized token to the
+child node.  Nodes at which a term ends are flagged with
+the special key None.
+
+The trie only tells where a term might end; the actual
+entries are still looked up in the full-term hash table.
+'''
+
+
+END = None
+
+
+class TokenTrie:
+    '''
+    Prefix tree over sequences of normalized tokens.
+    '''
+    def __init__(self, paths=()):
+        self.root = {}
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        '''
+        Insert a sequence of tokens.
+        '''
+        node = self.root
+        for tok in path:
+            try:
+                node = node[tok]
+            except KeyError:
+                node[tok] = node = {}
+        node[END] = True
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def clear(self):
+        '''Remove all paths.'''
+        self.root.clear()
+
+    def iter_ends(self, tokens, i):
+        '''
+        Iterate over end indices of paths starting at tokens[i].
+
+        The indices are produced in ascending order.
+        '''
+        node = self.root
+        for j in range(i, len(tokens)):
+            node = node.get(tokens[j])
+            if node is None:
+                return
+            if END in node:
+                yield j+1
@@ -6,6 +6,9 @@
 
 '''
 Postfilters for removing nested annotations.
+
+Articles with an entity table are filtered on its offset
+arrays, without creating Entity objects.
 '''
 
 
@@ -61,11 +64,18 @@ def remove_sametype_submatches(content: document.Exporter) -> None:
 def _rm_any_overlaps(content: document.Exporter, sametype: bool, sub: bool):
     if sametype:
         filter_ = _rm_sametype_overlaps
+        table_filter = _rm_sametype_rows
     else:
         filter_ = lambda e, s: list(_rm_overlapping(e, s))
+        table_filter = _rm_rows
 
-    for sentence in content.get_subelements(document.Sentence):
-        sentence.entities = filter_(sentence.entities, sub)
+    for article in content.get_subelements(document.Article,
+                                           include_self=True):
+        if article.entity_table is not None:
+            table_filter(article.entity_table, sub)
+            continue
+        for sentence in article.get_subelements(document.Sentence):
+            sentence.entities = filter_(sentence.entities, sub)
 
 
 def _rm_sametype_overlaps(entities, sub):
@@ -88,12 +98,60 @@ def _rm_overlapping(entities: Sequence[document.Entity],
     '''
     # Get the indices of all removables.
     filter_ = _submatches if sub else _crossmatches
-    removables = set(filter_(entities))
+    starts = [e.start for e in entities]
+    ends = [e.end for e in entities]
+    removables = set(filter_(starts, ends))
     # Create a new, filtered list.
     return (e for i, e in enumerate(entities) if i not in removables)
 
 
-def _submatches(entities):
+def _rm_rows(table: document.EntityTable, sub: bool) -> None:
+    '''
+    Remove overlapping rows from an entity table.
+    '''
+    # Filter each sentence separately (like the Entity objects), since
+    # the offsets of different sections may overlap (eg. BioC passages).
+    sentences = defaultdict(list)
+    for row, sent in enumerate(table.sentence):
+        sentences[sent].append(row)
+    table.remove(_filter_rows(table, sentences.values(), sub))
+
+
+def _rm_sametype_rows(table: document.EntityTable, sub: bool) -> None:
+    '''
+    Remove overlapping rows of the same type from an entity table.
+    '''
+    # Divide the rows by sentence and entity type.
+    # The groups are ranked in the order in which they first occur.
+    entity_types = defaultdict(list)
+    for row, sent in enumerate(table.sentence):
+        entity_types[sent, table.type(row)].append(row)
+    ranks = {key: i for i, key in enumerate(entity_types)}
+    removables = set(_filter_rows(table, entity_types.values(), sub))
+
+    # Order the remaining rows like _rm_sametype_overlaps() does:
+    # by offsets, then by type (first occurrence).
+    def sort_key(row):
+        sent = table.sentence[row]
+        return (sent, table.start[row], table.end[row],
+                ranks[sent, table.type(row)], row)
+    table.take(sorted((r for r in range(len(table)) if r not in removables),
+                      key=sort_key))
+
+
+def _filter_rows(table, groups, sub):
+    '''
+    Identify the overlapping rows within each group of rows.
+    '''
+    filter_ = _submatches if sub else _crossmatches
+    for rows in groups:
+        starts = [table.start[r] for r in rows]
+        ends = [table.end[r] for r in rows]
+        for i in filter_(starts, ends):
+            yield rows[i]
+
+
+def _submatches(starts, ends):
     '''
     Identify all entities that are found within another entity.
     '''
@@ -101,15 +159,15 @@ def _submatches(entities):
     # needed for comparison.
     # However, runs of equal offsets might need to be excluded together --
     # when followed by a later entity which contains them all.
-    ref_is, ref_entity = [], None
-    for i, entity in enumerate(entities):
+    ref_is, ref = [], None
+    for i, span in enumerate(zip(starts, ends)):
         if i:  # skip comparison in the first iteration (no reference yet)
-            if _contains(ref_entity, entity):
+            if _contains(ref, span):
                 yield i
                 continue  # keep the previous reference
-            elif _contains(entity, ref_entity):
+            elif _contains(span, ref):
                 yield from ref_is
-            elif _equals(entity, ref_entity):
+            elif span == ref:
                 # If the next entity will contain this one, then the previous
                 # needs to be excluded as well.
                 ref_is.append(i)
@@ -118,42 +176,36 @@ def _submatches(entities):
         # end offset is greater or equal to that of the reference.
         # Since the start offset of any future entity will not be lower than
         # the current one, we can safely update the reference.
-        ref_is, ref_entity = [i], entity
+        ref_is, ref = [i], span
 
 def _contains(a, b):
     '''
-    Return True if a contains b, False otherwise.
+    Return True if span a contains span b, False otherwise.
     '''
-    return ((a.start <= b.start and a.end > b.end)
+    return ((a[0] <= b[0] and a[1] > b[1])
             or
-            (a.start < b.start and a.end >= b.end))
-
-def _equals(a, b):
-    '''
-    Return True if a's and b's offsets are the same.
-    '''
-    return a.start == b.start and a.end == b.end
+            (a[0] < b[0] and a[1] >= b[1]))
 
 
-def _crossmatches(entities):
+def _crossmatches(starts, ends):
     '''
     Identify partially overlapping entities to be excluded.
     '''
-    for cluster in _clusters(entities):
+    for cluster in _clusters(starts, ends):
         longest = max(l for _, l in cluster)
         for i, l in cluster:
             if l != longest:
                 yield i
 
-def _clusters(entities):
+def _clusters(starts, ends):
     cluster = []
     current_end = 0
-    for i, e in enumerate(entities):
-        if e.start >= current_end:
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        if start >= current_end:
             if len(cluster) > 1:
                 yield cluster
             cluster.clear()
-        current_end = max(current_end, e.end)
-        cluster.append((i, e.end-e.start))
+        current_end = max(current_end, end)
+        cluster.append((i, end-start))
     if len(cluster) > 1:
         yield cluster
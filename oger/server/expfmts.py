@@ -58,18 +58,36 @@ def export(document, config, fmt, **params):
     '''
     Export article to fmt, considering the settings in config.
     '''
-    if fmt == 'tsv':
-        content_type = 'text/tab-separated-values; charset=UTF-8'
-    elif fmt.endswith('json'):
-        content_type = 'application/json; charset=UTF-8'
-    else:
-        content_type = 'text/xml; charset=UTF-8'
+    exporter = _get_exporter(config, fmt, params)
+    data = exporter.dump(document)
+    return _content_type(fmt), data
+
+
+def iter_export(document, config, fmt, **params):
+    '''
+    Export article to fmt as a sequence of byte chunks.
+
+    The chunks are produced while the exporter is running.
+    '''
+    exporter = _get_exporter(config, fmt, params)
+    chunks = (c if isinstance(c, bytes) else c.encode('utf8')
+              for c in exporter.iter_dump(document))
+    return _content_type(fmt), chunks
+
 
+def _get_exporter(config, fmt, params):
     if params:
         config = Router(config, export_format=(), **params)
-    exporter = EXPORTERS[fmt](config, fmt)
-    data = exporter.dump(document)
-    return content_type, data
+    return EXPORTERS[fmt](config, fmt)
+
+
+def _content_type(fmt):
+    if fmt == 'tsv':
+        return 'text/tab-separated-values; charset=UTF-8'
+    elif fmt.endswith('json'):
+        return 'application/json; charset=UTF-8'
+    else:
+        return 'text/xml; charset=UTF-8'
 
 
 def furbish_odin(node):
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Cache for annotated responses of the fetch endpoint.
+
+Entries are kept in memory in LRU order, limited by number
+and total size, and expire after a fixed time.
+Optionally, they are also stored on disk, where they survive
+server restarts; the disk store has its own size limit.
+
+Each key starts with the name of the annotator, which allows
+removing all entries of an annotator at once.
+Responses computed before such an invalidation are not added
+anymore (see ResponseCache.generation).
+'''
+
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+ENTRIES = 1000
+MEMORY = 64  # MB
+TTL = 24 * 3600  # seconds
+DISK = 1024  # MB
+
+
+class ResponseCache:
+    '''
+    Thread-safe LRU/TTL cache for <content type, body> pairs.
+    '''
+    def __init__(self, entries=ENTRIES, memory=MEMORY, ttl=TTL,
+                 directory=None, disk=DISK):
+        '''
+        Args:
+            entries (int): max number of entries in memory
+                (0 disables the cache)
+            memory (float): max size of the entries in memory (MB)
+            ttl (float): expiration time (seconds)
+            directory (str): path for storing entries on disk
+                (None: no disk store)
+            disk (float): max size of the disk store (MB)
+        '''
+        self.max_entries = entries
+        self.max_bytes = int(memory * 2**20)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (time, ctype, body)
+        self._generations = {}  # annotator -> number of invalidations
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if directory is not None and self.enabled:
+            self._disk = _DiskStore(directory, int(disk * 2**20))
+
+    @property
+    def enabled(self):
+        '''Is caching switched on?'''
+        return self.max_entries > 0
+
+    def get(self, key):
+        '''
+        Look up a <content type, body> pair, or None.
+        '''
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl:
+                self._drop(key)
+                entry = None
+            if entry is None and self._disk is not None:
+                entry = self._disk.get(key, now - self.ttl)
+                if entry is not None:
+                    self._insert(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1:]
+
+    def generation(self, annotator):
+        '''
+        Count the invalidations of this annotator.
+
+        Get this before computing a response and pass it
+        on to put(), so the response is discarded if the
+        annotator's entries are invalidated meanwhile.
+        '''
+        with self._lock:
+            return self._generations.get(annotator, 0)
+
+    def put(self, key, content_type, body, generation=None):
+        '''
+        Add an entry, unless it is from an older generation.
+        '''
+        if not self.enabled:
+            return
+        entry = (time.time(), content_type, body)
+        with self._lock:
+            if (generation is not None
+                    and generation != self._generations.get(key[0], 0)):
+                return  # computed before an invalidation
+            self._insert(key, entry)
+            if self._disk is not None:
+                self._disk.put(key, entry)
+
+    def invalidate(self, annotator):
+        '''
+        Remove all entries of this annotator.
+        '''
+        with self._lock:
+            self._generations[annotator] = (
+                self._generations.get(annotator, 0) + 1)
+            for key in [k for k in self._entries if k[0] == annotator]:
+                self._drop(key)
+            if self._disk is not None:
+                self._disk.remove(annotator)
+
+    def stats(self):
+        '''
+        Summary of the cache usage.
+        '''
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit rate': self.hits/total if total else None,
+            }
+
+    def _insert(self, key, entry):
+        if key in self._entries:
+            self._drop(key)
+        if len(entry[2]) > self.max_bytes:
+            return  # too big for the cache
+        self._entries[key] = entry
+        self._bytes += len(entry[2])
+        while (len(self._entries) > self.max_entries
+               or self._bytes > self.max_bytes):
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+
+class _DiskStore:
+    '''
+    Directory of cached responses, with a subdirectory per annotator.
+
+    Each file contains a JSON header line followed by the body.
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Index all existing files, oldest first.
+        files = []
+        os.makedirs(directory, exist_ok=True)
+        for dirpath, _, filenames in os.walk(directory):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        self._files = OrderedDict((path, size) for _, path, size in files)
+        self._bytes = sum(self._files.values())
+        self._evict()
+
+    def get(self, key, oldest):
+        '''
+        Read an entry created after `oldest`, or return None.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf8'))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        if header['key'] != repr(key) or header['time'] < oldest:
+            return None
+        if path in self._files:
+            self._files.move_to_end(path)
+        return header['time'], header['content_type'], body
+
+    def put(self, key, entry):
+        '''
+        Write an entry to disk.
+        '''
+        time_, content_type, body = entry
+        path = self._path(key)
+        header = dict(key=repr(key), time=time_, content_type=content_type)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps(header).encode('utf8') + b'\n')
+                f.write(body)
+            os.replace(tmp, path)
+            size = os.path.getsize(path)
+        except OSError:
+            logging.exception('Cannot write response to disk cache')
+            return
+        self._bytes += size - self._files.pop(path, 0)
+        self._files[path] = size
+        self._evict()
+
+    def remove(self, annotator):
+        '''
+        Delete all entries of this annotator.
+        '''
+        subdir = os.path.join(self.directory, annotator)
+        for path in [p for p in self._files
+                     if os.path.dirname(p) == subdir]:
+            self._bytes -= self._files.pop(path)
+        shutil.rmtree(subdir, ignore_errors=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, key[0], digest)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._files:
+            path, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -11,21 +11,28 @@ A RESTful API for OGER.
 
 import os
 import json
+import time
 import logging
 import hashlib
 import argparse
 import datetime
+import threading
+import itertools as it
 from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 
 from lxml import etree as ET
-from bottle import get, post, delete, response, request, error, HTTPError
+from bottle import get, post, patch, delete, response, request, error
+from bottle import HTTPError
 from bottle import run as run_bottle, view, ERROR_PAGE_TEMPLATE
 
 from ..ctrl import router, parameters
+from ..er.term_delta import parse_diff
 from ..util.misc import log_exc
-from .expfmts import EXPORT_FMTS, export
+from .expfmts import EXPORT_FMTS, export, iter_export
 from .client import ParamHandler, sanity_check
+from .wsgiserver import PooledServer, WORKERS, BACKLOG
+from . import respcache
 
 
 # ============= #
@@ -34,6 +41,7 @@ from .client import ParamHandler, sanity_check
 
 BOTTLE_HOST = '0.0.0.0'
 BOTTLE_PORT = 12321
+BOTTLE_SERVER = 'threads'
 
 INPUT_FORM = os.path.join(os.path.dirname(__file__), 'static', 'form.html')
 
@@ -54,13 +62,60 @@ def main():
         '-p', '--port', dest='bottle.port', metavar='N', default=BOTTLE_PORT,
         type=int,
         help='port number')
+    bottle.add_argument(
+        '-w', '--workers', dest='bottle.workers', metavar='N',
+        default=WORKERS, type=int,
+        help='number of concurrently handled requests')
+    bottle.add_argument(
+        '-b', '--backlog', dest='bottle.backlog', metavar='N',
+        default=BACKLOG, type=int,
+        help='maximum number of requests waiting for a worker; '
+             'any further requests are rejected (status 503)')
+    bottle.add_argument(
+        '--server', dest='bottle.server', metavar='NAME',
+        default=BOTTLE_SERVER,
+        help='WSGI server: "threads" for a thread pool, '
+             '"wsgiref" for a single thread, '
+             'or any other server backend supported by bottle '
+             '(options -w and -b apply only to "threads"; '
+             'pre-forking backends are not supported, since the '
+             'dictionaries and the response cache are per process)')
     bottle.add_argument(
         '-n', '--annotators', metavar='N', default=3, type=int,
         help='maximum number of non-default annotation dictionaries')
+    bottle.add_argument(
+        '-m', '--memory-budget', metavar='MB', type=float,
+        help='maximum estimated memory of all annotation dictionaries; '
+             'the least recently used ones are removed if exceeded '
+             '(default: no limit)')
     bottle.add_argument(
         '-d', '--debug', dest='bottle.debug', action='store_true',
         help='display exceptions in the served responses')
 
+    cache = ap.add_argument_group(
+        title='response cache',
+        description='cache for the annotated documents of the fetch routes')
+    cache.add_argument(
+        '--cache-entries', dest='cache.entries', metavar='N',
+        default=respcache.ENTRIES, type=int,
+        help='maximum number of responses kept in memory '
+             '(0 disables the cache)')
+    cache.add_argument(
+        '--cache-memory', dest='cache.memory', metavar='MB',
+        default=respcache.MEMORY, type=float,
+        help='maximum size of the responses kept in memory')
+    cache.add_argument(
+        '--cache-ttl', dest='cache.ttl', metavar='SECONDS',
+        default=respcache.TTL, type=float,
+        help='expiration time of cached responses')
+    cache.add_argument(
+        '--cache-dir', dest='cache.directory', metavar='PATH',
+        help='keep cached responses on disk as well')
+    cache.add_argument(
+        '--cache-disk', dest='cache.disk', metavar='MB',
+        default=respcache.DISK, type=float,
+        help='maximum size of the responses kept on disk')
+
     ann = ap.add_argument_group(title='OGER configuration')
     ann.add_argument(
         '-s', '--settings', dest='ann.settings', metavar='PATH', nargs='+',
@@ -77,12 +132,15 @@ def main():
     bottle_args = vars(args.bottle)
     ann_args = parameters.Params.merged(vars(args.ann), args.config)
 
-    init(ann_args, bottle_args, args.annotators)
+    init(ann_args, bottle_args, args.annotators, vars(args.cache),
+         args.memory_budget)
 
 
-def init(ann_conf, bottle_conf, annotators):
+def init(ann_conf, bottle_conf, annotators, cache_conf=None, memory=None):
     '''
     Setup and start the servers.
+
+    The memory budget is given in MB.
     '''
     # A global variable is needed here because the routes are mapped
     # to top-level functions.
@@ -94,9 +152,19 @@ def init(ann_conf, bottle_conf, annotators):
     # but before anything interesting happens (like termlist loading).
     setup_logging()
     # Get the default OGER server.
-    ann_manager = AnnotatorManager(ann_params, n=annotators)
+    cache = respcache.ResponseCache(**(cache_conf or {}))
+    budget = None if memory is None else int(memory * 2**20)
+    ann_manager = AnnotatorManager(ann_params, n=annotators, cache=cache,
+                                   budget=budget)
 
     # Bottle: request handling.
+    server = bottle_conf.get('server', BOTTLE_SERVER)
+    if server == BOTTLE_SERVER:
+        bottle_conf['server'] = PooledServer
+    else:
+        # Other backends have their own concurrency settings (if any).
+        bottle_conf.pop('workers', None)
+        bottle_conf.pop('backlog', None)
     run_bottle(**bottle_conf)
 
 
@@ -123,12 +191,16 @@ ANN = '/<ann:re:[0-9a-f]+>'
 
 FETCH = '/fetch'
 UPLOAD = '/upload'
+BATCH = '/batch'
 
 FETCH_SOURCES = ('pubmed', 'pmc')
 UPLOAD_FMTS = ('txt', 'txt_json', 'bioc', 'pxml', 'nxml', 'pxml.gz')
+BATCH_FMTS = ('txt_jsonl', 'txt_json', 'bioc', 'bioc_xml', 'bioc_json',
+              'pxml.gz')
 
 SOURCE = '/<source:re:{}>'.format('|'.join(FETCH_SOURCES))
 IN_FMT = '/<in_fmt:re:{}>'.format('|'.join(UPLOAD_FMTS))
+BATCH_IN_FMT = '/<in_fmt:re:{}>'.format('|'.join(BATCH_FMTS))
 OUT_FMT = '/<out_fmt:re:{}>'.format('|'.join(EXPORT_FMTS))
 DOCID_WILDCARD = '/<docid:re:[1-9][0-9]*>'
 
@@ -140,12 +212,18 @@ Valid "upload" requests (POST method only):
 /upload/:IN_FMT/:OUT_FMT
 /upload/:IN_FMT/:OUT_FMT/:DOC_ID
 
+Valid "batch" request (POST method only):
+/batch/:BATCH_IN_FMT/:OUT_FMT
+
 Valid SOURCE values:
 {sources}
 
 Valid IN_FMT values:
 {in_fmt}
 
+Valid BATCH_IN_FMT values:
+{batch_in_fmt}
+
 Valid OUT_FMT values:
 {out_fmt}
 
@@ -153,6 +231,7 @@ Valid DOC_ID values:
 [1-9][0-9]*
 '''.format(sources='|'.join(FETCH_SOURCES),
            in_fmt='|'.join(UPLOAD_FMTS),
+           batch_in_fmt='|'.join(BATCH_FMTS),
            out_fmt='|'.join(EXPORT_FMTS))
 
 
@@ -191,8 +270,7 @@ def build_web_page(source, target):
     page = ET.parse(source, parser=HTMLParser)
     radio_group = page.find('.//div[@id="div-ann-radios"]')
     ann_manager.purge()
-    for name in ann_manager.additional:
-        ann = ann_manager.active[name]
+    for name, ann in ann_manager.iter_additional():
         # Create a new radio button for each non-default annotator.
         args = dict(type='radio', name='annotator', value=name)
         node = ET.SubElement(radio_group, 'input', **args)
@@ -230,6 +308,9 @@ def system_status():
         'status': 'running',
         'active annotation dictionaries': len(ann_manager.active),
         'default dictionary': ann_manager.default,
+        'memory': ann_manager.memory_usage(),
+        'memory budget': ann_manager.budget,
+        'response cache': ann_manager.responses.stats(),
     }
 
 
@@ -283,7 +364,28 @@ def check_annotator(ann):
         ann_manager.remove(ann)
         status = 'crashed'
 
-    return {'description': annotator.description, 'status': status}
+    return {'description': annotator.description, 'status': status,
+            'memory': annotator.size()}
+
+
+@patch('/dict' + ANN)
+def update_annotator(ann):
+    '''
+    Add and remove termlist records of this annotator.
+
+    The payload is a diff of the termlist TSV (lines starting
+    with "+" or "-").  With multiple termlists, the query
+    parameter "termlist" selects one by its position.
+    '''
+    try:
+        index = int(request.query.get('termlist', 0))
+        lines = request.body.read().decode('utf-8').splitlines(True)
+        changed = ann_manager.update(ann, *parse_diff(lines), index=index)
+    except KeyError as e:
+        raise HTTPError(404, 'unknown dict: {}'.format(e), exception=e)
+    except Exception as e:
+        raise HTTPError(400, e)
+    return {'dict_id': ann, 'changed terms': changed}
 
 
 @delete('/dict' + ANN)
@@ -307,7 +409,8 @@ def fetch_article(source, out_fmt, docid):
     'Fetch and process one article.'
     logging.info('GET request: article %s from %s in %s format',
                  docid, source, out_fmt)
-    return load_process_export([docid], source, out_fmt, docid=None)
+    return load_process_export([docid], source, out_fmt, docid=None,
+                               cached=True)
 
 
 @post(UPLOAD + IN_FMT + OUT_FMT)
@@ -318,26 +421,77 @@ def upload_article(in_fmt, out_fmt, docid=None):
     return load_process_export(request.body, in_fmt, out_fmt, docid)
 
 
-def load_process_export(data, in_fmt, out_fmt, docid):
-    'Load, process, and export an article (or collection).'
+@post(BATCH + BATCH_IN_FMT + OUT_FMT)
+def batch_annotate(in_fmt, out_fmt):
+    '''
+    Process multiple uploaded documents.
+
+    The response is a stream of JSON lines, one per document,
+    each sent as soon as the document is done.
+    '''
+    logging.info('POST request: batch %s -> %s', in_fmt, out_fmt)
+    params, annotator = _request_annotator()
+    in_params = dict(data=request.body, fmt=in_fmt, **params.in_params)
+    out_params = dict(fmt=out_fmt, **params.out_params)
     try:
-        params = ParamHandler(request.query)
-    except ValueError as e:
+        return annotator.process_batch(in_params, out_params,
+                                       params.postfilters)
+    except Exception as e:
+        in_params.pop('data')
+        logging.exception('Fatal: batch params: %r, %r, %r',
+                          in_params, out_params, params.postfilters)
         raise HTTPError(400, e)
-    try:
-        annotator = ann_manager.get(params.dict)
-    except KeyError as e:
-        raise HTTPError(404, 'unknown dict: {}'.format(e), exception=e)
 
+
+def load_process_export(data, in_fmt, out_fmt, docid, cached=False):
+    '''
+    Load, process, and export an article (or collection).
+
+    If cached is True, the response is looked up in and added
+    to the response cache, using the (hashable) data as a key.
+    The key includes the state of the annotator's termlists.
+    '''
+    params, annotator = _request_annotator()
     in_params = dict(data=data, fmt=in_fmt, id_=docid, **params.in_params)
     out_params = dict(fmt=out_fmt, **params.out_params)
+    cached = cached and annotator.is_ready()
+    if cached:
+        name = params.dict or ann_manager.default
+        generation = ann_manager.responses.generation(name)
+        key = (name, annotator.fingerprint(), in_fmt, tuple(data),
+               tuple(sorted(params.in_params.items())),
+               tuple(sorted(out_params.items())),
+               tuple(sorted(params.postfilters)))
+        hit = ann_manager.responses.get(key)
+        if hit is not None:
+            response.content_type, body = hit
+            return body
     try:
-        return annotator.process(in_params, out_params, params.postfilters)
+        body = annotator.process(in_params, out_params, params.postfilters)
     except Exception as e:
         data = in_params.pop('data')
         logging.exception('Fatal: data: %.40r, params: %r, %r, %r',
                           data, in_params, out_params, params.postfilters)
         raise HTTPError(400, e)
+    if cached:
+        if not isinstance(body, bytes):
+            body = b''.join(body)
+        ann_manager.responses.put(key, response.content_type, body,
+                                  generation)
+    return body
+
+
+def _request_annotator():
+    'Get the query parameters and the targeted annotator.'
+    try:
+        params = ParamHandler(request.query)
+    except ValueError as e:
+        raise HTTPError(400, e)
+    try:
+        annotator = ann_manager.get(params.dict)
+    except KeyError as e:
+        raise HTTPError(404, 'unknown dict: {}'.format(e), exception=e)
+    return params, annotator
 
 
 # Legacy interface.
@@ -374,19 +528,30 @@ def error404(err):
 class AnnotatorManager:
     '''
     Container for a limited number of active annotation servers.
+
+    All methods are safe for concurrent use.
     '''
-    def __init__(self, default, n=3):
+    def __init__(self, default, n=3, cache=None, budget=None):
         '''
         Args:
             default (Params instance or dict of parameters):
                 parameters for the default server
             n (int): max number of additional servers
+            cache (ResponseCache): cache for fetched responses
+                (default: in memory, with default limits)
+            budget (int): max estimated memory of all servers
+                in bytes (default: no limit)
         '''
         self._default_settings = router.Router(default)
         self.n = n
+        self.budget = budget
         self.default = self.key(self._default_settings)  # default server name
         self.active = {}                  # all active servers
         self.additional = []              # names of additional servers
+        self._lock = threading.RLock()    # guards active and additional
+        if cache is None:
+            cache = respcache.ResponseCache()
+        self.responses = cache            # fetched responses by annotator
 
         logging.info('Starting default annotator %s', self.default)
         self.active[self.default] = Annotator(self._default_settings,
@@ -405,14 +570,20 @@ class AnnotatorManager:
         config = router.Router(self._default_settings, **params)
 
         key = self.key(config)
-        self.purge()
-        if key not in self.active:
-            logging.info('Starting new annotator %s', key)
-            self.active[key] = Annotator(config, desc, blocking)
-            self.additional.append(key)
-            # Dispose of surplus annotators.
-            while len(self.additional) > self.n:
-                self.remove()
+        with self._lock:
+            self.purge()
+            if key not in self.active:
+                logging.info('Starting new annotator %s', key)
+                annotator = Annotator(config, desc, blocking)
+                self.active[key] = annotator
+                self.additional.append(key)
+                # Dispose of surplus annotators.
+                while len(self.additional) > self.n:
+                    self.remove()
+                # Check the memory budget once the termlists are loaded.
+                annotator.add_done_callback(self._enforce_budget)
+            else:
+                self.active[key].touch()
         return key
 
     def remove(self, name=None):
@@ -420,18 +591,39 @@ class AnnotatorManager:
         Remove and destroy an annotator.
 
         If name is not given or None, remove the oldest annotator.
+        The removed annotator's memory is freed once all requests
+        using it are finished.
         '''
-        if name is None:
-            name = self.additional.pop(0)
-        else:
-            try:
-                self.additional.remove(name)
-            except ValueError:
-                if name == self.default:
-                    raise IllegalAction('cannot remove default annotator')
-                raise KeyError(name)
-        logging.info('Removing annotator %s', name)
-        del self.active[name]
+        with self._lock:
+            if name is None:
+                name = self.additional.pop(0)
+            else:
+                try:
+                    self.additional.remove(name)
+                except ValueError:
+                    if name == self.default:
+                        raise IllegalAction('cannot remove default annotator')
+                    raise KeyError(name)
+            logging.info('Removing annotator %s', name)
+            self.active.pop(name).close()
+            self.responses.invalidate(name)
+
+    def update(self, name, added, removed, index=0):
+        '''
+        Add and remove termlist records of an annotator.
+
+        The change affects all annotators sharing the termlist;
+        their cached responses are discarded.
+        Return the number of changed terms.
+        '''
+        annotator = self.get(name)
+        termlist, changed = annotator.update_terms(added, removed, index)
+        with self._lock:
+            users = [n for n, a in self.active.items()
+                     if termlist in a.termlists()]
+        for user in users:
+            self.responses.invalidate(user)
+        return changed
 
     def get(self, name):
         '''
@@ -442,14 +634,62 @@ class AnnotatorManager:
         '''
         if not name:
             name = self.default
-        return self.active[name]
+        with self._lock:
+            annotator = self.active[name]
+        annotator.touch()
+        return annotator
+
+    def iter_additional(self):
+        '''
+        Iterate over pairs <name, annotator> of non-default annotators.
+        '''
+        with self._lock:
+            items = [(name, self.active[name]) for name in self.additional]
+        return iter(items)
 
     def purge(self):
         """Remove any dead annotators."""
-        for name, ann in list(self.active.items()):
-            try:
-                ann.is_ready()
-            except RuntimeError:
+        with self._lock:
+            for name, ann in list(self.active.items()):
+                try:
+                    ann.is_ready()
+                except RuntimeError:
+                    self.remove(name)
+            self._enforce_budget()
+
+    def memory_usage(self):
+        '''
+        Estimated memory of all active annotators (in bytes).
+
+        Termlists shared by several annotators are counted once.
+        '''
+        with self._lock:
+            annotators = list(self.active.values())
+        termlists = {id(t): t for a in annotators for t in a.termlists()}
+        return sum(t.size for t in termlists.values())
+
+    def _enforce_budget(self):
+        '''
+        Remove the least recently used annotators while over budget.
+
+        The default annotator and the most recently used one
+        are never removed.
+        '''
+        if self.budget is None:
+            return
+        with self._lock:
+            while len(self.additional) > 1:
+                usage = self.memory_usage()
+                if usage <= self.budget:
+                    break
+                name = min(self.additional,
+                           key=lambda n: self.active[n].last_used)
+                most_recent = max(self.active[n].last_used
+                                  for n in self.additional)
+                if self.active[name].last_used == most_recent:
+                    break
+                logging.info('Memory budget exceeded (%d > %d bytes)',
+                             usage, self.budget)
                 self.remove(name)
 
     @classmethod
@@ -468,6 +708,8 @@ class AnnotatorManager:
 class Annotator:
     """
     Wrapper for a PipelineServer with termlist loading in a separate thread.
+
+    Once loaded, an annotator can process multiple requests concurrently.
     """
 
     def __init__(self, config, desc, blocking=False):
@@ -477,6 +719,7 @@ class Annotator:
         self.description = desc
         self._postfilters = None  # accessible by name
         self._pls = router.PipelineServer(self.config, lazy=True)
+        self.last_used = time.monotonic()
 
         # Load the termlist asynchronously.
         executor = ThreadPoolExecutor(max_workers=1)
@@ -486,6 +729,61 @@ class Annotator:
         executor.shutdown(wait=blocking)
         self.is_ready()  # trigger an exception if loading failed.
 
+    def close(self):
+        '''
+        Release the termlists (after loading has finished).
+        '''
+        self._loading.add_done_callback(lambda _: self._pls.close())
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback() once loading has finished (or failed).
+        '''
+        self._loading.add_done_callback(lambda _: callback())
+
+    def touch(self):
+        '''
+        Record the current time as the last use.
+        '''
+        self.last_used = time.monotonic()
+
+    def termlists(self):
+        '''
+        Distinct shared termlists (empty while loading).
+        '''
+        if not self._loading.done() or self._loading.exception() is not None:
+            return []
+        termlists = (er.termlist for er in self._pls.ers)
+        return list({id(t): t for t in termlists if t is not None}.values())
+
+    def size(self):
+        '''
+        Estimated memory of the termlists (in bytes).
+        '''
+        return sum(t.size for t in self.termlists())
+
+    def fingerprint(self):
+        '''
+        Token for the state of the termlists.
+        '''
+        if not self.is_ready():
+            raise RuntimeError('annotator not yet loaded')
+        return AnnotatorManager.hashtoken(
+            tuple(er.fingerprint for er in self._pls.ers))
+
+    def update_terms(self, added, removed, index=0):
+        '''
+        Add and remove records of the index-th termlist.
+
+        Return the shared termlist and the number of changed terms.
+        '''
+        if not self.is_ready():
+            raise RuntimeError('annotator not yet loaded')
+        ers = self._pls.ers
+        if not 0 <= index < len(ers):
+            raise ValueError('no termlist at position {}'.format(index))
+        return ers[index].termlist, ers[index].update_terms(added, removed)
+
     def is_ready(self):
         '''
         Has this annotator finished loading the termlist?
@@ -504,20 +802,86 @@ class Annotator:
             if not self.is_ready():
                 raise RuntimeError('annotator not yet loaded')
             # Index the filters by their function name.
-            self._postfilters = OrderedDict()
+            postfilters = OrderedDict()
             for func in self._pls.conf.postfilters:
-                self._postfilters[func.__name__] = func
+                postfilters[func.__name__] = func
+            self._postfilters = postfilters
         return self._postfilters
 
     def process(self, in_params, out_params, postfilters):
         '''
         Load, process, and export one document or collection.
+
+        Large outputs are returned as an iterator of chunks,
+        which are sent as they are produced.
         '''
         document = self._get_annotated(in_params)
         self._postfilter(document, postfilters)
-        ctype, data = export(document, self.config, **out_params)
+        ctype, chunks = iter_export(document, self.config, **out_params)
         response.content_type = ctype
-        return data
+        return self._start_output(chunks)
+
+    @staticmethod
+    def _start_output(chunks):
+        '''
+        Get the first two chunks before any output is sent.
+
+        This way, errors at the beginning of the export still
+        result in an error response.  Outputs that fit into
+        a single chunk are sent as a whole (with known length).
+        '''
+        first = next(chunks, b'')
+        second = next(chunks, None)
+        if second is None:
+            return first
+        return it.chain((first, second), chunks)
+
+    def process_batch(self, in_params, out_params, postfilters):
+        '''
+        Load, process, and export a sequence of documents.
+
+        Return an iterator of JSON lines (as bytes), one for each
+        document, with its ID and either the exported data or an
+        error message.
+        Problems with the parameters or the beginning of the input
+        are raised right away, before any output is produced.
+        '''
+        if not self.is_ready():
+            raise RuntimeError('annotator not yet loaded')
+        postfilters = self._select_postfilters(postfilters)
+        documents = self._pls.iter_load(**in_params)
+        first = next(documents, None)
+        response.content_type = 'application/x-ndjson; charset=UTF-8'
+        if first is None:
+            return []
+        return self._iter_batch(first, documents, out_params, postfilters)
+
+    def _iter_batch(self, document, documents, out_params, postfilters):
+        while document is not None:
+            try:
+                self._pls.process(document)
+                for postfilter in postfilters:
+                    self._pls.apply_postfilter(postfilter, document)
+                _, data = export(document, self.config, **out_params)
+                if isinstance(data, bytes):
+                    data = data.decode('utf8')
+                result = {'id': document.id_, 'data': data}
+            except Exception as e:
+                logging.exception('Batch: document %s failed', document.id_)
+                result = {'id': document.id_, 'error': str(e)}
+            yield self._json_line(result)
+
+            try:
+                document = next(documents, None)
+            except Exception as e:
+                # Malformed input: no way to continue.
+                logging.exception('Batch: loading failed')
+                yield self._json_line({'id': None, 'error': str(e)})
+                return
+
+    @staticmethod
+    def _json_line(obj):
+        return (json.dumps(obj) + '\n').encode('utf8')
 
     def _get_annotated(self, params):
         '''
@@ -533,6 +897,13 @@ class Annotator:
         '''
         Call each postfilter on the document.
         '''
+        for postfilter in self._select_postfilters(filternames):
+            self._pls.apply_postfilter(postfilter, document)
+
+    def _select_postfilters(self, filternames):
+        '''
+        Look up postfilter functions by name.
+        '''
         # Special values: true/false enable/disable all filters.
         # Specifying no filters explicitly defaults to enabling all too.
         if 'true' in filternames or not filternames:
@@ -540,12 +911,13 @@ class Annotator:
         elif 'false' in filternames:
             filternames = []
 
+        postfilters = []
         for name in filternames:
             try:
-                postfilter = self.postfilters[name]
+                postfilters.append(self.postfilters[name])
             except KeyError:
                 raise ValueError('unknown postfilter: {}'.format(name))
-            postfilter(document)
+        return postfilters
 
 
 # ============== #
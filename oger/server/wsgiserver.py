@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Multi-threaded WSGI server based on the standard library.
+
+Requests are handled by a fixed pool of worker threads.
+If more requests are waiting than the backlog allows,
+further requests are rejected immediately with status 503,
+rather than piling up.
+
+Responses of unknown length (such as the output of a
+generator) are sent to HTTP/1.1 clients with chunked
+transfer encoding, so each part is delivered as soon as
+it is produced.
+'''
+
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import (WSGIServer, WSGIRequestHandler,
+                                   ServerHandler, make_server)
+
+from bottle import ServerAdapter
+
+
+WORKERS = 8
+BACKLOG = 32
+
+BUSY_RESPONSE = (
+    b'HTTP/1.0 503 Service Unavailable\r\n'
+    b'Content-Type: text/plain; charset=UTF-8\r\n'
+    b'Retry-After: 1\r\n'
+    b'Connection: close\r\n'
+    b'\r\n'
+    b'Server busy, please try again later.\n'
+)
+
+
+class PooledWSGIServer(WSGIServer):
+    '''
+    WSGI server handling requests in a thread pool.
+    '''
+    def __init__(self, *args, workers=WORKERS, backlog=BACKLOG, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = ThreadPoolExecutor(workers,
+                                        thread_name_prefix='request')
+        # Requests being processed or waiting for a worker.
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            logging.warning('Server busy: rejecting request from %s',
+                            client_address[0])
+            self._reject(request)
+            return
+        self._pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def _reject(self, request):
+        try:
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=True)
+
+
+class ChunkedHandler(ServerHandler):
+    '''
+    Server handler with chunked transfer encoding.
+
+    The connection is closed after each response.
+    '''
+    http_version = '1.1'
+    chunked = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        self.headers['Connection'] = 'close'
+        self.chunked = ('Content-Length' not in self.headers
+                        and 'Transfer-Encoding' not in self.headers
+                        and self.environ['SERVER_PROTOCOL'] == 'HTTP/1.1'
+                        and self.environ['REQUEST_METHOD'] != 'HEAD'
+                        and self.status[:3] not in ('204', '304'))
+        if self.chunked:
+            self.headers['Transfer-Encoding'] = 'chunked'
+
+    def write(self, data):
+        if not self.headers_sent and self.status:
+            self.send_headers()
+        if self.chunked:
+            if not data:
+                return  # an empty chunk would end the response
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        super().write(data)
+
+    def finish_content(self):
+        super().finish_content()
+        if self.chunked:
+            self._write(b'0\r\n\r\n')
+            self._flush()
+
+
+class RequestHandler(WSGIRequestHandler):
+    '''
+    Request handler without reverse DNS lookups.
+    '''
+    def address_string(self):
+        return self.client_address[0]
+
+    def handle(self):
+        # Same as the base method, except for the server handler.
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = ChunkedHandler(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self  # backpointer for logging
+        handler.run(self.server.get_app())
+
+
+class QuietHandler(RequestHandler):
+    '''
+    Request handler without access logging.
+    '''
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class PooledServer(ServerAdapter):
+    '''
+    Bottle adapter for PooledWSGIServer.
+
+    Options: workers (number of threads) and backlog
+    (maximum number of requests waiting for a thread).
+    '''
+    def run(self, handler):
+        workers = int(self.options.pop('workers', WORKERS))
+        backlog = int(self.options.pop('backlog', BACKLOG))
+
+        def server_class(*args, **kwargs):
+            return PooledWSGIServer(*args, workers=workers, backlog=backlog,
+                                    **kwargs)
+
+        handler_class = QuietHandler if self.quiet else RequestHandler
+        srv = make_server(self.host, self.port, handler,
+                          server_class, handler_class)
+        self.srv = srv  # for shutdown by the caller
+        try:
+            srv.serve_forever()
+        finally:
+            srv.server_close()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Timing and memory benchmarks for performance-critical components.
+'''
+
+
+import os
+import time
+import gzip
+import pickle
+import tracemalloc
+import argparse
+import tempfile
+from os.path import join
+
+from ..ctrl.router import Router, PipelineServer
+from ..doc import LOADERS, pubmed
+from .tester import TESTFILES, TERMLIST
+
+
+BENCHMARKS = [
+    'er_engine',
+    'termlist_build',
+    'normalize_cache',
+    'term_tokenizer',
+    'medline_parse',
+    'doc_memory',
+]
+
+# Default input: PMC full texts.
+INPUT = join(TESTFILES, 'conll', 'PMC6930xxx.conll')
+INPUT_FORMAT = 'conll'
+
+# Medline sample, repeated to the size of a baseline file (30k citations).
+MEDLINE_SAMPLE = join(TESTFILES, 'pxml.gz', 'medline16n0005_sampled.xml.gz')
+MEDLINE_COPIES = 300
+
+
+def main():
+    '''
+    Run one or more benchmarks from the command line.
+    '''
+    ap = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ap.add_argument(
+        '-i', '--input', default=INPUT, metavar='PATH',
+        help='input document or collection')
+    ap.add_argument(
+        '-f', '--format', default=INPUT_FORMAT, metavar='FMT',
+        help='input format')
+    ap.add_argument(
+        '-t', '--termlist', default=TERMLIST, metavar='PATH',
+        help='termlist in Bio Term Hub format (with header)')
+    ap.add_argument(
+        '-r', '--repeat', default=5, type=int, metavar='N',
+        help='number of repetitions (the best run is reported)')
+    ap.add_argument(
+        'benchmarks', nargs='+', choices=['all'] + BENCHMARKS,
+        metavar='BENCHMARK',
+        help='any selection of the following, or "all" to run all: '
+        + ', '.join(BENCHMARKS))
+    args = vars(ap.parse_args())
+    names = args.pop('benchmarks')
+    if 'all' in names:
+        names = BENCHMARKS
+    for name in names:
+        print('{}:'.format(name))
+        globals()[name](**args)
+
+
+def best_of(repeat, func, *args, **kwargs):
+    '''
+    Run func repeatedly and return the shortest wall time.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(label, seconds, units=None, unit_name=None):
+    '''
+    Print a line with timing and optional throughput.
+    '''
+    line = '  {:<24} {:8.3f} s'.format(label, seconds)
+    if units is not None:
+        line += '  ({:,.0f} {}/s)'.format(units/seconds, unit_name)
+    print(line)
+
+
+def pipeline(termlist, cache=None, **params):
+    '''
+    Create a loaded PipelineServer for benchmarking.
+    '''
+    if cache is None:
+        cache = CACHE.name
+    conf = Router(termlist_path=termlist, termlist_skip_header=True,
+                  termlist_cache=cache, **params)
+    return PipelineServer(conf, lazy=False)
+
+
+CACHE = tempfile.TemporaryDirectory()
+
+
+# ================== #
+# ACTUAL BENCHMARKS. #
+# ================== #
+
+def er_engine(input, format, termlist, repeat):
+    '''
+    Compare the hash-probe and trie matching engines.
+    '''
+    for engine in ('hash', 'trie'):
+        pl = pipeline(termlist, termlist_engine=engine)
+        sentences = [s.text for s in pl.load_one(input, format)
+                     .get_subelements('sentence')]
+        er = pl.ers[0]
+
+        def recognize():
+            for sent in sentences:
+                for _ in er.recognize_entities(sent):
+                    pass
+
+        report(engine, best_of(repeat, recognize), len(sentences), 'sentences')
+
+
+def termlist_build(input, format, termlist, repeat):
+    '''
+    Compare serial and parallel termlist compilation from TSV.
+    '''
+    del input, format  # not needed
+    with open(termlist, encoding='utf8') as f:
+        lines = sum(1 for _ in f)
+    for workers in (1, 2, 4):
+        seconds = best_of(repeat, pipeline, termlist,
+                          termlist_force_reload=True,
+                          termlist_build_workers=workers)
+        report('{} processes'.format(workers), seconds, lines, 'lines')
+
+
+def normalize_cache(input, format, termlist, repeat):
+    '''
+    Recognition with and without the normalization cache.
+    '''
+    for size in (0, 2**16):
+        pl = pipeline(termlist, join(CACHE.name, 'stem'),
+                      termlist_normalize='lowercase stem',
+                      termlist_normalize_cache=size)
+        sentences = [s.text for s in pl.load_one(input, format)
+                     .get_subelements('sentence')]
+        er = pl.ers[0]
+
+        def recognize():
+            for sent in sentences:
+                for _ in er.recognize_entities(sent):
+                    pass
+
+        label = 'cache size {}'.format(size)
+        report(label, best_of(repeat, recognize), len(sentences), 'sentences')
+
+
+def term_tokenizer(input, format, termlist, repeat):
+    '''
+    Compare the NLTK term tokenizer with the compiled fast path.
+    '''
+    pl = pipeline(termlist)
+    sentences = [s.text for s in pl.load_one(input, format)
+                 .get_subelements('sentence')]
+    er = pl.ers[0]
+
+    def nltk():
+        for sent in sentences:
+            tuple(zip(*er.tokenizer.span_tokenize_words(sent)))
+
+    def fast():
+        for sent in sentences:
+            er.span_tokenize(sent)
+
+    timings = []
+    for label, func in (('NLTK RegexpTokenizer', nltk), ('fast path', fast)):
+        timings.append(best_of(repeat, func))
+        report(label, timings[-1], len(sentences), 'sentences')
+    print('  saving: {:.1f} µs per sentence'.format(
+        1e6*(timings[0]-timings[1])/len(sentences)))
+
+
+def medline_parse(input, format, termlist, repeat):
+    '''
+    Compare serial and parallel parsing of a Medline file.
+
+    Unless the input is in pxml.gz format, a baseline-sized
+    file is built from copies of the test sample.
+    '''
+    del termlist  # not needed
+    if format != 'pxml.gz':
+        input = join(CACHE.name, 'medline_baseline.xml.gz')
+        _baseline_sample(input)
+    print('  CPU cores available: {}'.format(os.cpu_count()))
+    for workers in (1, 2, 4):
+        loader = LOADERS['pxml.gz'](Router(medline_workers=workers))
+
+        def parse():
+            return sum(1 for _ in loader.iter_documents(input))
+
+        n = parse()
+        report('{} processes'.format(workers), best_of(repeat, parse),
+               n, 'documents')
+
+    # Estimate the gain for a machine with enough cores: the workers'
+    # share runs in parallel, the main process's share does not.
+    main, work = _medline_stages(input, repeat)
+    report('main process', main)
+    report('workers (CPU)', work)
+    for workers in (2, 4, 8):
+        print('  estimate with {} free cores: {:.3f} s'
+              .format(workers, max(main, work/workers)))
+
+
+def _medline_stages(path, repeat):
+    '''
+    Time the stages of parallel Medline parsing in-process.
+
+    Return the time spent in the main process (decompression,
+    cutting, unpickling, building the articles) and in the
+    workers (parsing, sentence splitting, pickling).
+    '''
+    loader = LOADERS['pxml.gz'](Router())
+    pubmed._init_medline_parser(loader)
+
+    def cut():
+        with gzip.open(path, 'rb') as f:
+            return list(pubmed._citation_shards(f, pubmed.MEDLINE_SHARD_SIZE))
+
+    shards = cut()
+    records = [pubmed._parse_citations(s) for s in shards]
+    pickles = [pickle.dumps(r) for r in records]
+
+    def build():
+        for r in records:
+            for record in r:
+                loader._build_article(*record)
+
+    main = (best_of(repeat, cut)
+            + best_of(repeat, lambda: [pickle.loads(p) for p in pickles])
+            + best_of(repeat, build))
+    work = (best_of(repeat, lambda: [pubmed._parse_citations(s)
+                                     for s in shards])
+            + best_of(repeat, lambda: [pickle.dumps(r) for r in records]))
+    return main, work
+
+
+def doc_memory(input, format, termlist, repeat):
+    '''
+    Measure the memory of a loaded collection (with tracemalloc).
+
+    Unless the input is in pxml.gz format, a baseline-sized
+    Medline file is used.
+    '''
+    del termlist, repeat  # not needed
+    if format != 'pxml.gz':
+        input = join(CACHE.name, 'medline_baseline.xml.gz')
+        _baseline_sample(input)
+        format = 'pxml.gz'
+    conf = Router()
+    _ = conf.text_processor  # load the tokenizers before measuring
+    loader = LOADERS[format](conf)
+    tracemalloc.start()
+    try:
+        coll = loader.load_one(input, None)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    n = sum(1 for _ in coll.get_subelements('article'))
+    sentences = sum(1 for _ in coll.get_subelements('sentence'))
+    print('  {:<24} {:8.1f} MB  ({:,.0f} bytes/document, {:,} sentences)'
+          .format('{:,} documents'.format(n), size/2**20, size/n, sentences))
+
+
+def _baseline_sample(path):
+    with gzip.open(MEDLINE_SAMPLE, 'rb') as f:
+        data = f.read()
+    head, rest = data.split(b'<MedlineCitationSet>', 1)
+    body, tail = rest.rsplit(b'</MedlineCitationSet>', 1)
+    with gzip.open(path, 'wb') as f:
+        f.write(head + b'<MedlineCitationSet>')
+        for _ in range(MEDLINE_COPIES):
+            f.write(body)
+        f.write(b'</MedlineCitationSet>' + tail)
+
+
+if __name__ == '__main__':
+    main()
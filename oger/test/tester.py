@@ -29,18 +29,41 @@ Test runs for the top-level call.
 # IMPORTS
 #########
 
+import io
 import sys
+import gzip
+import glob
+import copy
 import shlex
+import json
+import pickle
 import logging
 import argparse
 import tempfile
+import time
+import threading
+import urllib.request
+from urllib.parse import parse_qs
 from os.path import join, dirname, realpath
 import os
 from datetime import datetime
+from collections import Counter
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from concurrent.futures import ThreadPoolExecutor
 
 from ..ctrl.run import run
+from ..ctrl.router import Router, PipelineServer
 from ..ctrl import parameters
-from .. import doc
+from ..er import entity_recognition
+from ..er.term_registry import termlists
+from ..doc import pubmed
+from ..doc.store import DocumentStore
+from ..util import jsonstream
+from ..util.stream import CHUNK_SIZE
+from ..server import restfulserver, respcache, expfmts, wsgiserver
+from .. import doc, post
 
 
 #############################
@@ -66,10 +89,34 @@ TESTCASES = [
     'pubtator',
     'pubtator_fbk',
     'pxmlgz',
+    'pxmlgz_parallel',
     'pxml_directory',
     'pxml_id',
     'bioc_xml',
     'bioc_json',
+    'bioc_stream',
+    'bioc_stream_annotated',
+    'bioc_json_stream',
+    'termlist_mmap',
+    'termlist_compact',
+    'termlist_build',
+    'normalize_cache',
+    'abbrev_threads',
+    'termlist_shared',
+    'termlist_delta',
+    'document_model',
+    'entity_table',
+    'rest_concurrent',
+    'rest_batch',
+    'rest_streaming',
+    'rest_cache',
+    'rest_memory',
+    'efetch_store',
+    'efetch_prefetch',
+    'er_engine',
+    'parallel',
+    'parallel_collection',
+    'pipeline',
     'download_pubmed',
     'download_pmc',
     'download_bad_pmc',
@@ -217,6 +264,16 @@ def run_with_arguments(arguments_string):
     run(**arguments)
 
 
+def read_outputs(output):
+    'Read all output files of a directory into a dict.'
+    contents = {}
+    for path in sorted(glob.glob(join(output, '**', '*'), recursive=True)):
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                contents[os.path.relpath(path, output)] = f.read()
+    return contents
+
+
 def outdir(outputdir, *args):
     'Create an output directory name with datetime and test-case name.'
     # Get the name of the calling function.
@@ -299,6 +356,46 @@ def pubtator_fbk(outputdir):
 def pxmlgz(outputdir):
     _multiple_outfmts(outdir(outputdir), 'pxml.gz')
 
+def pxmlgz_parallel(outputdir):
+    # Parallel Medline parsing must give the same documents in order.
+    outputdir = outdir(outputdir)
+    shard_size = pubmed.MEDLINE_SHARD_SIZE
+    pubmed.MEDLINE_SHARD_SIZE = 7  # make sure there are many shards
+    try:
+        results = []
+        for workers in ('1', '3'):
+            testlogger.info('-> bioc_xml tsv (medline_workers: %s)', workers)
+            output = join(outputdir, workers)
+            arguments = make_arguments(format='pxml.gz',
+                                       output=output,
+                                       mode='collection',
+                                       export='bioc_xml tsv',
+                                       miscellaneous='-c include_mesh true '
+                                       '-c medline_workers ' + workers)
+            run_with_arguments(arguments)
+            results.append(read_outputs(output))
+    finally:
+        pubmed.MEDLINE_SHARD_SIZE = shard_size
+    if results[0] != results[1]:
+        raise AssertionError('parallel Medline parsing differs')
+
+    # Outside the main thread, the files are parsed serially (no fork).
+    testlogger.info('-> medline_workers 3 in a thread')
+    path, = glob.glob(join(TESTFILES, 'pxml.gz', '*.xml.gz'))
+    loader = doc.LOADERS['pxml.gz'](Router(medline_workers=3))
+
+    def refuse(*args):
+        raise AssertionError('process pool started outside the main thread')
+
+    loader._iterparse_parallel = refuse
+    with gzip.open(path, 'rb') as f:
+        reference = [a.id_ for a in loader._iterparse(f)]
+    with ThreadPoolExecutor(1) as pool:
+        ids = pool.submit(lambda: [a.id_ for a in
+                                   loader.iter_documents(path)]).result()
+    if ids != reference:
+        raise AssertionError('Medline parsing in a thread differs')
+
 def pxml_directory(outputdir):
     _multiple_outfmts(outdir(outputdir), 'pxml')
 
@@ -350,6 +447,792 @@ def bioc_json(outputdir):
                                export='pubtator')
     run_with_arguments(arguments)
 
+def bioc_stream(outputdir):
+    # Streamed collections must give the same output as loaded ones.
+    from lxml import etree
+    outputdir = outdir(outputdir)
+    input_dir = join(outputdir, 'input')
+    os.makedirs(input_dir, exist_ok=True)
+    # Merge all documents into one collection (without annotations).
+    paths = sorted(glob.glob(join(TESTFILES, 'bioc_xml', '*.xml')))
+    tree = etree.parse(paths[0])
+    for path in paths[1:]:
+        tree.getroot().extend(etree.parse(path).iterfind('document'))
+    for node in list(tree.iter('annotation')):
+        node.getparent().remove(node)
+    tree.write(join(input_dir, 'collection.xml'))
+    _compare_streamed(outputdir, 'bioc_xml', input_dir)
+
+def bioc_stream_annotated(outputdir):
+    # Streamed documents must not reuse annotation IDs of the input.
+    from lxml import etree
+    outputdir = outdir(outputdir)
+    input_dir = join(outputdir, 'input')
+    os.makedirs(input_dir, exist_ok=True)
+    # Merge two documents with annotations into one collection.
+    paths = sorted(glob.glob(join(TESTFILES, 'bioc_xml', '*.xml')))[:2]
+    tree = etree.parse(paths[0])
+    tree.getroot().extend(etree.parse(paths[1]).iterfind('document'))
+    tree.write(join(input_dir, 'collection.xml'))
+    input_ids = Counter(tree.xpath('//annotation/@id'))
+    _compare_streamed(outputdir, 'bioc_xml', input_dir,
+                      '-c stream_scan_ids true')
+    output, = glob.glob(join(outputdir, 'true', '*.xml'))
+    new = Counter(etree.parse(output).xpath('//annotation/@id')) - input_ids
+    if any(n > 1 for n in new.values()) or set(new) & set(input_ids):
+        raise AssertionError('duplicate annotation IDs')
+
+def bioc_json_stream(outputdir):
+    # Incremental parsing must give the same nodes as json.load().
+    outputdir = outdir(outputdir)
+    input_dir = join(TESTFILES, 'bioc_json')
+    backends = [b for b in jsonstream.BACKENDS
+                if b != 'ijson' or jsonstream.ijson is not None]
+    for path in sorted(glob.glob(join(input_dir, '*.json'))):
+        with open(path, encoding='utf8') as f:
+            expected = json.load(f)
+        for backend in backends:
+            for chunk_size in (7, 2**16):
+                with open(path, encoding='utf8') as f:
+                    members = jsonstream.iter_members(f, 'documents',
+                                                      backend, chunk_size)
+                    parsed = {'documents': []}
+                    for key, value in members:
+                        if key == 'documents':
+                            parsed[key].append(value)
+                        else:
+                            parsed[key] = value
+                if parsed != expected:
+                    raise AssertionError('{} ({}): parsed nodes differ'
+                                         .format(path, backend))
+    _compare_streamed(outputdir, 'bioc_json', input_dir)
+
+def _compare_streamed(outputdir, fmt, input_dir, misc=''):
+    # Streamed collections must give the same output as loaded ones.
+    results = []
+    for stream in ('false', 'true'):
+        testlogger.info('-> %s tsv (stream_collections: %s)', fmt, stream)
+        output = join(outputdir, stream)
+        options = ('-c stream_collections {} '
+                   '-c termlist_abbrev_detection true {}'.format(stream, misc))
+        arguments = make_arguments(format=fmt,
+                                   mode='collection',
+                                   input=input_dir,
+                                   output=output,
+                                   export='{} tsv'.format(fmt),
+                                   miscellaneous=options)
+        run_with_arguments(arguments)
+        results.append(read_outputs(output))
+    if results[0] != results[1]:
+        raise AssertionError('streamed output differs')
+
+def termlist_mmap(outputdir):
+    # The compiled index must give the same results as the pickle.
+    _compare_variants(outdir(outputdir), 'cache_format', 'pickle', 'mmap')
+
+def termlist_compact(outputdir):
+    # Interned entry tables must give the same results as plain tuples.
+    _compare_variants(outdir(outputdir), 'compact', 'false', 'true')
+
+def termlist_build(outputdir):
+    # Parallel compilation must give the same tables as serial compilation.
+    shard_size = entity_recognition.BUILD_SHARD_SIZE
+    entity_recognition.BUILD_SHARD_SIZE = 100  # make sure there are shards
+    try:
+        _compare_variants(outdir(outputdir), 'build_workers', '1', '3',
+                          misc='-c termlist_force_reload true')
+    finally:
+        entity_recognition.BUILD_SHARD_SIZE = shard_size
+
+def normalize_cache(outputdir):
+    # Caching the normalized tokens must not change the results.
+    misc = ('-c termlist_normalize "lowercase stem" '
+            '-c termlist_cache {}'.format(join(CACHE.name, 'stem')))
+    _compare_variants(outdir(outputdir), 'normalize_cache', '0', '100',
+                      misc=misc)
+
+def abbrev_threads(outputdir):
+    # Abbreviation detection must be safe for concurrent threads.
+    del outputdir  # no output files
+    server = PipelineServer(Router(termlist_path=TERMLIST,
+                                   termlist_cache=CACHE.name,
+                                   termlist_skip_header=True,
+                                   termlist_abbrev_detection=True))
+    path = join(TESTFILES, 'pubtator', 'NCBIdevelopset_corpus.txt')
+
+    def annotate(_):
+        coll = server.load_one(path, 'pubtator')
+        server.process(coll)
+        return [(e.start, e.end, e.info) for e in coll.iter_entities()]
+
+    reference = annotate(None)
+    with ThreadPoolExecutor(4) as pool:
+        for result in pool.map(annotate, range(8)):
+            if result != reference:
+                raise AssertionError('concurrent results differ from serial')
+
+def termlist_shared(outputdir):
+    # Recognizers with the same termlist settings share the tables.
+    del outputdir  # no output files
+    # Use a separate cache, so that no other test shares this termlist.
+    cache = join(CACHE.name, 'shared')
+    settings = dict(termlist_path=TERMLIST, termlist_cache=cache,
+                    termlist_skip_header=True)
+    servers = [PipelineServer(Router(settings, **params), lazy=False)
+               for params in ({},
+                              {'termlist_engine': 'trie'},
+                              {'termlist_normalize': 'lowercase stem'})]
+    plain, trie, stem = (s.ers[0] for s in servers)
+    if plain.full_terms is not trie.full_terms:
+        raise AssertionError('termlist not shared')
+    if plain.full_terms is stem.full_terms:
+        raise AssertionError('termlist shared despite other normalization')
+    shared = plain._termlist
+    if shared.users != 2 or trie._termlist is not shared:
+        raise AssertionError('wrong user count: {}'.format(shared.users))
+    servers[0].close()
+    servers[0].close()  # no effect
+    if shared.users != 1 or shared not in list(termlists):
+        raise AssertionError('termlist released too early')
+    servers[1].close()
+    if shared.users != 0 or shared in list(termlists):
+        raise AssertionError('termlist not released')
+    if termlists._loading:
+        raise AssertionError('loading locks kept')
+
+def termlist_delta(outputdir):
+    # Diffs of the termlist update the cache and the loaded termlist.
+    with open(TERMLIST, encoding='utf8') as f:
+        removed, = (line for line in f if '\tNikotin\t' in line)
+    added = 'C000\tTest\tX:1\tzorbulase\tzorbulase\tchemical\n'
+    outputdir = outdir(outputdir)
+    os.makedirs(outputdir, exist_ok=True)
+    diff = join(outputdir, 'terms.diff')
+    with open(diff, 'w', encoding='utf8') as f:
+        f.write('--- old\n+++ new\n@@ -1 +1 @@\n-{}+{}'.format(removed, added))
+    text = 'Nikotin and zorbulase.'
+
+    def names(er):
+        return sorted(e[1] for _, e in er.recognize_entities(text))
+
+    # Applied once to the cached termlist.
+    settings = dict(termlist_path=TERMLIST, termlist_skip_header=True,
+                    termlist_cache=join(CACHE.name, 'delta'))
+    for _ in range(2):
+        server = PipelineServer(Router(settings, termlist_delta=diff),
+                                lazy=False)
+        if names(server.ers[0]) != ['zorbulase']:
+            raise AssertionError('delta not applied: {}'
+                                 .format(names(server.ers[0])))
+        server.close()
+    cache_file = join(CACHE.name, 'delta', 'test_terms.tsv.pickle')
+    with open(cache_file + '.deltas') as f:
+        if len(f.read().split()) != 1:
+            raise AssertionError('delta not recorded')
+
+    # The result equals a full rebuild of the patched termlist,
+    # including the order of the entries of a term.
+    with open(TERMLIST, encoding='utf8') as f:
+        lines = f.readlines()
+    removed, = (line for line in lines if '\tQ9SDT1\tPOR\t' in line)
+    added = ['CUI-less\tTest\tX:2\tPOR\tPOR test\tgene/protein\n',
+             'C000\tTest\tX:1\tzorbulase\tzorbulase\tchemical\n']
+    patched = join(outputdir, 'terms.tsv')
+    with open(patched, 'w', encoding='utf8') as f:
+        f.writelines(line for line in lines if line != removed)
+        f.writelines(added)
+    patch = join(outputdir, 'terms2.diff')
+    with open(patch, 'w', encoding='utf8') as f:
+        f.write('--- old\n+++ new\n@@ -1 +1,2 @@\n-{}+{}+{}'
+                .format(removed, *added))
+    delta, rebuilt = (
+        PipelineServer(Router(settings, termlist_cache=join(CACHE.name, c),
+                              **params), lazy=False).ers[0]
+        for c, params in (('delta2', {'termlist_delta': patch}),
+                          ('patched', {'termlist_path': patched})))
+    ids = [e[3] for e in delta.full_terms[('por',)]]
+    expected = [line.split('\t')[2] for line in lines + added
+                if '\tPOR\t' in line and line != removed]
+    if ids != expected:
+        raise AssertionError('entry order not kept: {}'.format(ids))
+    if (delta.term_first, delta.full_terms) != (rebuilt.term_first,
+                                                rebuilt.full_terms):
+        raise AssertionError('delta differs from a full rebuild')
+
+    # Hot update of a loaded annotator.
+    srv = _start_rest_server(termlist_cache=join(CACHE.name, 'delta-rest'))
+    url = 'http://127.0.0.1:{}/{{}}'.format(srv.server_port)
+    annotator = restfulserver.ann_manager.get(None)
+    try:
+        if names(annotator._pls.ers[0]) != ['nicotine']:
+            raise AssertionError('wrong initial termlist')
+        with open(diff, 'rb') as f:
+            req = urllib.request.Request(
+                url.format('dict/' + restfulserver.ann_manager.default),
+                data=f.read(), method='PATCH')
+        with urllib.request.urlopen(req) as r:
+            result = json.loads(r.read().decode('utf8'))
+        if result['changed terms'] != 2:
+            raise AssertionError('wrong number of changes: {}'.format(result))
+        req = urllib.request.Request(url.format('upload/txt/tsv'),
+                                     data=text.encode('utf8'))
+        with urllib.request.urlopen(req) as r:
+            body = r.read().decode('utf8')
+        if 'zorbulase' not in body or 'CHEBI:18723' in body:
+            raise AssertionError('termlist not updated:\n{}'.format(body))
+    finally:
+        srv.shutdown()
+        srv.server_close()
+        annotator.close()
+
+def document_model(outputdir):
+    # The slotted document units keep their public attributes
+    # through pickling and copying.
+    del outputdir  # no output files
+    path = join(TESTFILES, 'pxml.gz', 'medline16n0005_sampled.xml.gz')
+
+    def snapshot(content):
+        return [(s.text, s.start, s.end,
+                 [(e.id_, e.text, e.start, e.end, e.info) for e in s.entities])
+                for s in content.get_subelements('sentence')]
+
+    for table in (False, True):
+        server = PipelineServer(Router(termlist_path=TERMLIST,
+                                       termlist_cache=CACHE.name,
+                                       termlist_skip_header=True,
+                                       include_mesh=True,
+                                       entity_table=table))
+        coll = server.load_one(path, 'pxml.gz')
+        server.process(coll)
+        for article in coll:
+            article.tokenizer = None  # not needed for comparison
+        for section in coll.get_subelements('section'):
+            for sent in section:
+                offsets = sent.start-section.start, sent.end-section.start
+                if sent.text != section.text[slice(*offsets)]:
+                    raise AssertionError('sentence text differs from section')
+        # Take the snapshots of the clones first: reading the entities
+        # of the original unpacks its entity table.
+        clones = [snapshot(pickle.loads(pickle.dumps(coll))),
+                  snapshot(copy.deepcopy(coll))]
+        reference = snapshot(coll)
+        if any(clone != reference for clone in clones):
+            raise AssertionError('copied collection differs')
+
+    sent = next(coll.get_subelements('sentence'))
+    clone = copy.copy(sent)
+    clone.text = 'replaced'
+    if (sent.text == 'replaced' or clone.text != 'replaced'
+            or (clone.start, clone.end) != (sent.start, sent.end)):
+        raise AssertionError('sentence copy shares its text')
+
+def entity_table(outputdir):
+    # Columnar entity storage must give the same output as Entity objects,
+    # also after the built-in postfilters.
+    outputdir = outdir(outputdir)
+    results = []
+    for table in ('false', 'true'):
+        testlogger.info('-> txt tsv text_tsv bioc_xml (entity_table: %s)',
+                        table)
+        output = join(outputdir, table)
+        options = ('-c entity_table {} '
+                   '-c termlist_abbrev_detection true'.format(table))
+        arguments = make_arguments(format='txt',
+                                   output=output,
+                                   export='tsv text_tsv bioc_xml',
+                                   pointers='*.txt',
+                                   miscellaneous=options)
+        run_with_arguments(arguments)
+        results.append(read_outputs(output))
+    if results[0] != results[1]:
+        raise AssertionError('entity-table output differs')
+
+    paths = sorted(glob.glob(join(TESTFILES, 'txt', '1*.txt')))
+    servers = [PipelineServer(Router(termlist_path=TERMLIST,
+                                     termlist_cache=CACHE.name,
+                                     termlist_skip_header=True,
+                                     entity_table=table))
+               for table in (False, True)]
+    for postfilter in (post.remove_overlaps, post.remove_sametype_overlaps,
+                       post.remove_submatches,
+                       post.remove_sametype_submatches):
+        testlogger.info('-> %s', postfilter.__name__)
+        results = []
+        for server in servers:
+            results.append([])
+            for path in paths:
+                article = server.load_one(path, 'txt')
+                server.process(article)
+                postfilter(article)
+                results[-1].append(server.dump(article, 'tsv'))
+        if results[0] != results[1]:
+            raise AssertionError('entity-table output differs after {}'
+                                 .format(postfilter.__name__))
+
+    # Passages with overlapping offsets (allowed in BioC):
+    # entities of different sentences must not affect each other.
+    with open(paths[0], encoding='utf8') as f:
+        text = f.read().strip()
+    for postfilter in (post.remove_overlaps, post.remove_sametype_overlaps,
+                       post.remove_submatches,
+                       post.remove_sametype_submatches):
+        testlogger.info('-> %s (overlapping passages)', postfilter.__name__)
+        results = []
+        for server in servers:
+            article = doc.document.Article(
+                'overlap', tokenizer=server.conf.text_processor)
+            for shift in (0, 3, 7):
+                article.add_section('paragraph', text[shift:], offset=0)
+            server.process(article)
+            postfilter(article)
+            results.append(server.dump(article, 'tsv'))
+        if results[0] != results[1]:
+            raise AssertionError('entity-table output differs after {} '
+                                 'with overlapping passages'
+                                 .format(postfilter.__name__))
+
+    # Changes by external postfilters must be kept.
+    example = join(dirname(dirname(HERE)), 'examples', 'example-filter.py')
+    results = []
+    for table in ('false', 'true'):
+        testlogger.info('-> change_origin (entity_table: %s)', table)
+        output = join(outputdir, 'change_origin', table)
+        options = ('-c entity_table {} -p {}:change_origin'
+                   .format(table, example))
+        arguments = make_arguments(format='txt',
+                                   output=output,
+                                   export='tsv',
+                                   pointers='*.txt',
+                                   miscellaneous=options)
+        run_with_arguments(arguments)
+        results.append(read_outputs(output))
+    origins = {line.split(b'\t')[9]
+               for content in results[1].values()
+               for line in content.splitlines()}
+    if results[0] != results[1] or origins != {b'Biogrid'}:
+        raise AssertionError('postfilter changes lost with entity table')
+
+def rest_concurrent(outputdir):
+    # The REST server must give the same answers under concurrent load.
+    del outputdir  # no output files
+    srv = _start_rest_server()
+    url = 'http://127.0.0.1:{}/upload/txt/tsv'.format(srv.server_port)
+    def annotate(path):
+        with open(path, 'rb') as f:
+            req = urllib.request.Request(url, data=f.read())
+        with urllib.request.urlopen(req) as r:
+            return r.read()
+
+    try:
+        paths = sorted(glob.glob(join(TESTFILES, 'txt', '*.txt')))
+        reference = [annotate(p) for p in paths]
+        with ThreadPoolExecutor(8) as pool:
+            for _ in range(3):
+                if list(pool.map(annotate, paths)) != reference:
+                    raise AssertionError('concurrent responses differ')
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+def rest_batch(outputdir):
+    # Batch results must match single uploads, streamed in input order.
+    del outputdir  # no output files
+    srv = _start_rest_server()
+    url = 'http://127.0.0.1:{}/{{}}/{{}}/tsv'.format(srv.server_port)
+    paths = sorted(glob.glob(join(TESTFILES, 'txt', '*.txt')))
+    texts = []
+    for path in paths:
+        with open(path, encoding='utf8') as f:
+            texts.append(f.read())
+    payload = ''.join(json.dumps({'id': str(i), 'text': t}) + '\n'
+                      for i, t in enumerate(texts, 1))
+
+    def send(url, data):
+        req = urllib.request.Request(url, data=data.encode('utf8'))
+        with urllib.request.urlopen(req) as r:
+            return r.headers, r.read().decode('utf8')
+
+    try:
+        reference = [send(url.format('upload', 'txt') + '/' + str(i), t)[1]
+                     for i, t in enumerate(texts, 1)]
+        headers, body = send(url.format('batch', 'txt_jsonl'),
+                             payload + '{"id": "x", "text":\n')
+        if headers.get('Transfer-Encoding') != 'chunked':
+            raise AssertionError('batch response is not chunked')
+        results = [json.loads(line) for line in body.splitlines()]
+        if [r.get('data') for r in results[:-1]] != reference:
+            raise AssertionError('batch results differ from single uploads')
+        if 'error' not in results[-1]:
+            raise AssertionError('malformed batch input not reported')
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+def rest_streaming(outputdir):
+    # Streamed responses must be identical to the file export.
+    del outputdir  # no output files
+    srv = _start_rest_server()
+    url = 'http://127.0.0.1:{}/upload/pxml.gz/{{}}'.format(srv.server_port)
+    path, = glob.glob(join(TESTFILES, 'pxml.gz', '*'))
+    with open(path, 'rb') as f:
+        payload = f.read()
+    annotator = restfulserver.ann_manager.get(None)
+    try:
+        for fmt in ('bioc', 'tsv', 'bioc_json', 'odin'):
+            testlogger.info('-> %s', fmt)
+            req = urllib.request.Request(url.format(fmt), data=payload)
+            with urllib.request.urlopen(req) as r:
+                chunked = r.headers.get('Transfer-Encoding') == 'chunked'
+                streamed = r.read()
+            document = annotator._get_annotated(
+                dict(data=io.BytesIO(payload), fmt='pxml.gz'))
+            annotator._postfilter(document, [])
+            exporter = expfmts.EXPORTERS[fmt](annotator.config, fmt)
+            buffer = io.BytesIO() if exporter.binary else io.StringIO()
+            exporter.write(buffer, document)
+            reference = buffer.getvalue()
+            if isinstance(reference, str):
+                reference = reference.encode('utf8')
+            if chunked != (len(streamed) > CHUNK_SIZE):
+                raise AssertionError('chunked transfer: {}'.format(chunked))
+            if streamed != reference:
+                raise AssertionError('streamed output differs')
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+def rest_cache(outputdir):
+    # Fetched documents are annotated only once per annotator and format.
+    efetch = _start_efetch_server()
+    srv = _start_rest_server()
+    url = 'http://127.0.0.1:{}/{{}}'.format(srv.server_port)
+    fetcher_url, doc.PXMLFetcher.url = doc.PXMLFetcher.url, efetch.url
+    manager = restfulserver.ann_manager
+
+    def get(path):
+        with urllib.request.urlopen(url.format(path)) as r:
+            return r.read()
+
+    try:
+        first = get('fetch/pubmed/tsv/3010203')
+        if get('fetch/pubmed/tsv/3010203') != first:
+            raise AssertionError('cached response differs')
+        get('fetch/pubmed/bioc_json/3010203')
+        if len(efetch.requests) != 2:
+            raise AssertionError('expected 2 efetch requests, got {}'
+                                 .format(len(efetch.requests)))
+        status = json.loads(get('status'))['response cache']
+        if (status['hits'], status['misses']) != (1, 2):
+            raise AssertionError('wrong cache statistics: {}'.format(status))
+
+        # Removing an annotator invalidates its entries.
+        name = manager.add({'termlist_abbrev_detection': 'false'},
+                           blocking=True)
+        get('fetch/pubmed/tsv/3010203?dict={}'.format(name))
+        entries = manager.responses.stats()['entries']
+        manager.remove(name)
+        if manager.responses.stats()['entries'] != entries - 1:
+            raise AssertionError('entries not invalidated')
+        # Responses computed before an invalidation are not added.
+        generation = manager.responses.generation(name)
+        manager.responses.invalidate(name)
+        manager.responses.put((name, 1), 'text/plain', b'x', generation)
+        if manager.responses.get((name, 1)) is not None:
+            raise AssertionError('stale response added')
+
+        # A rebuilt termlist doesn't use the previous entries.
+        er = manager.get(None)._pls.ers[0]
+        stat = os.stat(er._cache_file)
+        os.utime(er._cache_file,
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        requests = len(efetch.requests)
+        get('fetch/pubmed/tsv/3010203')
+        if len(efetch.requests) != requests + 1:
+            raise AssertionError('response of the old termlist used')
+
+        # Entries on disk survive a restart.
+        directory = join(outdir(outputdir), 'cache')
+        for _ in range(2):
+            cache = respcache.ResponseCache(directory=directory)
+            if cache.get(('a', 1)) is None:
+                cache.put(('a', 1), 'text/plain', b'x')
+            elif cache.get(('a', 1)) != ('text/plain', b'x'):
+                raise AssertionError('disk cache corrupted')
+        if cache.stats()['hits'] != 2:
+            raise AssertionError('disk cache not used')
+    finally:
+        doc.PXMLFetcher.url = fetcher_url
+        srv.shutdown()
+        srv.server_close()
+        efetch.shutdown()
+        efetch.server_close()
+
+def rest_memory(outputdir):
+    # Annotators beyond the memory budget are removed in LRU order.
+    del outputdir  # no output files
+    cache = join(CACHE.name, 'memory')
+    manager = restfulserver.AnnotatorManager(
+        dict(termlist_path=TERMLIST, termlist_cache=cache,
+             termlist_skip_header=True))
+    base = manager.memory_usage()
+    if base <= 0 or base != manager.get(None).size():
+        raise AssertionError('wrong default size: {}'.format(base))
+    # A shared termlist is counted only once.
+    shared = manager.add({'termlist_normalize_cache': '100'},
+                         blocking=True)
+    if manager.memory_usage() != base:
+        raise AssertionError('shared termlist counted twice')
+    greek, stem = (manager.add({'termlist_normalize': n}, blocking=True)
+                   for n in ('lowercase greektranslit', 'lowercase stem'))
+    total = manager.memory_usage()
+    if total <= base:
+        raise AssertionError('additional termlists not counted')
+    for name in (shared, greek):
+        manager.get(name)  # leave stem as the least recently used
+    manager.budget = total - 1
+    manager.purge()
+    if sorted(manager.additional) != sorted([shared, greek]):
+        raise AssertionError('wrong annotator evicted: {}'
+                             .format(manager.additional))
+    manager.budget = 0
+    manager.purge()
+    if manager.additional != [greek]:
+        raise AssertionError('most recently used annotator evicted')
+    manager.remove(greek)
+
+def efetch_store(outputdir):
+    # Stored documents must be used instead of downloading them again.
+    outputdir = outdir(outputdir)
+    pointers = _pmid_pointers(outputdir, 8)
+    store = join(outputdir, 'store')
+    results = []
+    with _efetch_server() as efetch:
+        for misc, requests in (('', 1),
+                               ('-c efetch_store ' + store, 2),
+                               ('-c efetch_store {} -c efetch_offline true'
+                                .format(store), 2)):
+            testlogger.info('-> tsv (%s)', misc or 'no store')
+            output = join(outputdir, str(len(results)))
+            arguments = make_arguments(format='pubmed',
+                                       output=output,
+                                       pointers=pointers,
+                                       pointer_type='id',
+                                       export='tsv',
+                                       miscellaneous=misc)
+            run_with_arguments(arguments)
+            results.append(read_outputs(output))
+            if len(efetch.requests) != requests:
+                raise AssertionError('expected {} efetch requests, got {}'
+                                     .format(requests, len(efetch.requests)))
+    if not results[0] or results.count(results[0]) != len(results):
+        raise AssertionError('stored documents give different output')
+    if len(glob.glob(join(store, 'objects', '*', '*.gz'))) != 8:
+        raise AssertionError('documents missing in the store')
+    # IDs must not reach outside the store.
+    for docid in ('.', '..', '../x', ''):
+        try:
+            DocumentStore(store).put('pubmed', docid, b'x')
+        except ValueError:
+            continue
+        raise AssertionError('invalid ID accepted: {!r}'.format(docid))
+
+def efetch_prefetch(outputdir):
+    # Concurrent chunk downloads must respect the rate limit and the order.
+    outputdir = outdir(outputdir)
+    pointers = _pmid_pointers(outputdir, 12)
+    results = []
+    for workers in (1, 3):
+        testlogger.info('-> tsv (%d workers)', workers)
+        output = join(outputdir, str(workers))
+        misc = ('-c efetch_max_ids 2 -c efetch_workers {} -c efetch_rate 10 '
+                '-c efetch_api_key secret'.format(workers))
+        arguments = make_arguments(format='pubmed',
+                                   output=output,
+                                   mode='collection',
+                                   pointers=pointers,
+                                   pointer_type='id',
+                                   export='tsv bioc_xml',
+                                   miscellaneous=misc)
+        with _efetch_server(delay=.5) as efetch:
+            run_with_arguments(arguments)
+        # Collection output: the file names contain a timestamp.
+        results.append(list(read_outputs(output).values()))
+        times = sorted(t for t, _ in efetch.log)
+        if len(efetch.requests) != 6 or efetch.max_active != workers:
+            raise AssertionError('{} requests, {} concurrent'.format(
+                len(efetch.requests), efetch.max_active))
+        if min(b-a for a, b in zip(times, times[1:])) < .09:
+            raise AssertionError('rate limit exceeded')
+        if any(key != ['secret'] for _, key in efetch.log):
+            raise AssertionError('API key not sent')
+    if not results[0] or results[0] != results[1]:
+        raise AssertionError('prefetched output differs')
+
+@contextmanager
+def _efetch_server(delay=0):
+    # Direct the PubMed fetcher to a local efetch server while in use.
+    efetch = _start_efetch_server(delay)
+    fetcher_url, doc.PXMLFetcher.url = doc.PXMLFetcher.url, efetch.url
+    try:
+        yield efetch
+    finally:
+        doc.PXMLFetcher.url = fetcher_url
+        efetch.shutdown()
+        efetch.server_close()
+
+def _pmid_pointers(outputdir, n):
+    # Write the IDs of the first n pxml test files to a pointer file.
+    os.makedirs(outputdir, exist_ok=True)
+    pointers = join(outputdir, 'pmids.txt')
+    with open(pointers, 'w') as f:
+        for path in sorted(glob.glob(join(TESTFILES, 'pxml', '*.pxml')))[:n]:
+            f.write(os.path.basename(path)[:-5] + '\n')
+    return pointers
+
+def _start_efetch_server(delay=0):
+    # Local stand-in for NCBI's efetch, serving the pxml test files.
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = self.rfile.read(int(self.headers['Content-Length']))
+            query = parse_qs(query.decode('ascii'))
+            docids = query['id'][0].split(',')
+            with self.server.lock:
+                self.server.requests.append(docids)
+                self.server.log.append((time.time(), query.get('api_key')))
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active,
+                                             self.server.active)
+            time.sleep(delay)
+            with self.server.lock:
+                self.server.active -= 1
+            body = [b'<?xml version="1.0"?>\n<PubmedArticleSet>']
+            for docid in docids:
+                path = join(TESTFILES, 'pxml', docid + '.pxml')
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        citation = f.read().split(b'?>', 1)[1]
+                    body.extend((b'<PubmedArticle>', citation,
+                                 b'</PubmedArticle>'))
+            body.append(b'</PubmedArticleSet>\n')
+            body = b''.join(body)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    srv.requests, srv.log = [], []
+    srv.lock, srv.active, srv.max_active = threading.Lock(), 0, 0
+    srv.url = 'http://127.0.0.1:{}/efetch.fcgi'.format(srv.server_port)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+def _start_rest_server(**settings):
+    import bottle
+    defaults = dict(termlist_path=TERMLIST, termlist_cache=CACHE.name,
+                    termlist_skip_header=True, termlist_abbrev_detection=True)
+    restfulserver.ann_manager = restfulserver.AnnotatorManager(
+        dict(defaults, **settings))
+    srv = wsgiserver.make_server(
+        '127.0.0.1', 0, bottle.default_app(),
+        lambda *args: wsgiserver.PooledWSGIServer(*args, workers=4),
+        wsgiserver.QuietHandler)
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    return srv
+
+def er_engine(outputdir):
+    # The trie engine must give the same results as hash probing.
+    _compare_variants(outdir(outputdir), 'engine', 'hash', 'trie')
+
+def parallel(outputdir):
+    # Parallel workers must give the same results as serial processing.
+    results = []
+    for n in ('1', '3'):
+        testlogger.info('-> tsv (%s workers)', n)
+        output = join(outdir(outputdir), n)
+        arguments = make_arguments(format='txt',
+                                   output=output,
+                                   export='tsv',
+                                   pointers='*.txt',
+                                   miscellaneous='-j {}'.format(n))
+        run_with_arguments(arguments)
+        results.append(read_outputs(output))
+    if results[0] != results[1]:
+        raise AssertionError('parallel output differs from serial')
+
+def parallel_collection(outputdir):
+    # Parallel workers must not split the efetch requests into chunks,
+    # nor overwrite each other's collections.
+    outputdir = outdir(outputdir)
+    pointers = _pmid_pointers(outputdir, 12)
+    results = []
+    for n in ('1', '2'):
+        testlogger.info('-> tsv (collection, %s workers)', n)
+        output = join(outputdir, n)
+        arguments = make_arguments(format='pubmed',
+                                   output=output,
+                                   mode='collection',
+                                   pointers=pointers,
+                                   pointer_type='id',
+                                   export='tsv',
+                                   miscellaneous='-j {} --chunk-size 2'
+                                                 .format(n))
+        with _efetch_server() as efetch:
+            run_with_arguments(arguments)
+        if len(efetch.requests) > int(n):
+            raise AssertionError('{} efetch requests with {} workers'
+                                 .format(len(efetch.requests), n))
+        # Compare the entities of all collections (one per worker).
+        lines = set()
+        for content in read_outputs(output).values():
+            lines.update(content.splitlines())
+        results.append(lines)
+    if not results[0] or results[0] != results[1]:
+        raise AssertionError('parallel collections differ from serial')
+
+def pipeline(outputdir):
+    # Pipeline mode must preserve order and entity IDs.
+    for mode in ('collection', 'document'):
+        results = []
+        for misc in ('', '--pipeline -j 2'):
+            testlogger.info('-> bioc_xml tsv (%s, %s)', mode, misc or 'serial')
+            output = join(outdir(outputdir), mode, str(len(results)))
+            arguments = make_arguments(format='pxml.gz',
+                                       mode=mode,
+                                       output=output,
+                                       export='bioc_xml tsv',
+                                       miscellaneous=misc)
+            run_with_arguments(arguments)
+            results.append(read_outputs(output))
+        if results[0] != results[1]:
+            raise AssertionError('pipeline output differs from serial')
+
+def _compare_variants(outputdir, param, reference, variant, misc=''):
+    '''Check that two values of an ER parameter give the same output.'''
+    results = []
+    for value in (reference, variant):
+        for abbrev in ('false', 'true'):
+            testlogger.info('-> tsv (%s: %s, abbrev: %s)',
+                            param, value, abbrev)
+            output = join(outputdir, value, abbrev)
+            options = ('-c termlist_{} {} -c termlist_abbrev_detection {} {}'
+                       .format(param, value, abbrev, misc))
+            arguments = make_arguments(format='pubtator',
+                                       output=output,
+                                       export='tsv',
+                                       miscellaneous=options)
+            run_with_arguments(arguments)
+            results.append(read_outputs(output))
+    if results[:2] != results[2:]:
+        raise AssertionError('{} {} differs from {}'
+                             .format(param, variant, reference))
+
 def download_pubmed(outputdir):
     pointers = join(IDFILES, 'pubmed_pmids.txt')
     output = join(outputdir, 'pubmed')
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# coding: utf8
+
+
+'''
+Incremental reading of large JSON objects.
+
+The members of a top-level JSON object are produced one
+by one; the elements of a selected array member (eg. the
+documents of a BioC collection) are produced separately,
+so only one of them needs to be in memory at a time.
+
+If the ijson package is installed, its event-based parser
+is used.  Otherwise, the input is decoded piece by piece
+with the json module of the standard library.
+'''
+
+
+import re
+import json
+from decimal import Decimal
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from .stream import CHUNK_SIZE
+
+
+BACKENDS = ('ijson', 'json')
+
+
+def iter_members(stream, split, backend=None, chunk_size=CHUNK_SIZE):
+    '''
+    Iterate over the pairs <key, value> of a JSON object.
+
+    The value of the member named `split` must be an array;
+    each of its elements is produced as a separate pair
+    <split, element>.  Members are produced in input order.
+
+    The stream is a text stream.  Backend is one of BACKENDS,
+    or None for the fastest one available.
+    '''
+    if backend is None:
+        backend = 'json' if ijson is None else 'ijson'
+    if backend == 'ijson':
+        if ijson is None:
+            raise ValueError('JSON backend not available: ijson')
+        return _iter_ijson(stream, split)
+    if backend == 'json':
+        return _iter_json(stream, split, chunk_size)
+    raise ValueError('unknown JSON backend: {}'.format(backend))
+
+
+def _iter_ijson(stream, split):
+    # ijson parses UTF-8 bytes; use the underlying binary stream if possible.
+    events = ijson.parse(getattr(stream, 'buffer', stream))
+    key = None
+    for prefix, event, value in events:
+        if prefix == '':
+            if event == 'map_key':
+                key = value
+            continue  # start or end of the top-level object
+        if prefix == split and event in ('start_array', 'end_array'):
+            continue  # the elements are produced separately
+        yield key, _build(event, value, events)
+
+
+def _build(event, value, events):
+    '''Assemble the value starting with this event.'''
+    if event not in ('start_map', 'start_array'):
+        return _number(value)
+    builder = ijson.common.ObjectBuilder()
+    depth = 0
+    while True:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+        builder.event(event, _number(value))
+        if depth == 0:
+            return builder.value
+        _, event, value = next(events)
+
+
+def _number(value):
+    # ijson produces Decimal for non-integers.
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _iter_json(stream, split, chunk_size):
+    reader = _PieceReader(stream, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        if not isinstance(key, str):
+            raise ValueError('malformed JSON: object key must be a string')
+        reader.expect(':')
+        if key == split:
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield key, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            yield key, reader.value()
+        if reader.expect(',}') == '}':
+            break
+
+
+class _PieceReader:
+    '''
+    Decode JSON values from a buffered part of a text stream.
+    '''
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def peek(self):
+        '''Get the next non-whitespace character.'''
+        while True:
+            self.pos = self._whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError('malformed JSON: unexpected end of input')
+            self._read(self.chunk_size)
+
+    def expect(self, chars):
+        '''Consume one of these structural characters.'''
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('malformed JSON: expected {}, found {!r}'
+                             .format(' or '.join(map(repr, chars)), char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''Decode the next complete value.'''
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                # A number at the end of the buffer might be truncated.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            # Incomplete value: read more, in growing pieces.
+            self._read(size)
+            size *= 2
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if not data:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
@@ -11,12 +11,16 @@ Streaming utilities.
 
 import io
 import os
+import queue
 import codecs
+import threading
 import urllib.request
 
 
 REMOTE_PROTOCOLS = ('http://', 'https://', 'ftp://')
 
+CHUNK_SIZE = 2**16
+
 
 def ropen(locator, encoding='utf-8', **kwargs):
     '''
@@ -53,3 +57,82 @@ def basename(source):
     if isinstance(source, str):
         return os.path.splitext(os.path.basename(source))[0]
     return None
+
+
+def iter_written(write, binary=False, chunk_size=CHUNK_SIZE, buffer=4):
+    '''
+    Iterate over the output of a function writing to a stream.
+
+    The function write is called with a file-like object
+    in a separate thread.  Whenever chunk_size characters
+    (or bytes, if binary is True) have been written, they are
+    passed on as a chunk.  At most `buffer` chunks are held
+    in memory; the writer is paused until they are consumed.
+    Exceptions in write are re-raised in the iterating thread.
+    If the iteration is aborted, write is stopped with an
+    exception at its next write call.
+    '''
+    sink = _QueueWriter(queue.Queue(maxsize=buffer), chunk_size, binary)
+    thread = threading.Thread(target=sink.run, args=(write,), daemon=True)
+    thread.start()
+    try:
+        for chunk in iter(sink.chunks.get, None):
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        sink.cancelled = True
+        # Unblock the writer, in case it is waiting for a free slot.
+        while thread.is_alive():
+            try:
+                sink.chunks.get(timeout=.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+class _QueueWriter:
+    '''
+    Write-only stream putting chunks on a queue.
+    '''
+    def __init__(self, chunks, chunk_size, binary):
+        self.chunks = chunks
+        self.chunk_size = chunk_size
+        self.cancelled = False
+        self._empty = b'' if binary else ''
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        'Add data to the current chunk.'
+        if self.cancelled:
+            raise BrokenPipeError('stream consumer has stopped')
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.chunk_size:
+            self._pass_on()
+        return len(data)
+
+    def writelines(self, lines):
+        'Add each line to the current chunk.'
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        'Do nothing: chunks are passed on when full.'
+
+    def _pass_on(self):
+        if self._buffer:
+            self.chunks.put(self._empty.join(self._buffer))
+            self._buffer.clear()
+            self._size = 0
+
+    def run(self, write):
+        'Call write(self) and signal the end or an error.'
+        try:
+            write(self)
+            self._pass_on()
+        except BaseException as e:
+            self.chunks.put(e)
+        else:
+            self.chunks.put(None)